@@ -1,47 +1,218 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
+import base64
+import contextvars
+import fcntl
+import hashlib
+import http.client
+import inspect
 import json
 import os
+import random
 import re
+import shlex
+import signal
+import socket
+import socketserver
+import stat
+import sqlite3
+import ssl
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.parse
+from collections import namedtuple
+from contextlib import closing, contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
 
 # Configuration (absolute paths so deploy.py works from any CWD)
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TERRAFORM_DIR = os.path.join(_SCRIPT_DIR, "terraform")
 
 _VALID_ENVS = ("dev", "prod", "management", "all")
+# Lệnh phụ (không deploy): deploy.py tunnels [status|stop], deploy.py stats [env], deploy.py destroy [env...],
+# deploy.py status [env...] [--json]
+_COMMANDS = ("tunnels", "stats", "destroy", "status")
+
+
+def _parse_args(argv):
+    """Không truyền gì → deploy toàn bộ (management + dev + prod + ArgoCD GitOps). Có truyền → dev | prod | management.
+    Trả về (env, command, args còn lại của command, flags --xxx); sai tham số → in usage và thoát."""
+    args = [a for a in argv if not a.startswith("--")]
+    flags = {a for a in argv if a.startswith("--")}
+    if not args:
+        return os.environ.get("TF_ENV", "all"), None, [], flags
+    first = args[0].lower()
+    if first in _VALID_ENVS:
+        return first, None, args[1:], flags
+    if first in _COMMANDS:
+        return os.environ.get("TF_ENV", "all"), first, args[1:], flags
+    print(f"Usage: {sys.argv[0]}  (deploy tất cả)  hoặc  {sys.argv[0]} [dev|prod|management] [--resume] [--plan]", file=sys.stderr)
+    print(f"       {sys.argv[0]} tunnels [status|stop]", file=sys.stderr)
+    print(f"       {sys.argv[0]} stats [env]", file=sys.stderr)
+    print(f"       {sys.argv[0]} destroy [networking|dev|prod|management ...]", file=sys.stderr)
+    print(f"       {sys.argv[0]} status [dev|prod|management ...] [--json]", file=sys.stderr)
+    print(f"Invalid environment: {args[0]}", file=sys.stderr)
+    sys.exit(1)
 
 
-def _get_terraform_env():
-    """Không truyền gì → deploy toàn bộ (management + dev + prod + ArgoCD GitOps). Có truyền → dev | prod | management."""
-    if len(sys.argv) >= 2:
-        env = sys.argv[1].lower()
-        if env in _VALID_ENVS:
-            return env
-        print(f"Usage: {sys.argv[0]}  (deploy tất cả)  hoặc  {sys.argv[0]} [dev|prod|management]", file=sys.stderr)
-        print(f"Invalid environment: {sys.argv[1]}", file=sys.stderr)
-        sys.exit(1)
-    return os.environ.get("TF_ENV", "all")
-
-
-TERRAFORM_ENV = _get_terraform_env()
-TERRAFORM_ENV_DIR = os.path.join(TERRAFORM_DIR, "environments", TERRAFORM_ENV)
 ANSIBLE_DIR = os.path.join(_SCRIPT_DIR, "ansible")
+# State cục bộ của deploy.py (log, cache...) — không commit
+_STATE_DIR = os.path.join(_SCRIPT_DIR, ".deploy")
+_LOG_DIR = os.path.join(_STATE_DIR, "logs")
+# Thư mục riêng mỗi env (.deploy/run/<env>): file sinh ra khi deploy (inventory, script, unit...) + lock của env
+_RUN_ROOT = os.path.join(_STATE_DIR, "run")
 HELM_DIR = os.path.join(_SCRIPT_DIR, "k8s_helm")
-# Per-env kubeconfig để dev/prod không ghi đè lên nhau
-KUBECONFIG_FILE = os.path.join(_SCRIPT_DIR, f"kube_config_rke2_{TERRAFORM_ENV}.yaml")
 SSH_KEY_FILE_NAME = "k8s-key.pem"
 # Cổng tunnel riêng mỗi env để chạy nhiều env cùng lúc không xung đột
 LOCAL_PORT_BY_ENV = {"dev": 6443, "prod": 6445, "management": 6446}
-# Trong deploy: file tạm 127.0.0.1:<port> cho tunnel; file ghi ra cho user (KUBECONFIG_FILE) = master IP
-KUBECONFIG_TUNNEL_FILE = None
+
+
+class EnvContext:
+    """Một env trong lần chạy: cấu hình (thư mục Terraform, kubeconfig, host app...) + state runtime mà các step
+    điền vào (IP master, jump host, port tunnel...). Step nhận nó làm ctx; code không nhận ctx dùng current_env().
+    Không tính gì lúc import → full pipeline chạy management/dev/prod trong cùng process (chung cache Terraform
+    output, SSH master, tunnel), và import deploy.py (test, script khác) không có side effect."""
+
+    def __init__(self, env, resume=False, skip_terraform=None):
+        self.env = env
+        self.resume = resume
+        # SKIP_TERRAFORM=1: bỏ qua Terraform apply của env (full pipeline tự apply dev/prod ở step riêng)
+        self.skip_terraform = os.environ.get("SKIP_TERRAFORM") == "1" if skip_terraform is None else skip_terraform
+        self.journal = None
+        # Trong deploy: file tạm 127.0.0.1:<port> cho tunnel; file ghi ra cho user (kubeconfig_file) = master IP
+        self.kubeconfig_tunnel_file = None
+
+    @property
+    def env_dir(self):
+        return os.path.join(TERRAFORM_DIR, "environments", self.env)
+
+    @property
+    def kubeconfig_file(self):
+        # Per-env kubeconfig để dev/prod không ghi đè lên nhau
+        return os.path.join(_SCRIPT_DIR, f"kube_config_rke2_{self.env}.yaml")
+
+    @property
+    def tunnel_kubeconfig_path(self):
+        # Bản kubeconfig trỏ 127.0.0.1:<port tunnel>, chỉ deploy.py dùng
+        return os.path.join(_SCRIPT_DIR, f".kube_config_rke2_{self.env}_tunnel.yaml")
+
+    @property
+    def ssh_key_path(self):
+        return os.path.abspath(os.path.join(self.env_dir, SSH_KEY_FILE_NAME))
+
+    @property
+    def local_port(self):
+        return LOCAL_PORT_BY_ENV.get(self.env, 6443)
+
+    @property
+    def app_ingress_host(self):
+        return f"meo-stationery-{self.env}.local"
+
+    def run_path(self, name):
+        """Path của file name trong thư mục riêng của env (tạo thư mục nếu chưa có)."""
+        run_dir = os.path.join(_RUN_ROOT, self.env)
+        os.makedirs(run_dir, exist_ok=True)
+        return os.path.join(run_dir, name)
+
+
+@contextmanager
+def env_lock(ctx):
+    """Giữ .deploy/run/<env>/deploy.lock suốt lần deploy env. Deploy thứ hai cùng env (terminal / CI job khác, hay
+    trong cùng process) dừng ngay thay vì ghi đè file của nhau; env khác nhau chạy song song bình thường."""
+    with open(ctx.run_path("deploy.lock"), "a+") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.seek(0)
+            holder = lock.read().strip() or "unknown"
+            print(f"  ✗ Env {ctx.env} đang được deploy ở nơi khác ({holder}); đợi xong rồi chạy lại.")
+            sys.exit(1)
+        lock.truncate(0)
+        lock.write(f"pid {os.getpid()}, since {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        lock.flush()
+        yield
+
+
+_CURRENT_ENV = contextvars.ContextVar("deploy_env", default=None)
+_default_env = None
+
+
+def current_env():
+    """EnvContext của step / thread đang chạy (mặc định: TF_ENV hoặc "all", tạo lần đầu cần)."""
+    global _default_env
+    ctx = _CURRENT_ENV.get()
+    if ctx is None:
+        if _default_env is None:
+            _default_env = EnvContext(os.environ.get("TF_ENV", "all"))
+        ctx = _default_env
+    return ctx
+
+
+@contextmanager
+def use_env(ctx):
+    """Chạy block với ctx là env hiện tại (thread / task khác không bị ảnh hưởng)."""
+    token = _CURRENT_ENV.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _CURRENT_ENV.reset(token)
+
+
+def _with_context(func):
+    """Bọc func để chạy trong context (env hiện tại, output) của thread gọi — cho ThreadPoolExecutor."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+# Output theo context: full pipeline chạy song song → print + process con của mỗi env vào log riêng của env đó
+_OUTPUT = contextvars.ContextVar("deploy_output", default=None)
+
+
+class _ContextStdout:
+    """sys.stdout thay thế: ghi vào file output của context hiện tại nếu có, không thì stdout gốc."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        return (_OUTPUT.get() or self._stream).write(text)
+
+    def flush(self):
+        (_OUTPUT.get() or self._stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+@contextmanager
+def output_to(f):
+    """print() và process con (không capture) trong block — kể cả thread step tạo từ đây — ghi vào file f."""
+    if not isinstance(sys.stdout, _ContextStdout):
+        sys.stdout = _ContextStdout(sys.stdout)
+    token = _OUTPUT.set(f)
+    try:
+        yield f
+    finally:
+        _OUTPUT.reset(token)
+
+
+def _default_output(kwargs):
+    """stdout/stderr của process con theo output của context (như process con kế thừa fd của deploy.py)."""
+    out = _OUTPUT.get()
+    if out is None or kwargs.get("capture_output"):
+        return kwargs
+    out.flush()
+    return {**kwargs, "stdout": kwargs.get("stdout") or out, "stderr": kwargs.get("stderr") or out}
 
 
 def _kubeconfig_for_deploy():
     """Path kubeconfig dùng trong deploy (tunnel nếu đã tạo, không thì file chính)."""
-    return os.path.abspath(KUBECONFIG_TUNNEL_FILE or KUBECONFIG_FILE)
+    ctx = current_env()
+    return os.path.abspath(ctx.kubeconfig_tunnel_file or ctx.kubeconfig_file)
 
 
 # App / UI settings
@@ -53,100 +224,1582 @@ RANCHER_BOOTSTRAP_PASSWORD = "Admin123!"
 # Rancher chart requires cert-manager CRDs
 CERT_MANAGER_CRDS_URL = "https://github.com/cert-manager/cert-manager/releases/download/v1.13.0/cert-manager.crds.yaml"
 
+# Helm chart bên ngoài, pin version: tarball cache ở .deploy/helm; đổi version ở đây = tải lại chart
+# name → (repo URL, chart, version)
+# Cặp với Kubernetes của cluster: RKE2 pin ở terraform/modules/rke2 (rke2_version = v1.31.4+rke2r1 → k8s 1.31).
+# Rancher 2.10.x khai báo kubeVersion < 1.32 — nâng rke2_version lên 1.32+ thì phải nâng Rancher cùng lúc;
+# argo-cd 7.7.x / external-secrets 0.18.x / aws-ebs-csi-driver 2.36.x đều hỗ trợ 1.31.
+HELM_CHARTS = {
+    "aws-ebs-csi-driver": ("https://kubernetes-sigs.github.io/aws-ebs-csi-driver", "aws-ebs-csi-driver", "2.36.0"),
+    "rancher": ("https://releases.rancher.com/server-charts/latest", "rancher", "2.10.1"),
+    "argo-cd": ("https://argoproj.github.io/argo-helm", "argo-cd", "7.7.11"),
+    "external-secrets": ("https://charts.external-secrets.io", "external-secrets", "0.18.2"),
+}
+_HELM_CACHE_DIR = os.path.join(_STATE_DIR, "helm")
+
+# Số step chạy song song tối đa trong pipeline của một env (DEPLOY_MAX_WORKERS=1 → chạy tuần tự như cũ)
+DEPLOY_MAX_WORKERS = int(os.environ.get("DEPLOY_MAX_WORKERS", "4"))
+
+# Ngân sách chung (giây) cho mọi wait trong một lần chạy; 0 = không giới hạn (mỗi wait chỉ theo timeout riêng)
+DEPLOY_WAIT_BUDGET = float(os.environ.get("DEPLOY_WAIT_BUDGET", "0"))
+
+# Full pipeline (./deploy.py): số env/Terraform apply chạy song song (DEPLOY_ENV_CONCURRENCY=1 → tuần tự, log ra terminal)
+DEPLOY_ENV_CONCURRENCY = int(os.environ.get("DEPLOY_ENV_CONCURRENCY", "3"))
+
+# Số process con dài (terraform/helm/ansible...) chạy cùng lúc tối đa trong một deploy.py. Probe của wait và command
+# ngắn (timeout ≤ _SHORT_PROCESS giây: kubectl check, ssh -O check...) không chiếm slot → không xếp hàng sau apply dài
+DEPLOY_MAX_PROCS = int(os.environ.get("DEPLOY_MAX_PROCS", "8"))
+_SHORT_PROCESS = 30
+
+# Pipeline huỷ (step lỗi / Ctrl-C): process đang chạy nhận SIGINT, còn sống sau bấy nhiêu giây thì SIGKILL
+DEPLOY_KILL_GRACE = float(os.environ.get("DEPLOY_KILL_GRACE", "15"))
+
+# Terraform incremental: bỏ qua init khi lock file / nguồn module không đổi, bỏ qua apply khi plan không có diff.
+# DEPLOY_TF_INCREMENTAL=0 → luôn init + apply -auto-approve như trước
+DEPLOY_TF_INCREMENTAL = os.environ.get("DEPLOY_TF_INCREMENTAL", "1") != "0"
+
+# Ansible OpenVPN: auto = bỏ qua playbook khi server đã báo fingerprint (playbook + vars) của lần apply trước
+# và .ovpn đã có local; always = luôn chạy playbook
+DEPLOY_ANSIBLE_MODE = os.environ.get("DEPLOY_ANSIBLE_MODE", "auto")
+
+# deploy.py status: thời gian tối đa (giây) đợi tunnel API của một env lên (tunnel warm → trả lời ngay)
+DEPLOY_STATUS_TIMEOUT = float(os.environ.get("DEPLOY_STATUS_TIMEOUT", "15"))
+
+# Một bước của pipeline: func(ctx) chạy sau khi mọi step trong deps đã xong.
+# fingerprint(ctx) → input của step (JSON được), check(ctx) → post-condition còn đúng; có cả hai thì resume được.
+Step = namedtuple("Step", ["name", "func", "deps", "fingerprint", "check"], defaults=((), None, None))
+
+
+# --- Tracing: span cho mỗi step / wait / process con → Chrome trace (.deploy/trace-<run>.json) + bảng cuối run ---
+# Span ghi env của context đang chạy → full pipeline (mọi env trong một process) vẫn là mỗi env một "process"
+# trong viewer. main() đăng ký ghi trace lúc thoát; import deploy.py không ghi gì.
+_TRACE_RUN = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+SPANS = []
+_spans_lock = threading.Lock()
+_PROCESS_STARTED = time.time()
+# Tên tool hiển thị theo executable (ansible-playbook → ansible...)
+_TOOLS = {"terraform": "terraform", "ssh": "ssh", "scp": "ssh", "kubectl": "kubectl", "helm": "helm",
+          "ansible-playbook": "ansible", "curl": "curl", "aws": "aws", "openssl": "openssl"}
+
+
+def _tool_of(command):
+    """Tool của một command (list args hoặc shell string), bỏ qua sudo / VAR=... ở đầu."""
+    words = command if isinstance(command, (list, tuple)) else command.split()
+    for word in words:
+        word = os.path.basename(str(word))
+        if word == "sudo" or "=" in word:
+            continue
+        if word.startswith("python"):
+            return "deploy.py"
+        return _TOOLS.get(word, "other")
+    return "other"
+
+
+def _record_span(name, cat, start, duration, args):
+    event = {"name": name, "cat": cat, "ph": "X", "ts": int(start * 1e6), "dur": int(duration * 1e6),
+             "pid": os.getpid(), "tid": threading.get_native_id(), "args": {"env": current_env().env, **args}}
+    with _spans_lock:
+        SPANS.append(event)
+
+
+@contextmanager
+def span(name, cat="step", **args):
+    """Đo wall time của block; args (dict yield ra) thêm được exit_code, attempts... trong block."""
+    start, t0 = time.time(), time.monotonic()
+    try:
+        yield args
+    except subprocess.CalledProcessError as e:
+        args.setdefault("exit_code", e.returncode)
+        raise
+    except subprocess.TimeoutExpired:
+        args.setdefault("exit_code", "timeout")
+        raise
+    except SystemExit as e:
+        if e.code in (0, None):
+            args.setdefault("status", "stopped")  # dừng sớm có chủ đích (SKIP_OPENVPN_ANSIBLE=1), không phải lỗi
+        else:
+            args.setdefault("exit_code", e.code)
+        raise
+    except BaseException as e:
+        args.setdefault("error", f"{type(e).__name__}: {e}"[:200])
+        raise
+    finally:
+        _record_span(name, cat, start, time.monotonic() - t0, args)
+
+
+# --- Exec: mọi process con chạy trên một event loop asyncio (thread "exec"), không chặn thread nào trong lúc chờ ---
+# Thread gọi run_process() chỉ đợi kết quả; nhiều command độc lập chạy chồng lên nhau bằng run_concurrently().
+# cancel_processes() (step lỗi / Ctrl-C) dừng mọi command đang chạy như Ctrl-C trên terminal: SIGINT cho process
+# và cây process con của nó (terraform/helm dừng gọn, nhả state lock), quá DEPLOY_KILL_GRACE giây → SIGKILL.
+class Cancelled(Exception):
+    """Command bị dừng / không được chạy vì pipeline đang huỷ."""
+
+
+_exec_loop = None
+_exec_lock = threading.Lock()
+_exec_slots = None
+_exec_tasks = set()
+_CANCEL = threading.Event()
+# True trong lúc wait_until gọi probe (thread của step) → process của probe không chờ slot
+_PROBING = contextvars.ContextVar("deploy_probing", default=False)
+
+
+def _exec():
+    """Event loop của process con (thread daemon, tạo lần đầu cần)."""
+    global _exec_loop
+    with _exec_lock:
+        if _exec_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="exec", daemon=True).start()
+            _exec_loop = loop
+    return _exec_loop
+
+
+def _descendants(pid):
+    """PID mọi process con/cháu của pid (theo ps; sh -c, ansible... đều có cây riêng)."""
+    try:
+        out = subprocess.run(["ps", "-A", "-o", "pid=", "-o", "ppid="], capture_output=True, text=True,
+                             timeout=5).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    children = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            children.setdefault(int(parts[1]), []).append(int(parts[0]))
+    found, todo = [], [pid]
+    while todo:
+        for child in children.get(todo.pop(), ()):
+            found.append(child)
+            todo.append(child)
+    return found
+
+
+def _signal_all(pids, sig):
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+async def _stop(proc, sig, grace):
+    """Gửi sig cho proc và cây con của nó; sau grace giây process còn sống → SIGKILL."""
+    pids = [proc.pid] + _descendants(proc.pid)
+    _signal_all(pids, sig)
+    if sig != signal.SIGKILL:
+        try:
+            await asyncio.wait_for(proc.wait(), grace)
+        except asyncio.TimeoutError:
+            pass
+        _signal_all(pids + _descendants(proc.pid), signal.SIGKILL)
+    await proc.wait()
+
+
+async def _read_stream(stream, on_line=None):
+    """Đọc hết stream (từng khối, không giới hạn độ dài dòng); on_line nhận từng dòng ngay khi có."""
+    if stream is None:
+        return None
+    chunks, partial = [], b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if on_line:
+            *lines, partial = (partial + chunk).split(b"\n")
+            for line in lines:
+                on_line(line.decode(errors="replace"))
+    if on_line and partial:
+        on_line(partial.decode(errors="replace"))
+    return b"".join(chunks)
+
+
+async def _communicate(proc, input, on_line):
+    async def feed():
+        if input is None:
+            return
+        try:
+            proc.stdin.write(input)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        proc.stdin.close()
+    _, out, err = await asyncio.gather(feed(), _read_stream(proc.stdout, on_line), _read_stream(proc.stderr))
+    await proc.wait()
+    return out, err
+
+
+async def run_process_async(command, shell=False, cwd=None, env=None, input=None, stdin=None, stdout=None,
+                            stderr=None, capture_output=False, text=False, timeout=None, check=False, on_line=None,
+                            capped=None):
+    """Coroutine tương đương subprocess.run (các tham số file này dùng) → CompletedProcess.
+    command: list args (exec thẳng, không qua shell) hoặc string với shell=True (sh -c, cho pipe/&&).
+    on_line(str): nhận từng dòng stdout trong lúc chạy (stdout=PIPE / capture_output).
+    capped: chờ slot DEPLOY_MAX_PROCS (None = theo _capped(), tính ở thread gọi)."""
+    global _exec_slots
+    if _CANCEL.is_set():
+        raise Cancelled(f"pipeline cancelled, not starting: {command}")
+    if _exec_slots is None:
+        _exec_slots = asyncio.Semaphore(max(1, DEPLOY_MAX_PROCS))
+    if capture_output:
+        stdout = stderr = subprocess.PIPE
+    if text and isinstance(input, str):
+        input = input.encode()
+    argv = ["/bin/sh", "-c", command] if shell else [str(a) for a in command]
+    task = asyncio.current_task()
+    _exec_tasks.add(task)
+    try:
+        async with _exec_slots if (_capped(timeout) if capped is None else capped) else nullcontext():
+            proc = await asyncio.create_subprocess_exec(
+                *argv, cwd=cwd, env=env, stdin=subprocess.PIPE if input is not None else stdin,
+                stdout=stdout, stderr=stderr,
+            )
+            try:
+                out, err = await asyncio.wait_for(_communicate(proc, input, on_line), timeout)
+            except asyncio.TimeoutError:
+                await _stop(proc, signal.SIGKILL, 0)
+                raise subprocess.TimeoutExpired(command, timeout)
+            except asyncio.CancelledError:
+                await _stop(proc, signal.SIGINT, DEPLOY_KILL_GRACE)
+                raise
+    finally:
+        _exec_tasks.discard(task)
+    if text:
+        out = out.decode() if out is not None else None
+        err = err.decode() if err is not None else None
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, out, err)
+    return subprocess.CompletedProcess(command, proc.returncode, out, err)
+
+
+def _capped(timeout):
+    """Process có chiếm slot DEPLOY_MAX_PROCS không: probe của wait_until và command có timeout ngắn thì không
+    (tự kết thúc nhanh, chờ slot sau terraform/helm thì wait hết hạn trong khi probe chưa chạy lần nào)."""
+    return not (_PROBING.get() or (timeout is not None and timeout <= _SHORT_PROCESS))
+
+
+def _run_on_loop(coro):
+    """Chạy coroutine trên exec loop, đợi kết quả từ thread hiện tại."""
+    fut = asyncio.run_coroutine_threadsafe(coro, _exec())
+    try:
+        return fut.result()
+    except CancelledError:
+        raise Cancelled("pipeline cancelled") from None
+    except KeyboardInterrupt:
+        fut.cancel()
+        raise
+
+
+def cancel_processes():
+    """Dừng mọi command đang chạy và không chạy command mới tới khi resume_processes(); wait_until() / watch_until()
+    cũng dừng."""
+    _CANCEL.set()
+    if _exec_loop is not None:
+        _exec_loop.call_soon_threadsafe(lambda: [task.cancel() for task in list(_exec_tasks)])
+    _close_watches()
+
+
+def resume_processes():
+    _CANCEL.clear()
+
+
+@contextmanager
+def _process_span(command):
+    tool = _tool_of(command)
+    label = command if isinstance(command, str) else " ".join(map(str, command))
+    with span(label[:120], cat=tool, tool=tool) as args:
+        yield args
+
+
+def run_process(command, **kwargs):
+    """subprocess.run qua exec loop, có span (tool, exit code); dùng thay subprocess.run trong cả file."""
+    kwargs.setdefault("capped", _capped(kwargs.get("timeout")))  # ở thread gọi: exec loop không thấy _PROBING
+    with _process_span(command) as args:
+        res = _run_on_loop(run_process_async(command, **_default_output(kwargs)))
+        args["exit_code"] = res.returncode
+        return res
+
+
+def run_concurrently(*commands):
+    """Chạy nhiều command độc lập cùng lúc trên exec loop (không thêm thread); commands: (command, kwargs dict).
+    Trả về list theo thứ tự: CompletedProcess, hoặc exception của command đó (TimeoutExpired, OSError...)."""
+    env = current_env()
+    commands = [(command, _default_output(dict(kwargs, capped=kwargs.get("capped", _capped(kwargs.get("timeout"))))))
+                for command, kwargs in commands]
+
+    async def one(command, kwargs):
+        _CURRENT_ENV.set(env)  # task có context riêng (của exec loop): span ghi env của thread gọi
+        try:
+            with _process_span(command) as args:
+                res = await run_process_async(command, **kwargs)
+                args["exit_code"] = res.returncode
+                return res
+        except (subprocess.SubprocessError, OSError) as e:
+            return e
+
+    async def gather():
+        return await asyncio.gather(*(one(command, kwargs) for command, kwargs in commands))
+    return _run_on_loop(gather())
+
+
+def _write_trace():
+    """Ghi span của run thành Chrome trace (mỗi env một "process": pid giả theo env) + bảng timing."""
+    _record_history()
+    with _spans_lock:
+        events = [dict(e) for e in SPANS]
+    if not events:
+        return
+    pids = {}
+    for e in events:
+        e["pid"] = pids.setdefault(e["args"]["env"], os.getpid() * 10 + len(pids))
+    meta = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"deploy.py {env}"}}
+            for env, pid in pids.items()]
+    os.makedirs(_STATE_DIR, exist_ok=True)
+    trace_path = os.path.join(_STATE_DIR, f"trace-{_TRACE_RUN}.json")
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+    latest = os.path.join(_STATE_DIR, "trace-latest.json")
+    if os.path.lexists(latest):
+        os.unlink(latest)
+    os.symlink(os.path.basename(trace_path), latest)
+    _print_timing_summary(events, trace_path)
+
+
+def _print_timing_summary(events, trace_path):
+    """Bảng step (wall time) + tổng theo tool, từ span đã gộp."""
+    steps = sorted((e for e in events if e["cat"] == "step"), key=lambda e: -e["dur"])
+    if not steps:
+        return
+    print("\n--- Timing summary ---")
+    print(f"  {'step':<32} {'env':<11} {'wall':>8}  status")
+    for e in steps[:25]:
+        status = e["args"].get("status") or ("exit %s" % e["args"]["exit_code"] if "exit_code" in e["args"] else
+                                             e["args"]["error"].split(":")[0] if "error" in e["args"] else "ok")
+        print(f"  {e['name'][:32]:<32} {e['args'].get('env', ''):<11} {e['dur'] / 1e6:>7.1f}s  {status}")
+    tools = {}
+    for e in events:
+        if e["cat"] not in ("step", "wait"):
+            t = tools.setdefault(e["cat"], [0, 0.0, 0])
+            t[0] += 1
+            t[1] += e["dur"] / 1e6
+            t[2] += e["args"].get("exit_code") not in (0, None)
+    waits = [e for e in events if e["cat"] == "wait"]
+    if waits:
+        tools["(waits)"] = [len(waits), sum(e["dur"] for e in waits) / 1e6, sum(not e["args"].get("ok") for e in waits)]
+    print(f"\n  {'tool':<12} {'calls':>6} {'total':>9} {'failed':>7}")
+    for tool, (calls, total, failed) in sorted(tools.items(), key=lambda kv: -kv[1][1]):
+        print(f"  {tool:<12} {calls:>6} {total:>8.1f}s {failed:>7}")
+    print(f"\n  Trace: {os.path.relpath(trace_path, _SCRIPT_DIR)} (mở bằng chrome://tracing hoặc ui.perfetto.dev)")
+
+
+# --- Run history: step / wait của mọi lần chạy → SQLite (.deploy/history.db), xem bằng `deploy.py stats` ---
+# Ghi lúc thoát (cùng lúc _write_trace), mỗi step / wait kèm env của nó. Dùng để chỉnh timeout / poll interval theo số liệu và thấy bootstrap cluster chậm dần.
+_HISTORY_DB = os.path.join(_STATE_DIR, "history.db")
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (run TEXT, pid INTEGER, env TEXT, argv TEXT, started REAL, duration REAL,
+                                 outcome TEXT, PRIMARY KEY (run, pid));
+CREATE TABLE IF NOT EXISTS steps (run TEXT, env TEXT, name TEXT, started REAL, duration REAL, slept REAL,
+                                  outcome TEXT, detail TEXT);
+CREATE TABLE IF NOT EXISTS waits (run TEXT, env TEXT, step TEXT, name TEXT, started REAL, duration REAL,
+                                  attempts INTEGER, slept REAL, time_limit REAL, outcome TEXT);
+CREATE INDEX IF NOT EXISTS steps_by_name ON steps (env, name, started);
+CREATE INDEX IF NOT EXISTS waits_by_name ON waits (env, name, started);
+"""
+
+
+def _history_db():
+    os.makedirs(_STATE_DIR, exist_ok=True)
+    db = sqlite3.connect(_HISTORY_DB, timeout=30)
+    db.executescript(_HISTORY_SCHEMA)
+    return db
+
+
+def _step_outcome(args):
+    """(outcome, detail) của span step: ok / skipped / stopped (sys.exit(0)) / failed (exit code hoặc lỗi)."""
+    if args.get("status") in ("skipped", "stopped"):
+        return args["status"], None
+    if "exit_code" in args:
+        return "failed", f"exit {args['exit_code']}"
+    if "error" in args:
+        return "failed", args["error"]
+    return "ok", None
+
+
+def _record_history():
+    """Ghi step + wait của run vào history.db (lỗi SQLite chỉ cảnh báo, không làm hỏng run)."""
+    with _spans_lock:
+        events = [e for e in SPANS if e["cat"] in ("step", "wait")]
+    if not events:
+        return
+    steps = [e for e in events if e["cat"] == "step"]
+
+    def enclosing_step(wait):
+        # wait chạy trong thread của step bao nó
+        return next((s for s in steps if s["tid"] == wait["tid"] and s["ts"] <= wait["ts"] <= s["ts"] + s["dur"]), None)
+
+    slept, wait_rows = {}, []
+    for e in events:
+        if e["cat"] != "wait":
+            continue
+        step = enclosing_step(e)
+        if step is not None:
+            slept[id(step)] = slept.get(id(step), 0.0) + e["args"].get("slept", 0.0)
+        wait_rows.append((_TRACE_RUN, e["args"]["env"], step["name"] if step else None, e["name"], e["ts"] / 1e6,
+                          e["dur"] / 1e6, e["args"].get("attempts"), e["args"].get("slept"), e["args"].get("limit"),
+                          e["args"].get("outcome") or ("ok" if e["args"].get("ok") else "timeout")))
+    step_rows = [(_TRACE_RUN, e["args"]["env"], e["name"], e["ts"] / 1e6, e["dur"] / 1e6, round(slept.get(id(e), 0.0), 1),
+                  *_step_outcome(e["args"])) for e in steps]
+    outcome = "failed" if any(row[6] == "failed" for row in step_rows) else "ok"
+    try:
+        with closing(_history_db()) as db, db:
+            db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (_TRACE_RUN, os.getpid(), current_env().env, shlex.join(sys.argv[1:]), _PROCESS_STARTED,
+                        time.time() - _PROCESS_STARTED, outcome))
+            db.executemany("INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", step_rows)
+            db.executemany("INSERT INTO waits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", wait_rows)
+    except sqlite3.Error as e:
+        print(f"  ⚠ Run history not recorded ({_HISTORY_DB}): {e}")
+
+
+def _fmt_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(round(seconds))
+    return f"{seconds // 60}m{seconds % 60:02d}s" if seconds >= 60 else f"{seconds}s"
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile của list đã sort."""
+    return values[max(1, -(-pct * len(values) // 100)) - 1] if values else None
+
 
-def run_command(command, cwd=None, env=None, timeout=None):
-    """Runs a shell command and exits if it fails (non-interactive)."""
-    print(f"Running: {command}")
+def _sparkline(values):
+    bars = "▁▂▃▄▅▆▇█"
+    lo, hi = min(values), max(values)
+    return "".join(bars[int((v - lo) / (hi - lo) * (len(bars) - 1)) if hi > lo else 0] for v in values)
+
+
+def _trend(durations):
+    """% thay đổi: median 5 lần gần nhất so với median các lần trước đó (durations theo thời gian tăng dần)."""
+    if len(durations) < 6:
+        return ""
+    recent, before = sorted(durations[-5:]), sorted(durations[:-5][-20:])
+    base = before[len(before) // 2]
+    return f"{(recent[2] - base) / base * 100:+.0f}%" if base > 0 else ""
+
+
+def stats_command(args):
+    """deploy.py stats [env]: p50/p95 + xu hướng theo step và theo wait, từ history.db."""
+    env_filter = args[0] if args else None
+    if not os.path.isfile(_HISTORY_DB):
+        print(f"Chưa có lịch sử ({os.path.relpath(_HISTORY_DB, _SCRIPT_DIR)}): chạy deploy ít nhất một lần.")
+        return
+    with closing(_history_db()) as db:
+        where, params = ("WHERE env = ?", (env_filter,)) if env_filter else ("", ())
+        # Full pipeline ghi một dòng runs (env 'all') cho mọi env chạy trong process → lọc theo env thì đếm run từ steps
+        runs = db.execute(f"SELECT COUNT(DISTINCT run), MIN(started), MAX(started) FROM {'steps' if env_filter else 'runs'} "
+                          f"{where}", params).fetchone()
+        steps = db.execute(f"SELECT env, name, duration, slept, outcome FROM steps {where} ORDER BY started", params).fetchall()
+        waits = db.execute(f"SELECT env, name, duration, attempts, slept, time_limit, outcome FROM waits {where} "
+                           "ORDER BY started", params).fetchall()
+    if not runs[0]:
+        print("Chưa có lịch sử" + (f" cho env {env_filter}." if env_filter else "."))
+        return
+    first, last = (time.strftime("%Y-%m-%d", time.localtime(ts)) for ts in runs[1:])
+    print(f"--- Run history: {runs[0]} run(s), {first} → {last} ---")
+
+    by_step = {}
+    for env, name, duration, step_slept, outcome in steps:
+        by_step.setdefault((env, name), []).append((duration, step_slept or 0.0, outcome))
+    print("\n  Steps (thời gian của các lần chạy xong; trend = median 5 lần gần nhất so với trước đó)")
+    print(f"  {'env':<11} {'step':<28} {'runs':>5} {'fail':>5} {'p50':>7} {'p95':>7} {'last':>7} {'sleep':>6} "
+          f"{'trend':>6}  recent")
+    for (env, name), rows in sorted(by_step.items()):
+        ok = [d for d, _, outcome in rows if outcome == "ok"]
+        failed = sum(outcome == "failed" for _, _, outcome in rows)
+        if not ok:
+            print(f"  {env:<11} {name[:28]:<28} {len(rows):>5} {failed:>5} {'-':>7}")
+            continue
+        values = sorted(ok)
+        sleep_share = sum(sl for d, sl, outcome in rows if outcome == "ok") / max(sum(ok), 1e-9)
+        print(f"  {env:<11} {name[:28]:<28} {len(rows):>5} {failed:>5} {_fmt_duration(_percentile(values, 50)):>7} "
+              f"{_fmt_duration(_percentile(values, 95)):>7} {_fmt_duration(ok[-1]):>7} {sleep_share:>6.0%} "
+              f"{_trend(ok):>6}  {_sparkline(ok[-12:])}")
+
+    by_wait = {}
+    for env, name, duration, attempts, wait_slept, limit, outcome in waits:
+        by_wait.setdefault((env, name), []).append((duration, attempts or 0, wait_slept or 0.0, limit, outcome))
+    if by_wait:
+        print("\n  Waits (limit = timeout đang dùng; p95 sát limit hoặc có timeout → cân nhắc chỉnh)")
+        print(f"  {'env':<11} {'wait':<34} {'n':>4} {'t/o':>4} {'p50':>7} {'p95':>7} {'max':>7} {'limit':>7} "
+              f"{'probes':>6} {'sleep':>6}")
+        for (env, name), rows in sorted(by_wait.items()):
+            durations = sorted(d for d, *_ in rows)
+            timeouts = sum(outcome == "timeout" for *_, outcome in rows)
+            limit = max((lim for *_, lim, _ in rows if lim is not None), default=None)
+            probes = sorted(a for _, a, *_ in rows)
+            sleep_share = sum(sl for _, _, sl, *_ in rows) / max(sum(durations), 1e-9)
+            print(f"  {env:<11} {name[:34]:<34} {len(rows):>4} {timeouts:>4} {_fmt_duration(_percentile(durations, 50)):>7} "
+                  f"{_fmt_duration(_percentile(durations, 95)):>7} {_fmt_duration(durations[-1]):>7} "
+                  f"{_fmt_duration(limit):>7} {_percentile(probes, 50):>6} {sleep_share:>6.0%}")
+
+
+def run_command(command, cwd=None, env=None, timeout=None, log_file=None, ok_codes=(0,)):
+    """Runs a shell command and exits if it fails (non-interactive).
+    log_file: append stdout/stderr to this file instead of the terminal (used when envs run in parallel).
+    ok_codes: exit code coi là thành công (vd. plan -detailed-exitcode: 0, 2). Trả về exit code."""
+    print(f"Running: {command}" + (f" (log: {log_file})" if log_file else ""))
     try:
-        subprocess.run(command, shell=True, cwd=cwd, env=env, check=True, timeout=timeout)
+        if log_file:
+            with open(log_file, "a") as f:
+                res = run_process(command, shell=True, cwd=cwd, env=env, timeout=timeout,
+                                  stdout=f, stderr=subprocess.STDOUT)
+        else:
+            res = run_process(command, shell=True, cwd=cwd, env=env, timeout=timeout)
+        if res.returncode not in ok_codes:
+            raise subprocess.CalledProcessError(res.returncode, command)
+        return res.returncode
     except subprocess.CalledProcessError:
         print(f"Error running command: {command}")
+        if log_file:
+            _print_log_tail(log_file)
         sys.exit(1)
     except subprocess.TimeoutExpired:
         print(f"Command timed out: {command}")
+        if log_file:
+            _print_log_tail(log_file)
+        sys.exit(1)
+
+
+def _print_log_tail(log_file, lines=25):
+    """In n dòng cuối của log file (chẩn đoán khi lỗi)."""
+    if not os.path.isfile(log_file):
+        print("  Log not found: %s" % log_file)
+        return
+    with open(log_file, "r", errors="replace") as f:
+        tail = f.readlines()[-lines:]
+    print("  Log (%s) last %d lines:" % (log_file, len(tail)))
+    for line in tail:
+        print("    " + line.rstrip())
+
+
+# --- Polling: một primitive wait_until() cho mọi vòng chờ (probe nhanh lúc đầu, backoff + jitter, deadline) ---
+class NotReady(Exception):
+    """Raised by a wait_until() probe when the condition does not hold yet; the message is shown in progress logs."""
+
+
+class Deadline:
+    """Overall time budget shared by several waits (time.monotonic based)."""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+
+class BudgetExhausted(Exception):
+    """Ngân sách chờ chung (deadline= / DEPLOY_WAIT_BUDGET) hết trước khi điều kiện của wait đúng."""
+
+
+class WaitResult(namedtuple("WaitResult", ["ok", "value", "waited", "attempts", "detail"])):
+    """Outcome of wait_until(); truthy only when the condition was met."""
+
+    def __bool__(self):
+        return self.ok
+
+
+# DEPLOY_WAIT_BUDGET của run: main() tạo lúc bắt đầu deploy (không phải lúc import)
+_RUN_DEADLINE = None
+# Metrics của mọi wait trong process: what, ok, waited, attempts, slept (in tổng kết cuối run)
+WAIT_METRICS = []
+_wait_metrics_lock = threading.Lock()
+
+
+def wait_until(probe, what, timeout=300, interval=1.0, max_interval=15.0, backoff=1.6, jitter=0.2,
+               deadline=None, progress_every=30, quiet=False):
+    """Gọi probe() tới khi trả về giá trị truthy hoặc hết thời gian.
+    Lần đầu probe ngay, sau đó interval tăng dần (x backoff, tối đa max_interval, ± jitter) → resource
+    sẵn sàng nhanh được phát hiện trong ~1s, resource chậm không bị hỏi dồn dập.
+    probe raise NotReady/TimeoutExpired/OSError/KubeError = chưa đạt. Hết timeout riêng → WaitResult falsy (caller
+    quyết định); deadline (Deadline) / _RUN_DEADLINE hết trước → BudgetExhausted; pipeline bị huỷ → Cancelled ngay
+    (step không bị coi là xong)."""
+    start = time.monotonic()
+    limit = timeout
+    for budget in (deadline, _RUN_DEADLINE):
+        if budget is not None:
+            limit = min(limit, budget.remaining())
+    attempts, slept, detail, value = 0, 0.0, "", None
+    next_progress = progress_every
+    delay = interval
+    while True:
+        attempts += 1
+        probing = _PROBING.set(True)
+        try:
+            value = probe()
+            if value:
+                break
+            detail = ""
+        except NotReady as e:
+            detail = str(e)
+        except (subprocess.TimeoutExpired, OSError, KubeError, http.client.HTTPException) as e:
+            detail = f"{type(e).__name__}: {e}"
+        finally:
+            _PROBING.reset(probing)
+        elapsed = time.monotonic() - start
+        if elapsed >= limit:
+            value = None
+            break
+        if not quiet and elapsed >= next_progress:
+            print(f"  Still waiting for {what}... ({elapsed:.0f}s" + (f": {detail[:150]}" if detail else "") + ")")
+            next_progress += progress_every
+        pause = max(0.0, min(delay * random.uniform(1 - jitter, 1 + jitter), limit - elapsed))
+        # Pipeline huỷ (cancel_processes) → thôi chờ ngay
+        if _CANCEL.wait(pause):
+            value, detail = None, "cancelled"
+            break
+        slept += pause
+        delay = min(delay * backoff, max_interval)
+    result = WaitResult(bool(value), value, time.monotonic() - start, attempts, detail)
+    _record_wait(what, result, slept, limit)
+    _raise_if_aborted(what, result, limit < timeout)
+    return result
+
+
+def _raise_if_aborted(what, result, budget_bound):
+    """Wait dừng vì pipeline huỷ hoặc hết ngân sách chung → raise (timeout riêng của wait vẫn trả về WaitResult)."""
+    if result.ok:
+        return
+    if result.detail == "cancelled":
+        raise Cancelled(f"pipeline cancelled while waiting for {what}")
+    if budget_bound:
+        raise BudgetExhausted(f"wait budget exhausted after {result.waited:.0f}s waiting for {what}"
+                              + (f" ({result.detail[:150]})" if result.detail else ""))
+
+
+def _record_wait(what, result, slept, limit):
+    outcome = "ok" if result.ok else "cancelled" if result.detail == "cancelled" else "timeout"
+    _record_span(what, "wait", time.time() - result.waited, result.waited,
+                 {"ok": result.ok, "outcome": outcome, "attempts": result.attempts, "slept": round(slept, 1),
+                  "limit": round(limit, 1)})
+    with _wait_metrics_lock:
+        WAIT_METRICS.append({"env": current_env().env, "what": what, "ok": result.ok, "waited": round(result.waited, 1),
+                             "attempts": result.attempts, "slept": round(slept, 1)})
+
+
+def _print_wait_summary(env=None):
+    """Bảng tổng kết các wait trong run (thời gian chờ, số lần probe); env → chỉ wait của env đó."""
+    metrics = [m for m in WAIT_METRICS if env is None or m["env"] == env]
+    if not metrics:
+        return
+    print("\n--- Wait summary ---")
+    print(f"  {'wait':<45} {'result':<8} {'waited':>8} {'probes':>7} {'slept':>7}")
+    for m in metrics:
+        print(f"  {m['what'][:45]:<45} {'ok' if m['ok'] else 'TIMEOUT':<8} {m['waited']:>7.1f}s {m['attempts']:>7} {m['slept']:>6.1f}s")
+
+
+# --- SSH: một master connection (ControlMaster) mỗi host; mọi ssh/scp/port forward tới host đi qua nó ---
+# Thư mục cố định → lần chạy sau (và ssh/ansible ngoài deploy.py) dùng lại được master đang sống
+_SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(), f"deploy-ssh-{os.getuid()}")
+_SSH_OPTS = ["-o", "IdentitiesOnly=yes", "-o", "StrictHostKeyChecking=no"]
+# Master vừa kiểm tra / mở trong vòng N giây thì không `ssh -O check` lại (master chết giữa chừng:
+# client ControlMaster=no tự kết nối thẳng, không lỗi)
+_SSH_CHECK_TTL = 30
+_ssh_sessions = {}
+_ssh_sessions_lock = threading.Lock()
+
+
+def _ensure_ssh_control_dir():
+    """Tạo _SSH_CONTROL_DIR (0700). Path đoán trước được trong /tmp → thư mục có sẵn phải đúng là của user này và
+    0700, không thì user khác có thể cài / chiếm control socket mà mọi ssh/scp dùng lại → RuntimeError (không phải
+    OSError: wait_until coi OSError là lỗi tạm và thử lại)."""
+    os.makedirs(_SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    st = os.lstat(_SSH_CONTROL_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise RuntimeError(f"refusing to use {_SSH_CONTROL_DIR} for SSH control sockets: must be a directory owned by "
+                      f"uid {os.getuid()} with mode 0700 (found uid {st.st_uid}, mode {oct(stat.S_IMODE(st.st_mode))})")
+
+
+class SSHSession:
+    """Persistent SSH master connection to one host, optionally opened through a jump session.
+    Commands, scp and port forwards are multiplexed over its control socket instead of new handshakes."""
+
+    def __init__(self, host, key_path, jump=None, user="ubuntu"):
+        self.host = host
+        self.key_path = key_path
+        self.jump = jump
+        self.target = f"{user}@{host}"
+        self.control_path = os.path.join(_SSH_CONTROL_DIR, self.target)
+        self.owned = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _opts(self, connect_timeout=10, master=False):
+        opts = ["-i", self.key_path, *_SSH_OPTS, "-o", f"ConnectTimeout={connect_timeout}",
+                "-o", f"ControlPath={self.control_path}"]
+        if master:
+            opts += ["-o", "ControlMaster=yes", "-o", "ControlPersist=yes", "-o", "ServerAliveInterval=30"]
+        else:
+            # Client thuần: không có master (chưa mở được) thì ssh tự kết nối trực tiếp
+            opts += ["-o", "ControlMaster=no"]
+        if self.jump is not None:
+            proxy = ["ssh", *self.jump._opts(connect_timeout), "-W", "%h:%p", self.jump.target]
+            opts += ["-o", "ProxyCommand=" + shlex.join(proxy)]
+        return opts
+
+    def ssh_args(self, connect_timeout=10):
+        return ["ssh", *self._opts(connect_timeout)]
+
+    def is_alive(self):
+        try:
+            r = run_process(self.ssh_args() + ["-O", "check", self.target], capture_output=True, timeout=10)
+            return r.returncode == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def ensure_master(self, connect_timeout=10):
+        """Mở master connection nếu chưa có (process khác mở rồi thì dùng lại). True nếu socket dùng được."""
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < _SSH_CHECK_TTL:
+                return True
+            _ensure_ssh_control_dir()
+            # flock: dev/prod chạy song song không cùng lúc mở 2 master cho một host
+            with open(self.control_path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if self.is_alive():
+                    self._checked_at = time.monotonic()
+                    return True
+                if self.jump is not None and not self.jump.ensure_master(connect_timeout):
+                    return False
+                if os.path.exists(self.control_path):
+                    os.unlink(self.control_path)  # socket chết từ lần chạy trước
+                if os.path.exists(self.control_path + ".forwards"):
+                    os.unlink(self.control_path + ".forwards")
+                # -f: master chạy nền sau khi auth; stdout/stderr không được là pipe (process nền giữ pipe mở)
+                with open(self.control_path + ".log", "w") as log:
+                    try:
+                        r = run_process(
+                            ["ssh", *self._opts(connect_timeout, master=True), "-f", "-N", self.target],
+                            stdin=subprocess.DEVNULL, stdout=log, stderr=log, timeout=connect_timeout + 20,
+                        )
+                    except subprocess.TimeoutExpired:
+                        return False
+                if r.returncode != 0:
+                    return False
+                self.owned = True
+                self._checked_at = time.monotonic()
+                return True
+
+    def run(self, remote_cmd, connect_timeout=10, **kwargs):
+        """subprocess.run của remote_cmd trên host (qua master). Master không mở được → trả về rc=255."""
+        args = self.ssh_args(connect_timeout) + [self.target, remote_cmd]
+        if not self.ensure_master(connect_timeout):
+            err = b"ssh master connection failed"
+            if os.path.isfile(self.control_path + ".log"):
+                with open(self.control_path + ".log", "rb") as f:
+                    err = f.read() or err
+            if kwargs.get("check"):
+                raise subprocess.CalledProcessError(255, args, b"", err)
+            if kwargs.get("text"):
+                err = err.decode(errors="replace")
+            return subprocess.CompletedProcess(args, 255, err[:0], err)
+        return run_process(args, **kwargs)
+
+    def command(self, remote_cmd):
+        """Shell command string (cho run_command) chạy remote_cmd qua master."""
+        self.ensure_master()
+        return shlex.join(self.ssh_args() + [self.target, remote_cmd])
+
+    def scp_command(self, local_path, remote_path):
+        self.ensure_master()
+        return shlex.join(["scp", *self._opts(), local_path, f"{self.target}:{remote_path}"])
+
+    def _forward_spec(self, local_port, dest_host, dest_port):
+        return f"127.0.0.1:{local_port}:{dest_host}:{dest_port}"
+
+    def forward_argv(self, dest_host, dest_port):
+        """`ssh -N -L` cho tunnel manager ("{port}" = port local): connection riêng, không qua master (master đóng
+        lúc deploy xong không kéo tunnel theo), tự thoát khi mất kết nối để daemon chạy lại."""
+        argv = ["ssh", "-i", self.key_path, *_SSH_OPTS, "-o", "ControlPath=none", "-o", "ConnectTimeout=10",
+                "-o", "ExitOnForwardFailure=yes", "-o", "ServerAliveInterval=15", "-o", "ServerAliveCountMax=3"]
+        if self.jump is not None:
+            proxy = ["ssh", "-i", self.jump.key_path, *_SSH_OPTS, "-o", "ControlPath=none", "-W", "%h:%p", self.jump.target]
+            argv += ["-o", "ProxyCommand=" + shlex.join(proxy)]
+        return argv + ["-N", "-L", f"127.0.0.1:{{port}}:{dest_host}:{dest_port}", self.target]
+
+    def cancel_forward(self, local_port, dest_host, dest_port):
+        """Bỏ forward kiểu cũ (ssh -O forward trên master, trước khi có tunnel manager) nếu master còn giữ."""
+        spec = self._forward_spec(local_port, dest_host, dest_port)
+        path = self.control_path + ".forwards"
+        if not os.path.isfile(path):
+            return
+        with open(path) as f:
+            recorded = [line for line in f.read().splitlines() if line]
+        if spec not in recorded:
+            return
+        run_process(self.ssh_args() + ["-O", "cancel", "-L", spec, self.target], capture_output=True, timeout=10)
+        left = [line for line in recorded if line != spec]
+        if left:
+            with open(path, "w") as f:
+                f.write("\n".join(left) + "\n")
+        else:
+            os.unlink(path)
+
+    def close(self):
+        """Đóng master nếu process này mở nó và không còn port forward nào đi qua."""
+        if not self.owned or os.path.exists(self.control_path + ".forwards"):
+            return
+        try:
+            run_process(self.ssh_args() + ["-O", "exit", self.target], capture_output=True, timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+        self.owned = False
+        self._checked_at = None
+
+
+def ssh_session(host, key_path, jump=None):
+    """SSHSession dùng chung cho (host, key, jump) trong process."""
+    key = (host, os.path.abspath(key_path), jump.target if jump else None)
+    with _ssh_sessions_lock:
+        if key not in _ssh_sessions:
+            _ssh_sessions[key] = SSHSession(host, os.path.abspath(key_path), jump=jump)
+        return _ssh_sessions[key]
+
+
+def _ssh_ready_probe(session, connect_timeout=10, command="echo ready"):
+    """Probe cho wait_until: host nhận SSH và command chạy được → stdout của command (ít nhất "\n")."""
+    def probe():
+        res = session.run(command, connect_timeout=connect_timeout, capture_output=True, timeout=connect_timeout + 5)
+        if res.returncode != 0:
+            lines = (res.stderr or b"").decode(errors="replace").strip().splitlines()
+            raise NotReady(lines[-1] if lines else f"ssh rc={res.returncode}")
+        return (res.stdout or b"").decode(errors="replace") or "\n"
+    return probe
+
+
+RemoteResult = namedtuple("RemoteResult", "name returncode stdout stderr")
+
+
+def _remote_path(path):
+    """Quote path cho shell remote, giữ ~/ (→ "$HOME"/...)."""
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+class RemoteScript:
+    """Gom các lệnh remote của một step thành một script bash, chạy bằng một ssh exec (`bash -s`, qua master
+    của session, có jump thì qua jump). Mỗi lệnh chạy riêng (stdin /dev/null), kết quả trả về theo tên:
+    RemoteResult(rc, stdout, stderr) dạng bytes — kể cả nội dung file (fetch) và upload file (put)."""
+
+    MARK = "@@deploy-py"
+    _EOF = "__DEPLOY_PY_CMD__"
+    _PRELUDE = (
+        "__run() {\n"
+        '  __out=$(mktemp) __err=$(mktemp)\n'
+        '  bash -c "$(cat)" </dev/null >"$__out" 2>"$__err"; __rc=$?\n'
+        # base64 một dòng: output nhiều dòng / binary không phá format; ':' giữ field khi output rỗng
+        '  printf \'%s %s %d :%s :%s\\n\' "' + MARK + '" "$1" "$__rc" "$(base64 -w0 <"$__out")" "$(base64 -w0 <"$__err")"\n'
+        '  rm -f "$__out" "$__err"; return $__rc\n'
+        "}\n"
+    )
+
+    def __init__(self, session):
+        self.session = session
+        self.names = []
+        self._blocks = []
+
+    def add(self, name, cmd, stop_on_error=False):
+        """Thêm lệnh shell. stop_on_error: lệnh lỗi thì các lệnh sau không chạy (không có trong kết quả)."""
+        if name in self.names or not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"bad or duplicate remote command name: {name!r}")
+        self.names.append(name)
+        self._blocks.append(f"__run {name} <<'{self._EOF}'{' || exit 1' if stop_on_error else ''}\n{cmd}\n{self._EOF}\n")
+        return self
+
+    def put(self, name, local_path, remote_path, mode=0o600):
+        """Upload file local (nhúng base64 trong script, không cần scp riêng); tạo thư mục cha (0700) nếu chưa có."""
+        with open(local_path, "rb") as f:
+            data = base64.encodebytes(f.read()).decode()
+        target = _remote_path(remote_path)
+        return self.add(name, (
+            f'umask 077 && mkdir -p "$(dirname {target})" && base64 -d > {target} <<\'__DEPLOY_PY_DATA__\'\n'
+            f"{data}__DEPLOY_PY_DATA__\nchmod {mode:o} {target}"
+        ), stop_on_error=True)
+
+    def fetch(self, name, remote_path, sudo=False):
+        """Đọc file remote: nội dung ở stdout của kết quả."""
+        return self.add(name, ("sudo " if sudo else "") + "cat " + _remote_path(remote_path))
+
+    def script(self):
+        return self._PRELUDE + "".join(self._blocks) + "exit 0\n"
+
+    def run(self, timeout=60, connect_timeout=10, check=False):
+        """Chạy script, trả về {name: RemoteResult}. ssh không chạy được (không có kết quả nào) →
+        CalledProcessError(rc ssh). check=True: lệnh lỗi hoặc không chạy tới cũng raise CalledProcessError."""
+        res = self.session.run("bash -s", connect_timeout=connect_timeout, input=self.script().encode(),
+                               capture_output=True, timeout=timeout)
+        results = {}
+        for line in (res.stdout or b"").decode(errors="replace").splitlines():
+            parts = line.split(" ")
+            if len(parts) == 5 and parts[0] == self.MARK and parts[1] in self.names:
+                results[parts[1]] = RemoteResult(parts[1], int(parts[2]), base64.b64decode(parts[3][1:]),
+                                                 base64.b64decode(parts[4][1:]))
+        if not results and self.names and res.returncode != 0:
+            raise subprocess.CalledProcessError(res.returncode, f"ssh {self.session.target} bash -s", res.stdout, res.stderr)
+        if check:
+            for name in self.names:
+                r = results.get(name)
+                if r is None or r.returncode != 0:
+                    raise subprocess.CalledProcessError(r.returncode if r else -1, f"{self.session.target}: {name}",
+                                                        r.stdout if r else b"", r.stderr if r else b"not run")
+        return results
+
+
+@atexit.register
+def _close_ssh_sessions():
+    # Đóng host sau jump trước, jump sau cùng
+    for session in sorted(_ssh_sessions.values(), key=lambda s: s.jump is None):
+        session.close()
+
+
+# --- Tunnel manager: daemon `deploy.py tunnels serve` giữ một forward lâu dài cho mỗi cluster ---
+# Mỗi tunnel là một process (ssh -N -L qua OpenVPN, kubectl port-forward) do daemon chạy và giám sát: health-check
+# (API: GET /readyz qua tunnel; còn lại: TCP connect), process chết / fail liên tiếp → chạy lại với backoff.
+# Port local: port ưa thích nếu trống, không thì port trống bất kỳ. Daemon sống qua nhiều lần deploy; các lần sau
+# hỏi qua Unix socket và attach ngay vào tunnel đang chạy.
+# Client chỉ gửi (loại tunnel, env); argv / port / probe do daemon tự dựng từ Terraform output (_tunnel_spec) →
+# ai gửi được request cũng không chạy được command tuỳ ý.
+_TUNNEL_DIR = os.path.join(_STATE_DIR, "tunnels")
+_TUNNEL_STATE = os.path.join(_STATE_DIR, "tunnels.json")
+_TUNNEL_LOG = os.path.join(_STATE_DIR, "tunnels.log")
+# Socket 0600 trong .deploy/ (chỉ owner checkout ghi được); path Unix socket giới hạn ~104 ký tự → checkout nằm quá
+# sâu thì dùng $XDG_RUNTIME_DIR (0700, riêng user), tên theo checkout
+_TUNNEL_SOCKET = os.path.join(_STATE_DIR, "tunnels.sock")
+if len(_TUNNEL_SOCKET.encode()) > 100 and os.environ.get("XDG_RUNTIME_DIR"):
+    _TUNNEL_SOCKET = os.path.join(
+        os.environ["XDG_RUNTIME_DIR"], "deploy-tunnels-%s.sock" % hashlib.sha256(_STATE_DIR.encode()).hexdigest()[:12]
+    )
+_TUNNEL_KINDS = ("api", "rancher")
+_TUNNEL_CHECK_EVERY = 10
+_TUNNEL_MAX_FAILS = 3
+_TUNNEL_START_GRACE = 30
+
+
+def _free_port(preferred=None):
+    """preferred nếu bind được, không thì port trống do kernel cấp."""
+    for port in ([preferred] if preferred else []) + [0]:
+        with socket.socket() as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return s.getsockname()[1]
+
+
+def _tunnel_healthy(port, probe):
+    """readyz: API server trả lời HTTP qua tunnel (mã nào cũng được); tcp: port local nhận kết nối."""
+    try:
+        if probe == "readyz":
+            conn = http.client.HTTPSConnection("127.0.0.1", port, timeout=5, context=ssl._create_unverified_context())
+            try:
+                conn.request("GET", "/readyz")
+                conn.getresponse().read()
+            finally:
+                conn.close()
+        else:
+            socket.create_connection(("127.0.0.1", port), timeout=3).close()
+        return True
+    except (OSError, http.client.HTTPException):
+        return False
+
+
+def _tunnel_socket_exists():
+    """True nếu _TUNNEL_SOCKET là socket của user này, False nếu chưa có. File khác / của user khác → OSError:
+    không kết nối (process lạ giả làm tunnel manager), không xoá."""
+    try:
+        st = os.lstat(_TUNNEL_SOCKET)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(f"refusing to use {_TUNNEL_SOCKET}: not a socket owned by uid {os.getuid()}")
+    return True
+
+
+def _tunnel_spec(kind, env):
+    """Spec của tunnel `<env>-<kind>`, dựng trong daemon: api = `ssh -N -L` qua jump Management tới master:6443
+    (Terraform output của env), rancher = `kubectl port-forward svc/rancher` bằng kubeconfig tunnel của env.
+    spec: name, argv ("{port}" = port local), port (ưa thích), probe, environ."""
+    if kind not in _TUNNEL_KINDS or env not in LOCAL_PORT_BY_ENV:
+        raise ValueError(f"unknown tunnel {kind!r} for env {env!r}")
+    ctx = EnvContext(env)
+    spec = {"name": f"{env}-{kind}", "kind": kind, "env": env}
+    if kind == "rancher":
+        kubeconfig = ctx.tunnel_kubeconfig_path if os.path.isfile(ctx.tunnel_kubeconfig_path) else ctx.kubeconfig_file
+        return dict(spec, argv=["kubectl", "port-forward", "-n", "cattle-system", "svc/rancher", "{port}:443"],
+                    port=8443, probe="tcp", environ={"KUBECONFIG": os.path.abspath(kubeconfig)})
+    try:
+        _apply_outputs(ctx, terraform_outputs(env))
+    except (KeyError, IndexError, TypeError, subprocess.CalledProcessError) as e:
+        raise ValueError(f"{env}: no master / jump host in Terraform output ({type(e).__name__}: {e})")
+    if not ctx.openvpn_public_ip:
+        raise ValueError(f"{env}: no jump host (management OpenVPN output)")
+    jump = ssh_session(ctx.openvpn_public_ip, ctx.jump_key_path or ctx.ssh_key_path)
+    return dict(spec, argv=jump.forward_argv(ctx.master_private_ip, 6443), port=ctx.local_port, probe="readyz",
+                environ={})
+
+
+class _Tunnel:
+    """Một forward do daemon giám sát, theo spec của _tunnel_spec."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.port = None
+        self.proc = None
+        self.status = "starting"
+        self.error = ""
+        self.restarts = 0
+        self.failures = 0
+        self.since = time.time()
+        self.started = 0.0
+        self.next_start = 0.0
+        self.next_check = 0.0
+
+    @property
+    def log_path(self):
+        return os.path.join(_TUNNEL_DIR, self.spec["name"] + ".log")
+
+    def _log(self, message):
+        with open(self.log_path, "a") as f:
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}\n")
+
+    def start(self):
+        # Giữ port cũ khi restart (kubeconfig tunnel đã trỏ vào đó), rồi tới port ưa thích, rồi port bất kỳ
+        self.port = (self.port if self.port and _free_port(self.port) == self.port
+                     else _free_port(self.spec.get("port")))
+        argv = [a.replace("{port}", str(self.port)) for a in self.spec["argv"]]
+        self._log(f"start on 127.0.0.1:{self.port}: {shlex.join(argv)}")
+        with open(self.log_path, "a") as log:
+            self.proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                         env=dict(os.environ, **self.spec["environ"]), start_new_session=True)
+        self.status = "starting"
+        self.started = time.monotonic()
+        self.next_check = self.started + 0.5
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+                self.proc.wait()
+            except ProcessLookupError:
+                pass
+        self.proc = None
+
+    def _restart_later(self, now, error):
+        self.stop()
+        self.error = error
+        self.status = "down"
+        self.restarts += 1
+        self.failures = 0
+        backoff = min(60, 2 ** min(self.restarts, 6))
+        self.next_start = now + backoff
+        self._log(f"down ({error}); restart in {backoff}s")
+
+    def tick(self, now):
+        """Một vòng giám sát: chạy process nếu tới lượt, health-check, restart khi chết / fail liên tiếp."""
+        if self.proc is not None and self.proc.poll() is not None:
+            self._restart_later(now, f"process exited with {self.proc.returncode}")
+        if self.proc is None:
+            if now >= self.next_start:
+                self.start()
+            return
+        if now < self.next_check:
+            return
+        if _tunnel_healthy(self.port, self.spec.get("probe", "tcp")):
+            if self.status != "up":
+                self._log("up")
+                self.since = time.time()
+            self.status, self.error, self.failures = "up", "", 0
+            self.restarts = 0 if now - self.started > 300 else self.restarts
+            self.next_check = now + _TUNNEL_CHECK_EVERY
+            return
+        self.failures += 1
+        if self.status == "starting" and now - self.started > _TUNNEL_START_GRACE:
+            self._restart_later(now, f"not healthy {_TUNNEL_START_GRACE}s after start")
+        elif self.status == "up" and self.failures >= _TUNNEL_MAX_FAILS:
+            self._restart_later(now, f"{self.failures} failed health checks")
+        else:
+            self.next_check = now + (1 if self.status == "starting" else 2)
+
+    def info(self):
+        return {"name": self.spec["name"], "port": self.port, "status": self.status, "error": self.error,
+                "pid": self.proc.pid if self.proc else None, "restarts": self.restarts, "since": self.since,
+                "argv": self.spec["argv"], "log": self.log_path}
+
+
+class TunnelDaemon:
+    """`deploy.py tunnels serve`: giữ các _Tunnel, trả lời request JSON (một dòng) qua _TUNNEL_SOCKET."""
+
+    def __init__(self):
+        self.tunnels = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self._saved = None
+
+    def handle(self, request):
+        op = request.get("op")
+        # Dựng spec ngoài lock: terraform output (cache miss) không chặn request khác
+        spec = _tunnel_spec(request["kind"], request["env"]) if op == "ensure" else None
+        with self.lock:
+            if op == "ensure":
+                t = self.tunnels.get(spec["name"])
+                if t is None or t.spec != spec:
+                    if t is not None:
+                        t.stop()
+                    t = self.tunnels[spec["name"]] = _Tunnel(spec)
+                elif t.status == "down":
+                    t.next_start = 0.0  # có client đang đợi → không chờ hết backoff
+                return t.info()
+            if op == "get":
+                t = self.tunnels.get(request["name"])
+                return t.info() if t else None
+            if op == "list":
+                return [t.info() for t in self.tunnels.values()]
+            if op == "stop":
+                t = self.tunnels.pop(request["name"], None)
+                if t:
+                    t.stop()
+                return bool(t)
+            if op == "shutdown":
+                self.stopping.set()
+                return True
+            if op == "ping":
+                return {"pid": os.getpid()}
+        raise ValueError(f"unknown op {op!r}")
+
+    def _save(self):
+        with self.lock:
+            state = {"pid": os.getpid(), "socket": _TUNNEL_SOCKET, "tunnels": [t.info() for t in self.tunnels.values()]}
+        data = json.dumps(state, indent=2)
+        if data != self._saved:
+            tmp = f"{_TUNNEL_STATE}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, _TUNNEL_STATE)
+            self._saved = data
+
+    def serve(self):
+        os.makedirs(_TUNNEL_DIR, exist_ok=True)
+        lock = open(os.path.join(_STATE_DIR, "tunnels.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Tunnel manager already running.")
+            return
+        _stop_orphan_tunnels()
+        try:
+            if _tunnel_socket_exists():
+                os.unlink(_TUNNEL_SOCKET)  # socket của daemon trước (bị kill -9)
+        except OSError as e:
+            print(e, flush=True)
+            return
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = {"result": daemon.handle(json.loads(self.rfile.readline()))}
+                except (ValueError, KeyError) as e:
+                    reply = {"error": str(e)}
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        # umask trước bind: socket sinh ra đã là 0600, không có khoảng hở cho user khác connect
+        os.umask(0o077)
+        server = socketserver.ThreadingUnixStreamServer(_TUNNEL_SOCKET, Handler)
+        os.chmod(_TUNNEL_SOCKET, 0o600)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="tunnels-socket", daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda *_: self.stopping.set())
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} tunnel manager pid {os.getpid()} on {_TUNNEL_SOCKET}", flush=True)
+        try:
+            while not self.stopping.wait(0.5):
+                with self.lock:
+                    tunnels = list(self.tunnels.values())
+                for t in tunnels:
+                    t.tick(time.monotonic())
+                self._save()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(_TUNNEL_SOCKET)
+            with self.lock:
+                for t in self.tunnels.values():
+                    t.stop()
+                self.tunnels.clear()
+            if os.path.exists(_TUNNEL_STATE):
+                os.unlink(_TUNNEL_STATE)
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} tunnel manager stopped", flush=True)
+
+
+def _stop_orphan_tunnels():
+    """Process tunnel của daemon trước (bị kill -9) còn sống thì dừng, để port ưa thích trống lại."""
+    try:
+        with open(_TUNNEL_STATE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    for t in state.get("tunnels", []):
+        if not t.get("pid"):
+            continue
+        try:
+            cmd = run_process(["ps", "-o", "command=", "-p", str(t["pid"])], capture_output=True, text=True).stdout
+        except OSError:
+            continue
+        # pid có thể đã bị process khác dùng lại → chỉ dừng khi command khớp
+        if cmd.strip() and t["argv"][0] in cmd and all(a in cmd for a in t["argv"][1:] if "{port}" not in a):
+            try:
+                os.killpg(t["pid"], signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+def _tunnel_request(op, timeout=10, **fields):
+    """Một request tới daemon; OSError nếu daemon không chạy (hoặc socket không phải của user này)."""
+    if not _tunnel_socket_exists():
+        raise FileNotFoundError(f"{_TUNNEL_SOCKET}: tunnel manager not running")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(_TUNNEL_SOCKET)
+        s.sendall(json.dumps(dict(op=op, **fields)).encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    reply = json.loads(data or b"{}")
+    if "result" not in reply:
+        raise OSError(f"tunnel manager: {reply.get('error', 'no reply')}")
+    return reply["result"]
+
+
+def _ensure_tunnel_daemon():
+    """Daemon đang chạy thì thôi, không thì khởi động nền (tách session → sống sau khi deploy.py thoát)."""
+    _tunnel_socket_exists()  # path bị file lạ chiếm → lỗi luôn, không khởi động daemon chỉ để nó từ chối
+    try:
+        return _tunnel_request("ping")
+    except OSError:
+        pass
+    print(f"  Starting tunnel manager (log: {os.path.relpath(_TUNNEL_LOG, _SCRIPT_DIR)})...")
+    os.makedirs(_STATE_DIR, exist_ok=True)
+    with open(_TUNNEL_LOG, "a") as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "tunnels", "serve"], cwd=_SCRIPT_DIR,
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    ready = wait_until(lambda: _tunnel_request("ping"), "tunnel manager", timeout=15, interval=0.1, max_interval=0.5,
+                       quiet=True)
+    if not ready:
+        raise OSError(f"tunnel manager did not start ({ready.detail}); log: {_TUNNEL_LOG}")
+    return ready.value
+
+
+def tunnel(kind, env=None, timeout=90):
+    """Forward `<env>-<kind>` (kind trong _TUNNEL_KINDS, env mặc định = env hiện tại) do tunnel manager giữ: tạo nếu
+    chưa có hoặc Terraform output đổi, đợi tới khi healthy. Trả về port local, None nếu không lên trong timeout."""
+    env = env or current_env().env
+    name = f"{env}-{kind}"
+    try:
+        _ensure_tunnel_daemon()
+        info = _tunnel_request("ensure", kind=kind, env=env)
+    except OSError as e:
+        print(f"  ✗ {e}")
+        return None
+    if info["status"] == "up":
+        print(f"  ✓ Tunnel {name}: warm on 127.0.0.1:{info['port']}")
+        return info["port"]
+
+    def up():
+        info = _tunnel_request("get", name=name)
+        if not info:
+            raise NotReady("tunnel removed")
+        if info["status"] != "up":
+            raise NotReady(info["status"] + (f": {info['error']}" if info["error"] else ""))
+        return info["port"]
+
+    ready = wait_until(up, f"tunnel {name}", timeout=timeout, interval=0.2, max_interval=2, progress_every=15)
+    if ready:
+        print(f"  ✓ Tunnel {name}: up on 127.0.0.1:{ready.value} ({ready.waited:.1f}s)")
+    return ready.value if ready else None
+
+
+def tunnels_command(args):
+    """deploy.py tunnels [status|stop|serve]."""
+    sub = args[0] if args else "status"
+    if sub == "serve":
+        TunnelDaemon().serve()
+        return
+    if sub == "stop":
+        try:
+            _tunnel_request("shutdown")
+            print("Tunnel manager stopping (tunnels closed).")
+        except OSError:
+            print("Tunnel manager not running.")
+        return
+    if sub != "status":
+        print(f"Usage: {sys.argv[0]} tunnels [status|stop]", file=sys.stderr)
         sys.exit(1)
+    try:
+        tunnels = _tunnel_request("list")
+    except OSError:
+        print("Tunnel manager not running (khởi động tự động ở lần deploy tới).")
+        return
+    print(f"  {'tunnel':<20} {'local':>6}  {'status':<9} {'up for':>8} {'restarts':>8}  error")
+    for t in sorted(tunnels, key=lambda t: t["name"]):
+        up_for = f"{time.time() - t['since']:.0f}s" if t["status"] == "up" else ""
+        print(f"  {t['name']:<20} {t['port'] or '':>6}  {t['status']:<9} {up_for:>8} {t['restarts']:>8}  {t['error']}")
+
+
+# --- Terraform output cache: mỗi env chỉ chạy `terraform output -json` một lần cho mỗi state ---
+# Key = lineage + serial của terraform.tfstate (local backend); apply/destroy tăng serial → cache tự hết hạn.
+# Cache trên đĩa (.deploy/tf-outputs-<env>.json, 0600 vì có output sensitive) dùng chung cho các lần chạy sau;
+# trong một run mọi env (full pipeline chạy chung process) dùng chung cache trong bộ nhớ.
+# _tf_outputs_lock chỉ giữ lúc đọc / ghi dict; `terraform output` chạy dưới lock riêng của env → env khác nhau đọc
+# song song, cùng env thì thread sau đợi rồi dùng kết quả của thread trước.
+_tf_outputs = {}
+_tf_outputs_lock = threading.Lock()
+_tf_env_locks = {}
+
+
+def _tf_state_key(env_name):
+    """(lineage, serial) của state local; None nếu chưa có state (hoặc không đọc được)."""
+    state_path = os.path.join(TERRAFORM_DIR, "environments", env_name, "terraform.tfstate")
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        return [state["lineage"], state["serial"]]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def terraform_outputs(env_name=None, timeout=60):
+    """`terraform output -json` của env (mặc định env hiện tại), cache theo lineage/serial của state.
+    Lỗi terraform → CalledProcessError như check_output."""
+    env_name = env_name or current_env().env
+    cache_file = os.path.join(_STATE_DIR, f"tf-outputs-{env_name}.json")
+    with _tf_outputs_lock:
+        env_lock = _tf_env_locks.setdefault(env_name, threading.Lock())
+    with env_lock:
+        key = _tf_state_key(env_name)
+        with _tf_outputs_lock:
+            cached = _tf_outputs.get(env_name)
+        if key and cached and cached["key"] == key:
+            return cached["outputs"]
+        if key:
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                if cached.get("key") == key:
+                    with _tf_outputs_lock:
+                        _tf_outputs[env_name] = cached
+                    return cached["outputs"]
+            except (OSError, ValueError):
+                pass
+        out = run_process(
+            ["terraform", f"-chdir=environments/{env_name}", "output", "-json"], cwd=TERRAFORM_DIR, timeout=timeout,
+            stdout=subprocess.PIPE, check=True,
+        ).stdout
+        outputs = json.loads(out)
+        # State đổi trong lúc đọc output → không cache (lần sau đọc lại)
+        if key and key == _tf_state_key(env_name):
+            entry = {"key": key, "outputs": outputs}
+            with _tf_outputs_lock:
+                _tf_outputs[env_name] = entry
+            os.makedirs(_STATE_DIR, exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, cache_file)
+        return outputs
+
+
+def terraform_output(name, env_name=None, default=None):
+    """Giá trị một output (default nếu output không có)."""
+    return terraform_outputs(env_name).get(name, {}).get("value", default)
 
 
 def get_terraform_output():
     """Gets Terraform output as JSON (from environments/<env>)."""
     print("Fetching Terraform outputs...")
-    cmd = f"terraform -chdir=environments/{TERRAFORM_ENV} output -json"
-    output = subprocess.check_output(cmd, shell=True, cwd=TERRAFORM_DIR).decode("utf-8")
-    return json.loads(output)
+    return terraform_outputs(current_env().env)
 
 
 def get_management_openvpn_ip():
     """Lấy OpenVPN public IP của management (dùng làm jump host cho dev/prod)."""
     try:
-        out = subprocess.check_output(
-            "terraform -chdir=environments/management output -json",
-            shell=True,
-            cwd=TERRAFORM_DIR,
-            timeout=15,
-        )
-        data = json.loads(out)
-        return data.get("openvpn_public_ip", {}).get("value", "")
+        return terraform_output("openvpn_public_ip", "management", "")
     except Exception:
         return ""
 
 
+def _ensure_tfvars(env_dir):
+    """Tạo terraform.tfvars từ .example nếu chưa có. Trả về False nếu không có cả hai."""
+    tfvars = os.path.join(env_dir, "terraform.tfvars")
+    if os.path.isfile(tfvars):
+        return True
+    example = os.path.join(env_dir, "terraform.tfvars.example")
+    if not os.path.isfile(example):
+        return False
+    with open(example, "r") as f:
+        content = f.read()
+    # Replace placeholder my_ip so Terraform apply runs (user can edit tfvars later for real prod)
+    content = content.replace("YOUR_OFFICE_OR_VPN_IP/32", "0.0.0.0/0")
+    with open(tfvars, "w") as f:
+        f.write(content)
+    print(f"Created {tfvars} from .example (my_ip=0.0.0.0/0). Edit for production.")
+    return True
+
+
+# --- Terraform incremental: init chỉ khi lock file / nguồn module đổi, apply chỉ khi plan có diff ---
+# Provider tải một lần vào cache chung (.deploy/terraform-plugins) cho cả bốn env; init giữ flock vì cache
+# không an toàn khi nhiều init ghi cùng lúc (dev/prod chạy song song).
+_TF_PLUGIN_CACHE = os.path.join(_STATE_DIR, "terraform-plugins")
+
+
+def _tf_init_fingerprint(env_name):
+    """Những gì `terraform init` phụ thuộc: lock file + dòng source/version/backend trong .tf của env và modules."""
+    env_dir = os.path.join(TERRAFORM_DIR, "environments", env_name)
+    h = hashlib.sha256()
+    lock_file = os.path.join(env_dir, ".terraform.lock.hcl")
+    if os.path.isfile(lock_file):
+        with open(lock_file, "rb") as f:
+            h.update(f.read())
+    tf_files = [os.path.join(env_dir, f) for f in sorted(os.listdir(env_dir)) if f.endswith(".tf")]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(TERRAFORM_DIR, "modules")):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        tf_files += [os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith(".tf")]
+    for path in tf_files:
+        with open(path) as f:
+            lines = [line.strip() for line in f if re.match(r"\s*(source|version|required_version|backend)\b", line)]
+        h.update(os.path.relpath(path, TERRAFORM_DIR).encode() + b"\0" + "\n".join(lines).encode())
+    return h.hexdigest()
+
+
+def terraform_init(env_name, log_file=None):
+    """`terraform init` của env, bỏ qua khi đã init thành công với cùng fingerprint (DEPLOY_TF_INCREMENTAL=1)."""
+    env_dir = os.path.join(TERRAFORM_DIR, "environments", env_name)
+    stamp = os.path.join(_STATE_DIR, f"tf-init-{env_name}.json")
+    fingerprint = _tf_init_fingerprint(env_name)
+    if DEPLOY_TF_INCREMENTAL and os.path.isdir(os.path.join(env_dir, ".terraform")):
+        try:
+            with open(stamp) as f:
+                if json.load(f).get("fingerprint") == fingerprint:
+                    print(f"  ✓ Terraform {env_name}: init up to date (lock file / modules unchanged), skipped")
+                    return
+        except (OSError, ValueError):
+            pass
+    env = os.environ.copy()
+    env.setdefault("TF_PLUGIN_CACHE_DIR", _TF_PLUGIN_CACHE)
+    os.makedirs(_STATE_DIR, exist_ok=True)
+    os.makedirs(env["TF_PLUGIN_CACHE_DIR"], exist_ok=True)
+    with open(os.path.join(_STATE_DIR, "terraform-init.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        run_command(f"terraform -chdir=environments/{env_name} init -input=false", cwd=TERRAFORM_DIR, env=env,
+                    log_file=log_file)
+    # init có thể tạo / cập nhật lock file → fingerprint sau init
+    with open(stamp, "w") as f:
+        json.dump({"fingerprint": _tf_init_fingerprint(env_name), "finished": time.time()}, f)
+
+
+def terraform_apply(env_name, timeout=None, log_file=None):
+    """init + apply env. Incremental: `plan -detailed-exitcode -out`, không diff → bỏ qua apply, có diff → apply
+    đúng plan đó (không refresh lần hai). Trả về True nếu đã apply."""
+    chdir = f"terraform -chdir=environments/{env_name}"
+    var_file = " -var-file=terraform.tfvars" if env_name != "networking" else ""
+    terraform_init(env_name, log_file=log_file)
+    if not DEPLOY_TF_INCREMENTAL:
+        run_command(f"{chdir} apply -auto-approve -input=false{var_file}", cwd=TERRAFORM_DIR, timeout=timeout,
+                    log_file=log_file)
+        return True
+    plan_path = os.path.join(_STATE_DIR, f"tfplan-{env_name}")
+    try:
+        rc = run_command(f"{chdir} plan -detailed-exitcode -input=false -out={shlex.quote(plan_path)}{var_file}",
+                         cwd=TERRAFORM_DIR, timeout=timeout, log_file=log_file, ok_codes=(0, 2))
+        if rc == 0:
+            print(f"  ✓ Terraform {env_name}: no changes, apply skipped")
+            return False
+        run_command(f"{chdir} apply -input=false {shlex.quote(plan_path)}", cwd=TERRAFORM_DIR, timeout=timeout,
+                    log_file=log_file)
+        return True
+    finally:
+        # Plan file có giá trị sensitive
+        if os.path.exists(plan_path):
+            os.unlink(plan_path)
+
+
 def setup_terraform():
     """Applies Terraform configuration (environments/<env>)."""
-    tfvars = os.path.join(TERRAFORM_ENV_DIR, "terraform.tfvars")
-    if not os.path.isfile(tfvars):
-        example = os.path.join(TERRAFORM_ENV_DIR, "terraform.tfvars.example")
-        if os.path.isfile(example):
-            with open(example, "r") as f:
-                content = f.read()
-            # Replace placeholder my_ip so Terraform apply runs (user can edit tfvars later for real prod)
-            content = content.replace("YOUR_OFFICE_OR_VPN_IP/32", "0.0.0.0/0")
-            with open(tfvars, "w") as f:
-                f.write(content)
-            print(f"Created {tfvars} from .example (my_ip=0.0.0.0/0). Edit for production.")
-        else:
-            print(f"Error: terraform.tfvars not found and no terraform.tfvars.example in {TERRAFORM_ENV}.")
-            sys.exit(1)
+    env = current_env()
+    if not _ensure_tfvars(env.env_dir):
+        print(f"Error: terraform.tfvars not found and no terraform.tfvars.example in {env.env}.")
+        sys.exit(1)
     print("--- Step 1: Terraform Apply ---")
-    run_command(f"terraform -chdir=environments/{TERRAFORM_ENV} init -input=false", cwd=TERRAFORM_DIR)
-    run_command(
-        f"terraform -chdir=environments/{TERRAFORM_ENV} apply -auto-approve -input=false -var-file=terraform.tfvars",
-        cwd=TERRAFORM_DIR,
-    )
+    terraform_apply(env.env)
 
 
 def run_openvpn_ansible(openvpn_public_ip):
     """Chạy Ansible playbook openvpn-server.yml để cấu hình OpenVPN và tạo .ovpn (fetch về project root)."""
     print("--- Step: Ansible OpenVPN Server Setup ---")
-    ssh_key_path = os.path.abspath(os.path.join(TERRAFORM_ENV_DIR, SSH_KEY_FILE_NAME))
+    ctx = current_env()
+    ssh_key_path = ctx.ssh_key_path
+    # Inventory + biến SSH của lần chạy nằm trong .deploy/run/<env>/, không sửa file trong ansible/ → deploy song
+    # song không ghi đè nhau. -e có độ ưu tiên cao nhất: thắng key path mẫu trong group_vars/vpn_server.yml.
+    inventory_path = ctx.run_path("inventory_openvpn.yml")
+    with open(inventory_path, "w") as f:
+        f.write(f"vpn_server:\n  hosts:\n    {openvpn_public_ip}:\n")
+    extra_vars_path = ctx.run_path("ansible-vars.json")
+    with open(extra_vars_path, "w") as f:
+        json.dump({
+            "openvpn_public_ip": openvpn_public_ip,
+            "ansible_user": "ubuntu",
+            "ansible_ssh_private_key_file": ssh_key_path,
+            # Tránh "Too many authentication failures": chỉ dùng key chỉ định, không dùng agent
+            "ansible_ssh_extra_args": "-o IdentitiesOnly=yes -o ConnectTimeout=30",
+        }, f, indent=2)
+    playbook_cmd = (f"ansible-playbook -i {shlex.quote(inventory_path)} -e @{shlex.quote(extra_vars_path)} "
+                    "openvpn-server.yml")
+    fingerprint = _openvpn_fingerprint(openvpn_public_ip)
     max_wait = 300  # 5 phút (Ubuntu + cloud-init đôi khi > 2 phút)
     print(f"  Waiting for OpenVPN instance to accept SSH (tối đa {max_wait // 60} phút)...")
-    ssh_ok = False
-    for waited in range(0, max_wait, 10):
-        try:
-            res = subprocess.run(
-                f"ssh -i {ssh_key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=10 ubuntu@{openvpn_public_ip} 'echo ready'",
-                shell=True,
-                capture_output=True,
-                timeout=15,
-            )
-            if res.returncode == 0:
-                print(f"  ✓ OpenVPN server SSH ready (waited {waited}s)")
-                ssh_ok = True
-                break
-        except Exception:
-            pass
-        if waited % 30 == 0 and waited > 0:
-            print(f"  Still waiting... ({waited}s)")
-        time.sleep(10)
-    if not ssh_ok:
-        inventory_path = os.path.join(ANSIBLE_DIR, "inventory_openvpn.yml")
-        with open(inventory_path, "w") as f:
-            f.write(f"vpn_server:\n  hosts:\n    {openvpn_public_ip}:\n")
+    vpn = ssh_session(openvpn_public_ip, ssh_key_path)
+    # Probe SSH đồng thời đọc fingerprint server đã apply + trạng thái OpenVPN → không tốn thêm round-trip
+    probe = _ssh_ready_probe(vpn, command=f"echo fingerprint=$(sudo -n cat {_OPENVPN_FINGERPRINT} 2>/dev/null); "
+                                          "echo state=$(systemctl is-active openvpn-server@server 2>/dev/null)")
+    ready = wait_until(probe, "OpenVPN SSH", timeout=max_wait, max_interval=5)
+    if ready:
+        print(f"  ✓ OpenVPN server SSH ready (waited {ready.waited:.0f}s)")
+        remote = dict(line.split("=", 1) for line in ready.value.splitlines() if "=" in line)
+        missing = [name for name in _vpn_client_files() if not os.path.isfile(os.path.join(_SCRIPT_DIR, name))]
+        if DEPLOY_ANSIBLE_MODE != "always" and remote.get("fingerprint") == fingerprint \
+                and remote.get("state") == "active" and not missing and _vpn_client_files():
+            print("  ✓ OpenVPN server đã apply đúng playbook + vars này, service active → bỏ qua Ansible "
+                  "(DEPLOY_ANSIBLE_MODE=always để chạy lại)")
+            return
+        reason = ("DEPLOY_ANSIBLE_MODE=always" if DEPLOY_ANSIBLE_MODE == "always" else
+                  "chưa provision" if not remote.get("fingerprint") else
+                  "playbook / vars đổi" if remote.get("fingerprint") != fingerprint else
+                  f"openvpn-server@server {remote.get('state') or 'unknown'}" if remote.get("state") != "active" else
+                  f"thiếu {', '.join(missing) or '.ovpn'} local")
+        print(f"  ↻ Chạy Ansible ({reason})")
+    else:
         print(f"  ✗ OpenVPN server SSH timeout sau {max_wait}s.")
         # One verbose attempt to show why (timeout vs refused vs permission denied)
         try:
-            r = subprocess.run(
-                f"ssh -v -i {ssh_key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=5 ubuntu@{openvpn_public_ip} exit 2>&1",
+            r = run_process(
+                f"ssh -v -i {ssh_key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ControlPath=none -o ConnectTimeout=5 ubuntu@{openvpn_public_ip} exit 2>&1",
                 shell=True,
                 capture_output=True,
                 timeout=15,
@@ -158,147 +1811,176 @@ def run_openvpn_ansible(openvpn_public_ip):
         except Exception as e:
             print(f"     [ssh] {e}")
         print("     (Lỗi này không liên quan ArgoCD – deploy fail ở bước OpenVPN SSH, trước khi tới cluster/ArgoCD.)")
-        print("     Thử: mạng khác (VPN/corp có thể chặn); hoặc recreate: ./scripts/recreate-openvpn-instance.sh " + TERRAFORM_ENV)
-        print("     Bỏ qua bước này lần chạy: SKIP_OPENVPN_ANSIBLE=1 ./deploy.py " + TERRAFORM_ENV)
+        print("     Thử: mạng khác (VPN/corp có thể chặn); hoặc recreate: ./scripts/recreate-openvpn-instance.sh " + ctx.env)
+        print("     Bỏ qua bước này lần chạy: SKIP_OPENVPN_ANSIBLE=1 ./deploy.py " + ctx.env)
         print("     Kiểm tra SSH thủ công (timeout = mạng/firewall; refused = instance chưa sẵn sàng; denied = key sai):")
         print(f"     ssh -o IdentitiesOnly=yes -i {ssh_key_path} -o ConnectTimeout=15 ubuntu@{openvpn_public_ip}")
         print("     Chạy Ansible thủ công khi SSH được:")
-        print(f"     cd {ANSIBLE_DIR} && ansible-playbook -i inventory_openvpn.yml -e openvpn_public_ip={openvpn_public_ip} openvpn-server.yml")
+        print(f"     cd {ANSIBLE_DIR} && {playbook_cmd}")
         sys.exit(1)
 
-    # Static inventory: Terraform output đã có openvpn_public_ip, không cần dynamic inventory
-    vpn_server_yml = os.path.join(ANSIBLE_DIR, "group_vars", "vpn_server.yml")
-    with open(vpn_server_yml, "r") as f:
-        vpn_cfg = f.read()
-    key_line = f'ansible_ssh_private_key_file: "{ssh_key_path}"'
-    if "ansible_ssh_private_key_file" in vpn_cfg:
-        vpn_cfg = re.sub(r"ansible_ssh_private_key_file:\s*[^\n]+", key_line, vpn_cfg)
-    else:
-        vpn_cfg = vpn_cfg.rstrip() + "\n" + key_line + "\n"
-    # Tránh "Too many authentication failures": chỉ dùng key chỉ định, không dùng agent
-    if 'IdentitiesOnly' not in vpn_cfg:
-        if 'ansible_ssh_common_args:' in vpn_cfg:
-            vpn_cfg = re.sub(r'(ansible_ssh_common_args:\s*)"', r'\1"-o IdentitiesOnly=yes ', vpn_cfg)
-        else:
-            vpn_cfg = vpn_cfg.rstrip() + '\nansible_ssh_common_args: "-o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=30"\n'
-    with open(vpn_server_yml, "w") as f:
-        f.write(vpn_cfg)
-
-    # Inventory file: group vpn_server với host = IP (Ansible SSH tới IP, không resolve "vpn_server")
-    inventory_path = os.path.join(ANSIBLE_DIR, "inventory_openvpn.yml")
-    with open(inventory_path, "w") as f:
-        f.write(f"vpn_server:\n  hosts:\n    {openvpn_public_ip}:\n")
-
     env = os.environ.copy()
     env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
     env["ANSIBLE_PRIVATE_KEY_FILE"] = ssh_key_path
-    run_command(
-        f"ansible-playbook -i inventory_openvpn.yml -e openvpn_public_ip={openvpn_public_ip} openvpn-server.yml",
-        cwd=ANSIBLE_DIR,
-        env=env,
-        timeout=600,
-    )
+    env.update({
+        # Mỗi task: một ssh exec (pipelining) trên master connection deploy.py vừa mở cho probe → không handshake lại
+        "ANSIBLE_PIPELINING": "True",
+        "ANSIBLE_SSH_ARGS": "-o ControlMaster=auto -o ControlPersist=300s -o StrictHostKeyChecking=no",
+        "ANSIBLE_SSH_CONTROL_PATH": vpn.control_path,
+        # Facts cache local: gather facts một lần / ngày thay vì mỗi play mỗi lần chạy
+        "ANSIBLE_GATHERING": "smart",
+        "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+        "ANSIBLE_CACHE_PLUGIN_CONNECTION": os.path.join(_STATE_DIR, "ansible-facts"),
+        "ANSIBLE_CACHE_PLUGIN_TIMEOUT": "86400",
+        "ANSIBLE_NOCOLOR": "1",
+    })
+    _run_playbook(playbook_cmd, env, ctx.run_path("ansible.log"), timeout=600)
+    # Ghi fingerprint lên server sau khi playbook xong → lần sau (cùng playbook + vars) bỏ qua được
+    res = vpn.run(f"echo {fingerprint} | sudo -n tee {_OPENVPN_FINGERPRINT} >/dev/null", capture_output=True, timeout=30)
+    if res.returncode != 0:
+        print(f"  ⚠ Không ghi được fingerprint lên server (lần sau sẽ chạy lại playbook): rc={res.returncode}")
     print("  ✓ OpenVPN server configured; .ovpn files fetched to project root (e.g. client1.ovpn)")
 
 
+# Fingerprint playbook + vars đã apply, lưu trên chính OpenVPN server (server recreate → mất → chạy lại)
+_OPENVPN_FINGERPRINT = "/etc/openvpn/deploy-py.fingerprint"
+
+
+def _openvpn_fingerprint(openvpn_public_ip):
+    """sha256 của ansible/ (playbook, group_vars, vars) + biến truyền vào playbook."""
+    data = json.dumps({"ansible": _hash_tree(ANSIBLE_DIR), "openvpn_public_ip": openvpn_public_ip}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _vpn_client_files():
+    """Tên file .ovpn playbook fetch về project root (vpn_users trong group_vars/users.yml)."""
+    try:
+        with open(os.path.join(ANSIBLE_DIR, "group_vars", "users.yml")) as f:
+            text = re.sub(r"#.*", "", f.read())
+    except OSError:
+        return []
+    return [f"{name}.ovpn" for name in re.findall(r"(?:^\s*-\s*|\{\s*)name:\s*[\"']?([^\"',}\s]+)", text, re.M)]
+
+
+def _run_playbook(command, env, log_file, timeout):
+    """Chạy ansible-playbook, output đầy đủ vào log_file; terminal nhận từng task ngay khi xong (thời gian + kết quả)
+    và bảng task chậm nhất ở cuối. Lỗi → in các dòng fatal + tail log rồi thoát như run_command."""
+    print(f"Running: {command} (log: {log_file})")
+    tasks = []
+    current = {}
+    rank = {"skipping": 0, "ok": 1, "changed": 2, "failed": 3, "fatal": 3, "unreachable": 3}
+
+    def finish():
+        if current:
+            task = (current["name"], time.monotonic() - current["start"], current["status"])
+            tasks.append(task)
+            print(f"    {task[1]:6.1f}s  {task[2]:<11} {task[0]}")
+            current.clear()
+
+    def on_line(line):
+        log.write(line + "\n")
+        m = re.match(r"(TASK|RUNNING HANDLER) \[(.*)\]", line)
+        if m or line.startswith(("PLAY [", "PLAY RECAP")):
+            finish()
+            if m:
+                current.update(name=m.group(2), start=time.monotonic(), status="-")
+            elif line.startswith("PLAY ["):
+                print(f"  {line.rstrip(' *')}")
+            return
+        m = re.match(r"(skipping|ok|changed|failed|fatal|unreachable)\b", line)
+        if m and current and rank[m.group(1)] >= rank.get(current["status"], -1):
+            current["status"] = m.group(1)
+        if line.startswith(("fatal:", "failed:")) or line.startswith("ERROR!"):
+            print(f"      {line[:300]}")
+
+    start = time.monotonic()
+    with open(log_file, "w") as log:
+        try:
+            res = run_process(command, shell=True, cwd=ANSIBLE_DIR, env=env, timeout=timeout, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, on_line=_with_context(on_line))
+        except subprocess.TimeoutExpired:
+            res = None
+        finish()
+    if res is None or res.returncode != 0:
+        print(f"Error running command: {command}" if res is not None else f"Command timed out: {command}")
+        _print_log_tail(log_file)
+        sys.exit(1)
+    slowest = sorted(tasks, key=lambda t: -t[1])[:3]
+    changed = sum(1 for t in tasks if t[2] == "changed")
+    print(f"  ✓ Ansible: {len(tasks)} task ({changed} changed) trong {time.monotonic() - start:.0f}s; chậm nhất: "
+          + ", ".join(f"{name} {dur:.1f}s" for name, dur, _ in slowest))
+
+
 def fetch_kubeconfig(openvpn_ip, master_private_ip, nlb_dns, jump_ssh_key_path=None, key_on_jump="k8s-key.pem"):
     """Fetches and configures kubeconfig via SSH through OpenVPN server (jump host).
     jump_ssh_key_path: key to SSH to jump (management); None = use current env key.
-    key_on_jump: path on jump host for key to master (~/.ssh/<name>)."""
-    key_to_jump = jump_ssh_key_path or os.path.abspath(os.path.join(TERRAFORM_ENV_DIR, SSH_KEY_FILE_NAME))
-    master_key_path = os.path.abspath(os.path.join(TERRAFORM_ENV_DIR, SSH_KEY_FILE_NAME))
+    key_on_jump: tên key (~/.ssh/<name>) bản cũ copy lên jump để ssh tiếp tới master — giờ master đi qua
+    ProxyCommand nên key không cần ở jump nữa; bản copy cũ còn sót thì xoá."""
+    kubeconfig_file = current_env().kubeconfig_file
+    master_key_path = current_env().ssh_key_path
+    key_to_jump = jump_ssh_key_path or master_key_path
 
     print("--- Step 4: Fetching Kubeconfig via OpenVPN Server (jump) ---")
 
-    print("  Waiting for OpenVPN server to be ready...")
-    for waited in range(0, 120, 5):
-        try:
-            res = subprocess.run(
-                f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=5 ubuntu@{openvpn_ip} 'echo ready'",
-                shell=True,
-                capture_output=True,
-                timeout=10,
-            )
-            if res.returncode == 0:
-                print(f"  ✓ OpenVPN server ready (waited {waited}s)")
-                break
-        except Exception:
-            pass
-        if waited % 15 == 0:
-            print(f"  Still waiting for OpenVPN server... ({waited}s)")
-        time.sleep(5)
+    jump = ssh_session(openvpn_ip, key_to_jump)
+    # Master đi qua ProxyCommand trên master connection của jump → không còn ssh lồng trên OpenVPN
+    master = ssh_session(master_private_ip, master_key_path, jump=jump)
 
-    print("  Copying SSH key to OpenVPN server for master access...")
-    run_command(
-        f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no ubuntu@{openvpn_ip} 'mkdir -p ~/.ssh && chmod 700 ~/.ssh'",
-        timeout=15,
-    )
-    run_command(
-        f"scp -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -i {key_to_jump} {master_key_path} ubuntu@{openvpn_ip}:~/.ssh/{key_on_jump}",
-        timeout=30,
-    )
-    run_command(
-        f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no ubuntu@{openvpn_ip} 'chmod 600 ~/.ssh/{key_on_jump}'",
-        timeout=15,
-    )
+    # Jump chỉ cần SSH được (private key của master không lên jump). Probe xoá luôn key mà bản cũ đã copy lên đó.
+    print("  Waiting for OpenVPN server to be ready...")
+    remove_old_key = f"rm -f {_remote_path('~/.ssh/' + key_on_jump)}; echo ready"
+    ready = wait_until(_ssh_ready_probe(jump, connect_timeout=5, command=remove_old_key), "OpenVPN server",
+                       timeout=120, max_interval=5, progress_every=15)
+    if ready:
+        print(f"  ✓ OpenVPN server ready (waited {ready.waited:.0f}s)")
+    else:
+        raise RuntimeError(f"OpenVPN server {openvpn_ip} not reachable over SSH: {ready.detail[:300]}")
 
-    print("  Waiting for RKE2 to generate kubeconfig (user_data đang chạy)...")
-    time.sleep(180)
+    # Không sleep cố định: cluster đã chạy (re-deploy) có file ngay → đi tiếp luôn; cluster mới thì poll tới khi RKE2 tạo xong.
+    # Mỗi lần poll là một script đọc luôn cả hai file → file có là đã có nội dung, không cần thêm lần cat nào
+    max_wait = 600
+    print(f"  Waiting for SSH to master via OpenVPN server (và file kubeconfig, tối đa {max_wait // 60} phút)...")
+    fetch = RemoteScript(master)
+    fetch.fetch("home", "/home/ubuntu/.kube/config")
+    fetch.fetch("rke2", "/etc/rancher/rke2/rke2.yaml", sudo=True)  # RKE2 tạo rke2.yaml trước
 
-    inner_ssh = f"ssh -i ~/.ssh/{key_on_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=10 ubuntu@{master_private_ip}"
-    print("  Waiting for SSH to master via OpenVPN server (và file kubeconfig)...")
-    for waited in range(0, 420, 15):
+    def fetch_kubeconfig_file():
         try:
-            # Kiểm tra /home/ubuntu/.kube/config hoặc /etc/rancher/rke2/rke2.yaml (RKE2 tạo rke2.yaml trước)
-            res = subprocess.run(
-                f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=5 ubuntu@{openvpn_ip} "
-                f"'{inner_ssh} \"test -f /home/ubuntu/.kube/config || sudo test -f /etc/rancher/rke2/rke2.yaml\" && echo ready'",
-                shell=True,
-                capture_output=True,
-                timeout=25,
-            )
-            if res.returncode == 0 and b"ready" in (res.stdout or b""):
-                print(f"  ✓ kubeconfig ready (waited {waited}s)")
-                break
-        except Exception:
+            results = fetch.run(timeout=30)
+        except subprocess.CalledProcessError as e:
+            lines = (e.stderr or b"").decode(errors="replace").strip().splitlines()
+            raise NotReady(lines[-1] if lines else f"ssh rc={e.returncode}")
+        for name in ("home", "rke2"):
+            r = results.get(name)
+            if r and r.returncode == 0 and r.stdout:
+                return name, r.stdout
+        errors = [r.stderr.decode(errors="replace").strip() for r in results.values() if r.stderr.strip()]
+        raise NotReady("; ".join(errors) or "kubeconfig file not there yet")
+
+    ready = wait_until(fetch_kubeconfig_file, "RKE2 kubeconfig", timeout=max_wait)
+    if ready:
+        print(f"  ✓ kubeconfig ready (waited {ready.waited:.0f}s)")
+    else:
+        print(f"  ✗ kubeconfig not found on master {master_private_ip} after {max_wait}s.")
+        print(f"  Last error: {ready.detail[:300]}")
+        try:
+            res = master.run("systemctl is-active rke2-server; sudo tail -5 /var/log/cloud-init-output.log",
+                             capture_output=True, text=True, timeout=25)
+            for line in (res.stdout or res.stderr or "").splitlines():
+                print(f"    [master] {line}")
+        except subprocess.TimeoutExpired:
             pass
-        if waited % 30 == 0:
-            print(f"  Still waiting... ({waited}s)")
-        time.sleep(15)
+        print("  Debug: SSH được tới master? rke2-server active? Xem /var/log/cloud-init-output.log trên master.")
+        raise RuntimeError(f"RKE2 kubeconfig not ready on {master_private_ip} after {max_wait}s")
 
-    print("  Fetching kubeconfig via SSH (through OpenVPN server)...")
-    kubeconfig_content = None
-    try:
-        kubeconfig_content = subprocess.check_output(
-            f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no ubuntu@{openvpn_ip} "
-            f"'{inner_ssh} cat /home/ubuntu/.kube/config'",
-            shell=True,
-            timeout=30,
-            stderr=subprocess.PIPE,
-        )
-    except subprocess.CalledProcessError as e:
-        if e.returncode != 0 and e.stderr:
-            print(f"  (cat /home/ubuntu/.kube/config failed: {e.stderr.decode(errors='replace')[:200]})")
-        try:
-            kubeconfig_content = subprocess.check_output(
-                f"ssh -i {key_to_jump} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no ubuntu@{openvpn_ip} "
-                f"'{inner_ssh} sudo cat /etc/rancher/rke2/rke2.yaml'",
-                shell=True,
-                timeout=30,
-                stderr=subprocess.PIPE,
-            )
-            print("  ✓ Used /etc/rancher/rke2/rke2.yaml (fallback)")
-        except subprocess.CalledProcessError as e2:
-            if e2.stderr:
-                print(f"  Fallback failed: {e2.stderr.decode(errors='replace')[:300]}", file=sys.stderr)
-            raise
-    if kubeconfig_content is None or len(kubeconfig_content) == 0:
-        raise RuntimeError("Could not fetch kubeconfig from master (SSH or file missing)")
-    with open(KUBECONFIG_FILE, "wb") as f:
+    source, kubeconfig_content = ready.value
+    if source == "rke2":
+        print("  ✓ Used /etc/rancher/rke2/rke2.yaml (fallback)")
+    with open(kubeconfig_file, "wb") as f:
         f.write(kubeconfig_content)
 
     # Đọc và sửa: server = master IP (chỉ cần VPN, một terminal); xóa cert, dùng insecure-skip-tls-verify
-    with open(KUBECONFIG_FILE, "r") as f:
+    with open(kubeconfig_file, "r") as f:
         config = f.read()
     config = re.sub(r'server:\s*https://[^\s\n]+', f'server: https://{master_private_ip}:6443', config)
 
@@ -335,187 +2017,618 @@ def fetch_kubeconfig(openvpn_ip, master_private_ip, nlb_dns, jump_ssh_key_path=N
             config
         )
     
-    with open(KUBECONFIG_FILE, "w") as f:
+    with open(kubeconfig_file, "w") as f:
         f.write(config)
-    os.chmod(KUBECONFIG_FILE, 0o600)
-    print(f"  ✓ Kubeconfig saved to {KUBECONFIG_FILE} (server: https://{master_private_ip}:6443 — dùng khi đã bật VPN)")
+    os.chmod(kubeconfig_file, 0o600)
+    print(f"  ✓ Kubeconfig saved to {kubeconfig_file} (server: https://{master_private_ip}:6443 — dùng khi đã bật VPN)")
 
 
-def _create_tunnel_kubeconfig():
-    """Tạo file kubeconfig tạm 127.0.0.1:<port> để deploy dùng tunnel (port riêng mỗi env)."""
-    global KUBECONFIG_TUNNEL_FILE
-    local_port = LOCAL_PORT_BY_ENV.get(TERRAFORM_ENV, 6443)
-    with open(KUBECONFIG_FILE, "r") as f:
+def _create_tunnel_kubeconfig(local_port=None):
+    """Tạo file kubeconfig tạm 127.0.0.1:<port> để deploy dùng tunnel (port do tunnel manager cấp cho env)."""
+    env = current_env()
+    local_port = local_port or env.local_port
+    with open(env.kubeconfig_file, "r") as f:
         config = f.read()
     config_tunnel = re.sub(r'server:\s*https://[^\s\n]+', f'server: https://127.0.0.1:{local_port}', config)
-    path = os.path.join(_SCRIPT_DIR, f".kube_config_rke2_{TERRAFORM_ENV}_tunnel.yaml")
+    path = env.tunnel_kubeconfig_path
     with open(path, "w") as f:
         f.write(config_tunnel)
     os.chmod(path, 0o600)
-    KUBECONFIG_TUNNEL_FILE = path
+    env.kubeconfig_tunnel_file = path
+    # mtime có thể không đổi nếu ghi lại trong cùng tick của filesystem → bỏ luôn client cũ (port cũ)
+    with _kube_clients_lock:
+        _kube_clients.pop(os.path.abspath(path), None)
+
+
+def _readyz_command(url):
+    """Remote command: HTTP code của url (/readyz) + exit code curl."""
+    return f"curl -k -s -o /dev/null -w '%{{http_code}}' --connect-timeout 5 {url} 2>&1; echo \" exit=$?\""
+
+
+def _readyz_result(res):
+    """HTTP code khi API trả lời (kết quả ssh chạy _readyz_command); chưa trả lời → NotReady."""
+    if isinstance(res, Exception):
+        raise NotReady(f"{type(res).__name__}: {res}")
+    out = (res.stdout or "").strip()
+    code = out.split()[0] if out else ""
+    # 200 = OK, 401/403 = API đang chạy nhưng từ chối vì curl không gửi client cert (bình thường)
+    if res.returncode == 0 and code in ("200", "401", "403"):
+        return code
+    raise NotReady("curl: " + (out or (res.stderr or "").strip() or "ssh_rc=%s" % res.returncode))
+
+
+def _readyz_probe(session, url):
+    """Probe cho wait_until: curl url (/readyz) từ host của session. Trả về HTTP code khi API trả lời."""
+    def probe():
+        return _readyz_result(session.run(_readyz_command(url), capture_output=True, text=True, timeout=20))
+    return probe
 
 
 def wait_for_api_from_openvpn(openvpn_ip, master_private_ip, max_wait=600, jump_ssh_key_path=None):
     """Đợi API server thật sự trả lời từ OpenVPN (curl /readyz). RKE2 user_data có thể mất 5–10 phút."""
-    key_path = jump_ssh_key_path or os.path.abspath(os.path.join(TERRAFORM_ENV_DIR, SSH_KEY_FILE_NAME))
+    key_path = jump_ssh_key_path or current_env().ssh_key_path
     print("  Waiting for Kubernetes API from OpenVPN (curl https://master:6443/readyz)...")
-    last_curl_out, last_curl_err = "", ""
-    for waited in range(0, max_wait, 15):
-        try:
-            res = subprocess.run(
-                f"ssh -i {key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -o ConnectTimeout=10 ubuntu@{openvpn_ip} "
-                f"curl -k -s -o /dev/null -w '%{{http_code}}' --connect-timeout 5 https://{master_private_ip}:6443/readyz 2>&1; echo ' exit='$?",
-                shell=True,
-                capture_output=True,
-                timeout=20,
-            )
-            out = (res.stdout or b"").decode(errors="replace").strip()
-            err = (res.stderr or b"").decode(errors="replace").strip()
-            last_curl_out, last_curl_err = out, err
-            # 200 = OK, 401/403 = API đang chạy nhưng từ chối vì curl không gửi client cert (bình thường)
-            if res.returncode == 0 and ("200" in out or "401" in out or "403" in out):
-                print("  ✓ API reachable from OpenVPN (waited %ds, curl: %s)" % (waited, out.split()[0] if out else "ok"))
-                return True
-            if waited % 60 == 0 and waited > 0:
-                # In ra lỗi thật: 000 = không kết nối được, exit=7 = refused, exit=28 = timeout
-                hint = out or err or ("ssh_rc=%s" % res.returncode)
-                print("  Still waiting... (%ds) curl: %s" % (waited, hint[:120]))
-        except subprocess.TimeoutExpired:
-            last_curl_err = "ssh/curl timeout"
-        except Exception as e:
-            last_curl_err = str(e)
-        time.sleep(15)
+    jump = ssh_session(openvpn_ip, key_path)
+    ready = wait_until(_readyz_probe(jump, f"https://{master_private_ip}:6443/readyz"), "API from OpenVPN",
+                       timeout=max_wait, progress_every=60)
+    if ready:
+        print("  ✓ API reachable from OpenVPN (waited %ds, curl: %s)" % (ready.waited, ready.value))
+        return True
     print("  ✗ API not reachable from OpenVPN after %ds." % max_wait)
-    print("  Curl last output: %s" % (last_curl_out or "(empty)"))
-    if last_curl_err:
-        print("  Curl last stderr: %s" % last_curl_err[:200])
+    # 000 = không kết nối được, exit=7 = refused, exit=28 = timeout
+    print("  Curl last output: %s" % (ready.detail[:200] or "(empty)"))
     print("  Debug: (1) terraform apply đã chạy xong? SG k8s_master có rule 6443 từ openvpn SG.")
     print("         (2) Trên master: ssh ubuntu@<master_ip> rồi sudo tail -100 /var/log/cloud-init-output.log")
     print("         (3) Từ OpenVPN: ssh ubuntu@<master_ip> rồi curl -k -v https://localhost:6443/readyz")
     return False
 
 
-def _tunnel_log_path():
-    return f"/tmp/openvpn-k8s-pf-{TERRAFORM_ENV}.log"
-
-
-def _dump_tunnel_diagnostics(local_port=6443):
-    """In log tunnel và trạng thái process khi API không kết nối được."""
-    log_file = _tunnel_log_path()
+def _dump_tunnel_diagnostics(name=None):
+    """In trạng thái + log của tunnel (tunnel manager) khi API không kết nối được."""
+    name = name or f"{current_env().env}-api"
     print("  --- Tunnel diagnostics ---")
-    if os.path.isfile(log_file):
-        with open(log_file, "r") as f:
-            lines = f.readlines()
-        tail = lines[-25:] if len(lines) >= 25 else lines
-        print("  Tunnel log (%s) last %d lines:" % (log_file, len(tail)))
-        for line in tail:
-            print("    " + line.rstrip())
-    else:
-        print("  Tunnel log not found: %s" % log_file)
     try:
-        r = subprocess.run(
-            "pgrep -af 'ssh.*%s:.*6443'" % local_port,
-            shell=True,
-            capture_output=True,
-            timeout=5,
-        )
-        if r.returncode == 0 and r.stdout:
-            print("  Tunnel process: running")
-        else:
-            print("  Tunnel process: NOT running (tunnel đã tắt → kiểm tra SSH từ máy bạn tới OpenVPN)")
-    except Exception:
-        print("  Tunnel process: (check failed)")
+        info = _tunnel_request("get", name=name)
+    except OSError as e:
+        print(f"  Tunnel manager not reachable: {e} (log: {_TUNNEL_LOG})")
+        return
+    if not info:
+        print(f"  Tunnel {name}: not managed (chưa chạy bước port_forward?)")
+        return
+    print(f"  Tunnel {name}: {info['status']} on 127.0.0.1:{info['port']}, restarts {info['restarts']}"
+          + (f", last error: {info['error']}" if info["error"] else ""))
+    _print_log_tail(info["log"])
 
 
 def start_openvpn_port_forward(openvpn_ip, master_private_ip, local_port=None, remote_port=6443, jump_ssh_key_path=None):
-    """SSH tunnel: local:port -> OpenVPN server connects to master:6443 (một bước, ổn định hơn ProxyCommand)."""
+    """Tunnel 127.0.0.1:<port> -> OpenVPN -> master:6443 do tunnel manager giữ (tự reconnect, dùng lại giữa các lần
+    chạy; daemon dựng từ Terraform output của env). local_port = port của forward kiểu cũ cần bỏ (mặc định
+    LOCAL_PORT_BY_ENV). Trả về port local thật, None nếu không lên."""
     if local_port is None:
-        local_port = LOCAL_PORT_BY_ENV.get(TERRAFORM_ENV, 6443)
-    print(f"--- Step 4.5: Starting SSH Port Forward (local:{local_port} -> OpenVPN -> master:{remote_port}) ---")
-    ssh_key_path = jump_ssh_key_path or os.path.abspath(os.path.join(TERRAFORM_ENV_DIR, SSH_KEY_FILE_NAME))
-    log_file = _tunnel_log_path()
+        local_port = current_env().local_port
+    print(f"--- Step 4.5: SSH tunnel (127.0.0.1 -> OpenVPN -> master:{remote_port}) ---")
+    ssh_key_path = jump_ssh_key_path or current_env().ssh_key_path
+    jump = ssh_session(openvpn_ip, ssh_key_path)
+    # Forward kiểu cũ trên master connection (bản trước) còn giữ port ưa thích → bỏ
+    jump.cancel_forward(local_port, master_private_ip, remote_port)
+    port = tunnel("api")
+    if port is None:
+        print("  ✗ Tunnel to API not healthy.")
+        _dump_tunnel_diagnostics()
+        return None
+    print("  Trạng thái tunnel: ./deploy.py tunnels")
+    return port
 
-    try:
-        subprocess.run("pkill -f 'ssh.*%s:.*%s' 2>/dev/null || true" % (local_port, remote_port), shell=True)
-        time.sleep(1)
-    except Exception:
-        pass
 
-    cmd = (
-        f"ssh -i {ssh_key_path} -o IdentitiesOnly=yes -o StrictHostKeyChecking=no "
-        f"-o ConnectTimeout=30 -o ServerAliveInterval=30 "
-        f"-N -L 127.0.0.1:{local_port}:{master_private_ip}:{remote_port} ubuntu@{openvpn_ip}"
-    )
-    with open(log_file, "w") as f:
-        proc = subprocess.Popen(cmd, shell=True, stdout=f, stderr=subprocess.STDOUT)
+def _nlb_health_command(tg_arn):
+    """aws elbv2 hỏi trạng thái target của NLB; None nếu không có ARN."""
+    if not tg_arn:
+        return None
+    # arn:aws:elasticloadbalancing:<region>:<account>:targetgroup/...
+    region = tg_arn.split(":")[3] if tg_arn.count(":") >= 5 else ""
+    return (["aws", "elbv2", "describe-target-health", "--target-group-arn", tg_arn,
+             "--query", "TargetHealthDescriptions[].TargetHealth.State", "--output", "json"]
+            + (["--region", region] if region else []))
+
 
-    time.sleep(5)
-    if proc.poll() is not None:
-        print("  ✗ Port-forward process exited. Log:")
-        _dump_tunnel_diagnostics(local_port)
+def _nlb_target_states(res):
+    """List state từ kết quả _nlb_health_command; None nếu không hỏi được (không có aws CLI, timeout, lỗi)."""
+    if res is None or isinstance(res, Exception) or res.returncode != 0:
         return None
     try:
-        r = subprocess.run(
-            "curl -k -s -o /dev/null -w '%%{http_code}' --connect-timeout 8 https://127.0.0.1:%s/readyz" % local_port,
-            shell=True,
-            capture_output=True,
-            timeout=12,
+        return json.loads(res.stdout or "[]")
+    except ValueError:
+        return None
+
+
+def wait_for_nlb_health_checks(openvpn_ip, nlb_dns, jump_ssh_key_path=None, tg_arn=None, max_wait=300):
+    """Đợi NLB (internal) có target healthy: /readyz qua NLB trả lời từ OpenVPN, hoặc aws elbv2 báo healthy.
+    Cluster đã chạy sẵn → pass ngay lần probe đầu."""
+    print("--- Waiting for NLB to become healthy ---")
+    key_path = jump_ssh_key_path or current_env().ssh_key_path
+    jump = ssh_session(openvpn_ip, key_path)
+    aws_cmd = _nlb_health_command(tg_arn)
+    readyz_cmd = _readyz_command(f"https://{nlb_dns}:6443/readyz")
+    states = None
+
+    def nlb_healthy():
+        nonlocal states
+        jump.ensure_master()
+        # Hỏi AWS và curl /readyz qua NLB cùng lúc (mỗi lần probe tốn một round trip thay vì hai)
+        commands = [(jump.ssh_args() + [jump.target, readyz_cmd], dict(capture_output=True, text=True, timeout=20))]
+        if aws_cmd:
+            commands.append((aws_cmd, dict(capture_output=True, text=True, timeout=20)))
+        results = run_concurrently(*commands)
+        states = _nlb_target_states(results[1] if aws_cmd else None)
+        if states and "healthy" in states:
+            return "targets " + ", ".join(states)
+        # /readyz trả lời qua NLB = có ít nhất một target healthy
+        return "curl " + _readyz_result(results[0])
+
+    ready = wait_until(nlb_healthy, "NLB", timeout=max_wait, max_interval=10)
+    if ready:
+        print(f"  ✓ NLB healthy via {nlb_dns} ({ready.value}, waited {ready.waited:.0f}s)")
+        return True
+    print(f"  ⚠ NLB not healthy after {max_wait}s ({ready.detail or 'no answer'}"
+          + (f", targets: {', '.join(states)}" if states else "") + ").")
+    print("  Deploy dùng tunnel tới master nên vẫn tiếp tục; kiểm tra target group/SG 6443 của NLB nếu cần.")
+    return False
+
+
+# --- Kubernetes API client in-process: đọc kubeconfig một lần, giữ HTTPS keep-alive tới tunnel ---
+class KubeError(Exception):
+    """Non-2xx answer from the Kubernetes API (404 is returned as None by KubeClient instead)."""
+
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}" if status else message)
+        self.status = status
+
+
+# kind → (apiVersion, plural, namespaced) cho các resource deploy.py đụng tới
+_RESOURCES = {
+    "Namespace": ("v1", "namespaces", False),
+    "Node": ("v1", "nodes", False),
+    "Pod": ("v1", "pods", True),
+    "Secret": ("v1", "secrets", True),
+    "ServiceAccount": ("v1", "serviceaccounts", True),
+    "ConfigMap": ("v1", "configmaps", True),
+    "Endpoints": ("v1", "endpoints", True),
+    "Service": ("v1", "services", True),
+    "Deployment": ("apps/v1", "deployments", True),
+    "Job": ("batch/v1", "jobs", True),
+    "StorageClass": ("storage.k8s.io/v1", "storageclasses", False),
+    "CustomResourceDefinition": ("apiextensions.k8s.io/v1", "customresourcedefinitions", False),
+    "ClusterSecretStore": ("external-secrets.io/v1", "clustersecretstores", False),
+    "SecretStore": ("external-secrets.io/v1", "secretstores", True),
+    "ExternalSecret": ("external-secrets.io/v1", "externalsecrets", True),
+    "Application": ("argoproj.io/v1alpha1", "applications", True),
+}
+
+
+def resource_path(kind, namespace=None, name=None, api_version=None):
+    """API path của kind (vd. Pod, ns=argocd → /api/v1/namespaces/argocd/pods[/name])."""
+    default_version, plural, namespaced = _RESOURCES.get(kind, (api_version, kind.lower() + "s", bool(namespace)))
+    api_version = api_version or default_version
+    path = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+    if namespaced and namespace:
+        path += f"/namespaces/{namespace}"
+    path += f"/{plural}"
+    if name:
+        path += f"/{name}"
+    return path
+
+
+class KubeClient:
+    """Minimal Kubernetes API client over a pooled keep-alive HTTPS connection.
+    Reads the kubeconfig once (via kubectl config view) and serves get/list/create/patch/apply/watch."""
+
+    def __init__(self, kubeconfig_path, timeout=30):
+        res = run_process(
+            ["kubectl", "config", "view", "--raw", "--minify", "--flatten", "-o", "json", f"--kubeconfig={kubeconfig_path}"],
+            capture_output=True, text=True, timeout=15,
         )
-        out = (r.stdout or b"").decode().strip()
-        if r.returncode == 0 and out == "200":
-            print("  ✓ Port-forward OK, API reachable via 127.0.0.1:%s (PID %s)" % (local_port, proc.pid))
+        if res.returncode != 0 or not res.stdout.strip():
+            raise KubeError(None, f"cannot load kubeconfig {kubeconfig_path}: {(res.stderr or '').strip()[:200]}")
+        cfg = json.loads(res.stdout)
+        cluster = cfg["clusters"][0]["cluster"]
+        user = (cfg.get("users") or [{"user": {}}])[0].get("user") or {}
+        url = urllib.parse.urlsplit(cluster["server"])
+        self.server = cluster["server"]
+        self.host, self.port = url.hostname, url.port or 443
+        self.timeout = timeout
+        ctx = ssl.create_default_context()
+        if cluster.get("insecure-skip-tls-verify"):
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        elif cluster.get("certificate-authority-data"):
+            ctx.load_verify_locations(cadata=base64.b64decode(cluster["certificate-authority-data"]).decode())
+        if user.get("client-certificate-data") and user.get("client-key-data"):
+            # ssl chỉ nhận cert/key dạng file → file tạm 0600, xóa ngay sau khi load
+            with tempfile.TemporaryDirectory() as td:
+                cert, key = os.path.join(td, "client.crt"), os.path.join(td, "client.key")
+                for path, field in ((cert, "client-certificate-data"), (key, "client-key-data")):
+                    with open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600), "wb") as f:
+                        f.write(base64.b64decode(user[field]))
+                ctx.load_cert_chain(cert, key)
+        self._ctx = ctx
+        self._token = user.get("token")
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout):
+        return http.client.HTTPSConnection(self.host, self.port, context=self._ctx, timeout=timeout)
+
+    def _headers(self, content_type=None):
+        headers = {"Accept": "application/json", "User-Agent": "deploy.py"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        if self._token:
+            headers["Authorization"] = f"Bearer {self._token}"
+        return headers
+
+    def request(self, method, path, body=None, content_type="application/json", params=None):
+        """Một request qua connection trong pool. 404 → None; lỗi khác → KubeError."""
+        if params:
+            path += "?" + urllib.parse.urlencode(params)
+        data = json.dumps(body).encode() if body is not None else None
+        headers = self._headers(content_type if data is not None else None)
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            conn = conn or self._connect(self.timeout)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue  # keep-alive connection đã bị server đóng → thử lại với connection mới
+                raise
+            break
+        if resp.will_close:
+            conn.close()
         else:
-            print("  ⚠ Tunnel up but /readyz returned: %s. Log: %s" % (out or "timeout/error", log_file))
-    except Exception as e:
-        print("  ⚠ Tunnel verify failed: %s. Log: %s" % (e, log_file))
-    print("  Logs: %s" % log_file)
-    return proc
+            with self._lock:
+                self._idle.append(conn)
+        if resp.status == 404:
+            return None
+        if resp.status >= 400:
+            try:
+                message = json.loads(payload).get("message", "")
+            except ValueError:
+                message = payload.decode(errors="replace")[:200]
+            raise KubeError(resp.status, message)
+        if not payload:
+            return {}
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return payload.decode(errors="replace")
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def exists(self, path):
+        return self.get(path) is not None
+
+    def list(self, path, label_selector=None, field_selector=None):
+        params = {}
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        return self.request("GET", path, params=params) or {"items": [], "metadata": {}}
+
+    def create(self, path, obj):
+        return self.request("POST", path, body=obj)
+
+    def patch(self, path, patch, patch_type="merge"):
+        content_type = {
+            "merge": "application/merge-patch+json",
+            "strategic": "application/strategic-merge-patch+json",
+            "json": "application/json-patch+json",
+        }[patch_type]
+        return self.request("PATCH", path, body=patch, content_type=content_type)
+
+    def apply(self, obj, field_manager="deploy-py"):
+        """Server-side apply một object (JSON là YAML hợp lệ cho apply-patch+yaml)."""
+        meta = obj["metadata"]
+        path = resource_path(obj["kind"], meta.get("namespace"), meta["name"], api_version=obj["apiVersion"])
+        return self.request("PATCH", path, body=obj, content_type="application/apply-patch+yaml",
+                            params={"fieldManager": field_manager, "force": "true"})
+
+    def watch(self, path, resource_version=None, timeout=30, label_selector=None, field_selector=None):
+        """Generator các watch event (connection riêng, server đóng stream sau timeout giây)."""
+        params = {"watch": "1", "timeoutSeconds": str(max(1, int(timeout))), "allowWatchBookmarks": "true"}
+        if resource_version:
+            params["resourceVersion"] = resource_version
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        conn = self._connect(timeout + 15)
+        with _watch_conns_lock:
+            _watch_conns.add(conn)
+        try:
+            conn.request("GET", path + "?" + urllib.parse.urlencode(params), headers=self._headers())
+            resp = conn.getresponse()
+            if resp.status >= 400:
+                raise KubeError(resp.status, resp.read().decode(errors="replace")[:200])
+            while True:
+                line = resp.readline()
+                if not line:
+                    return
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            with _watch_conns_lock:
+                _watch_conns.discard(conn)
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# path → (mtime_ns của kubeconfig lúc đọc, KubeClient): tunnel restart sang port mới → _create_tunnel_kubeconfig ghi
+# lại file → client mới đọc host:port mới
+_kube_clients = {}
+_kube_clients_lock = threading.Lock()
+# Connection của các watch đang mở: cancel_processes() đóng chúng để watch_until không đợi hết stream
+_watch_conns = set()
+_watch_conns_lock = threading.Lock()
+
+
+def _close_watches():
+    with _watch_conns_lock:
+        conns = list(_watch_conns)
+    for conn in conns:
+        try:
+            if conn.sock is not None:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
-def wait_for_nlb_health_checks():
-    print("--- Waiting for NLB to become healthy ---")
-    print("  NLB health checks can take 1-2 minutes to pass...")
-    print("  This is normal - NLB needs time to register healthy targets...")
-    time.sleep(120)  # Tăng thời gian đợi lên 2 phút
+def kube_client(kubeconfig_path=None):
+    """KubeClient dùng chung theo kubeconfig (mặc định: kubeconfig tunnel của deploy); file đổi → client mới."""
+    path = os.path.abspath(kubeconfig_path or _kubeconfig_for_deploy())
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    with _kube_clients_lock:
+        cached = _kube_clients.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _kube_clients[path] = (mtime, KubeClient(path))
+        return cached[1]
+
+
+# --- Watch: list + một watch stream mỗi wait, thức dậy đúng event làm điều kiện thành true ---
+def watch_until(kind, predicate, what, client=None, namespace=None, selector=None, name=None, timeout=300,
+                deadline=None, progress_every=30):
+    """Đợi predicate(objects) đúng, objects = {name: object} hiện tại của kind (theo namespace/selector/name).
+    List một lần rồi watch từ resourceVersion đó; stream hết hạn/đứt thì list + watch lại (backoff khi lỗi).
+    deadline (Deadline) / _RUN_DEADLINE giới hạn thêm timeout; hết ngân sách / pipeline bị huỷ → raise như
+    wait_until (cancel_processes đóng cả stream watch đang mở). Không truyền client → mỗi lần list lại lấy
+    kube_client() mới nhất (tunnel đổi port giữa chừng vẫn theo kịp)."""
+    kubeconfig_path = None if client else _kubeconfig_for_deploy()
+    path = resource_path(kind, namespace)
+    field_selector = f"metadata.name={name}" if name else None
+    start = time.monotonic()
+    limit = timeout
+    for budget in (deadline, _RUN_DEADLINE):
+        if budget is not None:
+            limit = min(limit, budget.remaining())
+    expires = start + limit
+    streams, failures, detail, value = 0, 0, "", None
+    objects = {}
+    next_progress = progress_every
+    while value is None:
+        if _CANCEL.is_set():
+            detail = "cancelled"
+            break
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            kube = client or kube_client(kubeconfig_path)
+            listed = kube.list(path, label_selector=selector, field_selector=field_selector)
+            objects = {o["metadata"]["name"]: o for o in listed.get("items") or []}
+            value = predicate(objects) or None
+            if value is not None:
+                break
+            streams += 1
+            # Watch ngắn (≤ progress_every) để in progress đều và list lại định kỳ
+            for event in kube.watch(path, listed.get("metadata", {}).get("resourceVersion"),
+                                      timeout=min(remaining, progress_every),
+                                      label_selector=selector, field_selector=field_selector):
+                etype, obj = event.get("type"), event.get("object") or {}
+                if etype == "ERROR":
+                    detail = obj.get("message", "watch error")  # vd. 410 Gone → list lại
+                    break
+                if _CANCEL.is_set():
+                    break
+                if etype == "BOOKMARK":
+                    continue
+                key = obj.get("metadata", {}).get("name", "")
+                if etype == "DELETED":
+                    objects.pop(key, None)
+                elif key:
+                    objects[key] = obj
+                value = predicate(objects) or None
+                if value is not None:
+                    break
+            failures = 0
+        except (KubeError, OSError, http.client.HTTPException, ValueError) as e:
+            if _CANCEL.is_set():
+                continue  # stream bị cancel_processes đóng
+            failures += 1
+            detail = f"{type(e).__name__}: {e}"
+            if _CANCEL.wait(min(2 ** failures, 10, max(0.0, expires - time.monotonic()))):
+                continue
+        elapsed = time.monotonic() - start
+        if value is None and elapsed >= next_progress:
+            print(f"  Still waiting for {what}... ({elapsed:.0f}s, {len(objects)} object(s)"
+                  + (f": {detail[:120]}" if detail else "") + ")")
+            next_progress += progress_every
+    result = WaitResult(value is not None, value, time.monotonic() - start, streams, detail)
+    _record_wait(what + " (watch)", result, 0.0, limit)
+    _raise_if_aborted(what, result, limit < timeout)
+    return result
+
+
+def _pods_ready(objects):
+    """Có ít nhất một pod mà container đầu tiên ready (giống jsonpath containerStatuses[0].ready cũ)."""
+    return any(((pod.get("status") or {}).get("containerStatuses") or [{}])[0].get("ready") for pod in objects.values())
+
+
+def _pods_running(objects):
+    return any((pod.get("status") or {}).get("phase") == "Running" for pod in objects.values())
+
+
+def _crd_established(objects):
+    return any(
+        c.get("type") == "Established" and c.get("status") == "True"
+        for crd in objects.values()
+        for c in (crd.get("status") or {}).get("conditions") or []
+    )
+
+
+def _endpoints_ready(objects):
+    return any(subset.get("addresses") for ep in objects.values() for subset in ep.get("subsets") or [])
+
+
+def _exists(objects):
+    return bool(objects)
 
 
 def wait_for_k8s_api(kubeconfig_path, max_wait=120):
     """Đợi API server qua tunnel (API đã được kiểm tra từ OpenVPN trước khi mở tunnel)."""
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
     print("  Waiting for Kubernetes API server to be accessible (via tunnel)...")
-    waited = 0
-    last_error = ""
-    while waited < max_wait:
-        res = subprocess.run(
-            f"kubectl --kubeconfig={kubeconfig_path} get nodes --request-timeout=15s",
-            shell=True,
-            capture_output=True,
-            env=env,
-            timeout=25,
-        )
-        if res.returncode == 0:
-            print(f"  ✓ API server is accessible (waited {waited}s)")
-            return True
-        
-        err = (res.stderr or b"").decode(errors="ignore").strip()
-        if err and err != last_error:
-            last_error = err
-            if waited % 30 == 0:
-                print(f"  Still waiting... ({err[:150]})")
-        
-        time.sleep(10)
-        waited += 10
-    
+    ready = wait_until(
+        lambda: kube_client(kubeconfig_path).list(resource_path("Node")),
+        "Kubernetes API (tunnel)", timeout=max_wait,
+    )
+    if ready:
+        print(f"  ✓ API server is accessible (waited {ready.waited:.0f}s)")
+        return True
+
     print("  ⚠ API server not accessible after %ds" % max_wait)
-    if last_error:
-        print("  Last error: %s" % last_error[:200])
-    local_port = LOCAL_PORT_BY_ENV.get(TERRAFORM_ENV, 6443)
-    _dump_tunnel_diagnostics(local_port)
+    if ready.detail:
+        print("  Last error: %s" % ready.detail[:200])
+    _dump_tunnel_diagnostics()
     print("  Continuing anyway...")
     return False
 
 
+# --- Bundled apply: manifest của một step → một stream YAML, một lần `kubectl apply --server-side` ---
+# Thứ tự theo dependency: namespace → CRD → store → secret/config → ExternalSecret → ArgoCD Application.
+_APPLY_ORDER = {"Namespace": 0, "CustomResourceDefinition": 1, "ClusterSecretStore": 2, "SecretStore": 2,
+                "Secret": 3, "ConfigMap": 3, "ExternalSecret": 4, "AppProject": 4, "Application": 5}
+
+
+def namespace_manifest(name):
+    return f"apiVersion: v1\nkind: Namespace\nmetadata:\n  name: {name}\n"
+
+
+def _manifest_documents(text):
+    """Các document YAML (tách theo ---) có kind; comment / document rỗng bỏ qua."""
+    return [doc.strip() + "\n" for doc in re.split(r"^---[^\n]*$", text, flags=re.M) if re.search(r"^kind:", doc, re.M)]
+
+
+def _document_kind(doc):
+    return re.search(r"^kind:\s*(\S+)", doc, re.M).group(1)
+
+
+def apply_bundle(what, paths=(), documents=(), kubeconfig_path=None, timeout=60):
+    """Gom manifest từ paths (file hoặc thư mục *.yaml) + documents (YAML string), sắp theo _APPLY_ORDER,
+    apply một lần (server-side, field manager deploy-py). In kết quả từng object.
+    Trả về (applied, errors): list "kind/name <result>" và list dòng lỗi của kubectl."""
+    docs = []
+    for path in paths:
+        files = ([os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith((".yaml", ".yml"))]
+                 if os.path.isdir(path) else [path])
+        for file_path in files:
+            with open(file_path) as f:
+                docs += _manifest_documents(f.read())
+    for doc in documents:
+        docs += _manifest_documents(doc)
+    if not docs:
+        print(f"  ⚠ {what}: no manifests to apply.")
+        return [], []
+    # sorted() ổn định: cùng bậc thì giữ thứ tự file
+    docs.sort(key=lambda doc: _APPLY_ORDER.get(_document_kind(doc), 3))
+    print(f"  Applying {what}: {len(docs)} object(s) in one server-side apply...")
+    env = os.environ.copy()
+    env["KUBECONFIG"] = kubeconfig_path or _kubeconfig_for_deploy()
+    try:
+        res = run_process(
+            ["kubectl", "apply", "--server-side", "--force-conflicts", "--field-manager=deploy-py", "-f", "-"],
+            input="---\n".join(docs), env=env, cwd=_SCRIPT_DIR, capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        print(f"  ✗ {what}: kubectl apply timed out after {timeout}s.")
+        return [], [f"timeout after {timeout}s"]
+    # kubectl apply tiếp tục với object sau khi một object lỗi: stdout = object đã apply, stderr = lỗi
+    applied = [line.strip() for line in res.stdout.splitlines() if line.strip()]
+    errors = [line.strip() for line in res.stderr.splitlines() if line.strip() and not line.startswith("Warning:")]
+    for line in applied:
+        print(f"    ✓ {line}")
+    for line in errors:
+        print(f"    ✗ {line[:300]}")
+    if res.returncode != 0 and not errors:
+        errors = [f"kubectl exit {res.returncode}"]
+    return applied, errors
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def helm_chart(name):
+    """Path tarball local của chart pin trong HELM_CHARTS (pull một lần, kiểm tra sha256 mỗi lần dùng).
+    Không cần `helm repo add/update`: cache hit = không gọi tới chart repo."""
+    repo_url, chart, version = HELM_CHARTS[name]
+    os.makedirs(_HELM_CACHE_DIR, exist_ok=True)
+    tarball = os.path.join(_HELM_CACHE_DIR, f"{chart}-{version}.tgz")
+    lock_path = os.path.join(_HELM_CACHE_DIR, "charts.lock.json")
+    # flock: dev/prod (process riêng) và các step song song không pull cùng một chart hai lần
+    with open(os.path.join(_HELM_CACHE_DIR, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(lock_path) as f:
+                pinned = json.load(f)
+        except (OSError, ValueError):
+            pinned = {}
+        entry = pinned.get(name) or {}
+        if entry.get("version") == version and os.path.isfile(tarball) and _sha256(tarball) == entry.get("sha256"):
+            return tarball
+        print(f"  Pulling Helm chart {chart} {version} (cache miss)...")
+        # Không giữ index.yaml của repo: `helm pull --repo` luôn tải index mới (và xoá sau khi dùng), mà chỉ cache
+        # miss (đổi version) mới cần index — index cũ không có version mới. --repository-cache chỉ để helm không
+        # ghi vào ~/.cache/helm.
+        run_command(
+            f"helm pull {chart} --repo {repo_url} --version {version} --destination {_HELM_CACHE_DIR} "
+            f"--repository-cache {os.path.join(_HELM_CACHE_DIR, 'repository')}",
+            timeout=300,
+        )
+        pinned[name] = {"repo": repo_url, "chart": chart, "version": version, "sha256": _sha256(tarball)}
+        tmp = f"{lock_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(pinned, f, indent=2, sort_keys=True)
+        os.replace(tmp, lock_path)
+        return tarball
+
+
 def install_ebs_csi_driver():
     """Installs AWS EBS CSI Driver for EBS volume support."""
     print("--- Step 5.6: Installing AWS EBS CSI Driver ---")
@@ -527,35 +2640,20 @@ def install_ebs_csi_driver():
 
     # Create ServiceAccount for EBS CSI controller (required when serviceAccount.create=false)
     print("  Creating ServiceAccount for EBS CSI controller...")
-    sa_exists = subprocess.run(
-        f"kubectl --kubeconfig={kubeconfig_path} get serviceaccount ebs-csi-controller-sa -n kube-system",
-        shell=True,
-        env=env,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    if sa_exists.returncode != 0:
-        run_command(
-            f"kubectl --kubeconfig={kubeconfig_path} create serviceaccount ebs-csi-controller-sa -n kube-system",
-            cwd=HELM_DIR,
-            env=env,
-        )
+    kube = kube_client(kubeconfig_path)
+    sa_path = resource_path("ServiceAccount", "kube-system")
+    if not kube.exists(f"{sa_path}/ebs-csi-controller-sa"):
+        kube.create(sa_path, {
+            "apiVersion": "v1", "kind": "ServiceAccount",
+            "metadata": {"name": "ebs-csi-controller-sa", "namespace": "kube-system"},
+        })
         print("  ✓ ServiceAccount created")
     else:
         print("  ✓ ServiceAccount already exists")
 
-    print("  Adding AWS EBS CSI Driver Helm repository...")
-    run_command("helm repo add aws-ebs-csi-driver https://kubernetes-sigs.github.io/aws-ebs-csi-driver", cwd=HELM_DIR, env=env)
-    # Update only the EBS CSI driver repo to avoid timeout issues with other repos
-    print("  Updating EBS CSI Driver Helm repository...")
-    result = subprocess.run("helm repo update aws-ebs-csi-driver", shell=True, cwd=HELM_DIR, env=env, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"  ⚠️  Warning: helm repo update failed (non-critical): {result.stderr}")
-        print("  Continuing anyway...")
-
     print("  Installing AWS EBS CSI Driver...")
     run_command(
-        f"helm upgrade --install aws-ebs-csi-driver aws-ebs-csi-driver/aws-ebs-csi-driver "
+        f"helm upgrade --install aws-ebs-csi-driver {helm_chart('aws-ebs-csi-driver')} "
         f"--namespace kube-system --create-namespace "
         f"--set controller.serviceAccount.create=false "
         f"--set controller.serviceAccount.name=ebs-csi-controller-sa "
@@ -565,44 +2663,26 @@ def install_ebs_csi_driver():
         env=env,
     )
 
-    print("  Waiting for EBS CSI Driver pods to be ready...")
-    waited = 0
-    while waited < 300:
-        try:
-            result = subprocess.run(
-                f"kubectl --kubeconfig={kubeconfig_path} get pods -n kube-system "
-                f"-l app=ebs-csi-controller -o jsonpath='{{.items[*].status.phase}}'",
-                shell=True,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=10,
-            )
-            if "Running" in (result.stdout or ""):
-                print(f"  ✓ EBS CSI Driver is ready (waited {waited}s)")
-                break
-        except Exception:
-            pass
-        time.sleep(10)
-        waited += 10
-
-    if waited >= 300:
+    print("  Waiting for EBS CSI Driver pods to be ready...")
+    ready = watch_until(
+        "Pod", _pods_running, "EBS CSI controller pods", kube,
+        namespace="kube-system", selector="app=ebs-csi-controller", timeout=300,
+    )
+    if ready:
+        print(f"  ✓ EBS CSI Driver is ready (waited {ready.waited:.0f}s)")
+
+    if not ready:
         print("  ⚠️  Warning: EBS CSI Driver pods may still be starting. Check with: kubectl get pods -n kube-system | grep ebs-csi")
     else:
         print("  ✓ EBS CSI Driver installed successfully.")
 
     # Remove default annotation from local-path if it exists (from previous deployments)
     print("  Removing default annotation from local-path storage class (if exists)...")
-    result = subprocess.run(
-        f"kubectl --kubeconfig={kubeconfig_path} patch storageclass local-path "
-        f"-p '{{\"metadata\": {{\"annotations\":{{\"storageclass.kubernetes.io/is-default-class\":\"false\"}}}}}}'",
-        shell=True,
-        cwd=HELM_DIR,
-        env=env,
-        capture_output=True,
-        text=True,
+    patched = kube.patch(
+        resource_path("StorageClass", name="local-path"),
+        {"metadata": {"annotations": {"storageclass.kubernetes.io/is-default-class": "false"}}},
     )
-    if result.returncode == 0:
+    if patched is not None:
         print("  ✓ Removed default annotation from local-path")
     else:
         # local-path may not exist, which is fine
@@ -614,18 +2694,8 @@ def install_ebs_csi_driver():
 
 def ensure_rancher_tls_secret():
     """Create a self-signed TLS secret for rancher ingress (idempotent)."""
-    kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
-
-    exists = subprocess.run(
-        "kubectl -n cattle-system get secret tls-rancher-ingress",
-        shell=True,
-        env=env,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    if exists.returncode == 0:
+    kube = kube_client()
+    if kube.exists(resource_path("Secret", "cattle-system", "tls-rancher-ingress")):
         return
 
     print("  Creating self-signed TLS secret for Rancher ingress (tls-rancher-ingress)...")
@@ -637,12 +2707,15 @@ def ensure_rancher_tls_secret():
             f"-keyout {key} -out {crt} -subj \"/CN={RANCHER_HOSTNAME}\"",
             timeout=60,
         )
-        run_command(
-            f"kubectl -n cattle-system create secret tls tls-rancher-ingress "
-            f"--cert={crt} --key={key} --dry-run=client -o yaml | kubectl apply -f -",
-            env=env,
-            timeout=60,
-        )
+        data = {}
+        for field, path in (("tls.crt", crt), ("tls.key", key)):
+            with open(path, "rb") as f:
+                data[field] = base64.b64encode(f.read()).decode()
+    kube.apply({
+        "apiVersion": "v1", "kind": "Secret", "type": "kubernetes.io/tls",
+        "metadata": {"name": "tls-rancher-ingress", "namespace": "cattle-system"},
+        "data": data,
+    })
 
 
 def install_rancher():
@@ -656,16 +2729,9 @@ def install_rancher():
     print("  Installing cert-manager CRDs (required by Rancher)...")
     run_command(f"kubectl --kubeconfig={kubeconfig_path} apply -f {CERT_MANAGER_CRDS_URL}", cwd=HELM_DIR, env=env, timeout=120)
 
-    run_command("helm repo add rancher-latest https://releases.rancher.com/server-charts/latest", cwd=HELM_DIR, env=env)
-    # Update only the Rancher repo to avoid timeout issues with other repos
-    result = subprocess.run("helm repo update rancher-latest", shell=True, cwd=HELM_DIR, env=env, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"  ⚠️  Warning: helm repo update failed (non-critical): {result.stderr}")
-        print("  Continuing anyway...")
-
     print("  Installing Rancher Helm chart...")
     run_command(
-        f"helm upgrade --install rancher rancher-latest/rancher "
+        f"helm upgrade --install rancher {helm_chart('rancher')} "
         f"--namespace cattle-system --create-namespace "
         f"--set hostname={RANCHER_HOSTNAME} "
         f"--set bootstrapPassword={RANCHER_BOOTSTRAP_PASSWORD} "
@@ -688,16 +2754,9 @@ def install_argocd():
     env = os.environ.copy()
     env["KUBECONFIG"] = kubeconfig_path
 
-    run_command("helm repo add argo https://argoproj.github.io/argo-helm", cwd=HELM_DIR, env=env)
-    # Update only the ArgoCD repo to avoid timeout issues with other repos
-    result = subprocess.run("helm repo update argo", shell=True, cwd=HELM_DIR, env=env, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"  ⚠️  Warning: helm repo update failed (non-critical): {result.stderr}")
-        print("  Continuing anyway...")
-
     argocd_values_path = os.path.abspath("./argocd/values-nodeselector.yaml")
     run_command(
-        f"helm upgrade --install argocd argo/argo-cd "
+        f"helm upgrade --install argocd {helm_chart('argo-cd')} "
         f"--namespace argocd --create-namespace "
         f"--values {argocd_values_path} "
         f"--timeout 10m",
@@ -710,29 +2769,13 @@ def install_argocd():
 def wait_for_argocd_ready():
     """Waits for ArgoCD server to be ready."""
     print("  Waiting for ArgoCD server to be ready...")
-    kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
-
-    waited = 0
-    while waited < 300:
-        try:
-            result = subprocess.run(
-                "kubectl get pods -n argocd -l app.kubernetes.io/name=argocd-server "
-                "-o jsonpath='{.items[*].status.containerStatuses[0].ready}'",
-                shell=True,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=10,
-            )
-            if "true" in (result.stdout or ""):
-                print(f"  ✓ ArgoCD server is ready (waited {waited}s)")
-                return True
-        except Exception:
-            pass
-        time.sleep(10)
-        waited += 10
+    ready = watch_until(
+        "Pod", _pods_ready, "ArgoCD server", kube_client(),
+        namespace="argocd", selector="app.kubernetes.io/name=argocd-server", timeout=300,
+    )
+    if ready:
+        print(f"  ✓ ArgoCD server is ready (waited {ready.waited:.0f}s)")
+        return True
 
     print("  ⚠ ArgoCD not ready after 300s, proceeding anyway")
     return False
@@ -746,45 +2789,20 @@ def install_external_secrets_operator():
     env["KUBECONFIG"] = kubeconfig_path
 
     # Check if already installed
-    res = subprocess.run(
-        "kubectl get namespace external-secrets --request-timeout=5s 2>/dev/null && "
-        "kubectl get deploy -n external-secrets external-secrets -o name 2>/dev/null",
-        shell=True,
-        env=env,
-        capture_output=True,
-        text=True,
-        timeout=10,
-    )
-    if res.returncode == 0 and "external-secrets" in (res.stdout or ""):
+    kube = kube_client(kubeconfig_path)
+    if kube.exists(resource_path("Deployment", "external-secrets", "external-secrets")):
         print("  ✓ External Secrets Operator already installed.")
         return
 
-    run_command("helm repo add external-secrets https://charts.external-secrets.io", cwd=_SCRIPT_DIR, env=env, timeout=30)
-    run_command("helm repo update external-secrets", cwd=_SCRIPT_DIR, env=env, timeout=60)
     run_command(
-        "helm upgrade --install external-secrets external-secrets/external-secrets "
+        f"helm upgrade --install external-secrets {helm_chart('external-secrets')} "
         "-n external-secrets --create-namespace --set installCRDs=true --timeout 5m",
         cwd=_SCRIPT_DIR,
         env=env,
         timeout=360,
     )
     print("  ✓ External Secrets Operator installed. Waiting for CRDs to be ready...")
-    crd_name = "clustersecretstores.external-secrets.io"
-    for waited in range(0, 120, 5):
-        res = subprocess.run(
-            f"kubectl get crd {crd_name} --request-timeout=5s 2>/dev/null",
-            shell=True,
-            env=env,
-            capture_output=True,
-            timeout=10,
-        )
-        if res.returncode == 0:
-            print(f"  ✓ CRD {crd_name} ready (waited {waited}s).")
-            break
-        if waited % 15 == 0 and waited > 0:
-            print(f"  Still waiting for CRDs... ({waited}s)")
-        time.sleep(5)
-    else:
+    if not _wait_for_external_secrets_crd(kube):
         print("  ⚠ CRD may not be ready yet; apply SecretStore later if it fails.")
 
 
@@ -793,18 +2811,8 @@ def ensure_aws_secrets_credentials():
     Tự động lấy từ Terraform output (eso_access_key_id, eso_secret_access_key) do Terraform IAM module tạo.
     Fallback: env AWS_ACCESS_KEY_ID + AWS_SECRET_ACCESS_KEY."""
     print("--- Step 7.5b: AWS credentials for External Secrets ---")
-    kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
-
-    res = subprocess.run(
-        "kubectl get secret aws-secrets-credentials -n external-secrets --request-timeout=5s 2>/dev/null",
-        shell=True,
-        env=env,
-        capture_output=True,
-        timeout=10,
-    )
-    if res.returncode == 0:
+    kube = kube_client()
+    if kube.exists(resource_path("Secret", "external-secrets", "aws-secrets-credentials")):
         print("  ✓ Secret aws-secrets-credentials already exists.")
         return
 
@@ -813,163 +2821,113 @@ def ensure_aws_secrets_credentials():
 
     # Tự động lấy từ Terraform output (IAM user ESO do Terraform tạo)
     if not access or not secret_val:
-        out_ak = subprocess.run(
-            ["terraform", "-chdir=environments/" + TERRAFORM_ENV, "output", "-raw", "eso_access_key_id"],
-            cwd=TERRAFORM_DIR,
-            capture_output=True,
-            text=True,
-            timeout=15,
-        )
-        out_sk = subprocess.run(
-            ["terraform", "-chdir=environments/" + TERRAFORM_ENV, "output", "-raw", "eso_secret_access_key"],
-            cwd=TERRAFORM_DIR,
-            capture_output=True,
-            text=True,
-            timeout=15,
-        )
-        if out_ak.returncode == 0 and out_sk.returncode == 0 and out_ak.stdout and out_sk.stdout:
-            access = out_ak.stdout.strip()
-            secret_val = out_sk.stdout.strip()
-            if access and secret_val:
-                print("  Using ESO credentials from Terraform output (IAM user created by Terraform).")
+        try:
+            access = (terraform_output("eso_access_key_id") or "").strip()
+            secret_val = (terraform_output("eso_secret_access_key") or "").strip()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError, ValueError):
+            access, secret_val = "", ""
+        if access and secret_val:
+            print("  Using ESO credentials from Terraform output (IAM user created by Terraform).")
 
     if access and secret_val:
-        # Don't pass credentials via command line (would show in logs); use stdin for kubectl
-        yaml_out = subprocess.run(
-            [
-                "kubectl", "create", "secret", "generic", "aws-secrets-credentials",
-                "-n", "external-secrets",
-                "--from-literal=access-key=" + access,
-                "--from-literal=secret-access-key=" + secret_val,
-                "--dry-run=client", "-o", "yaml",
-            ],
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=15,
-        )
-        if yaml_out.returncode != 0:
-            print("  ⚠ Failed to create aws-secrets-credentials:", yaml_out.stderr)
-            return
-        apply_out = subprocess.run(
-            ["kubectl", "apply", "-f", "-"],
-            input=yaml_out.stdout,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=15,
-        )
-        if apply_out.returncode != 0:
-            print("  ⚠ kubectl apply failed:", apply_out.stderr)
+        # Gửi thẳng qua API (không qua command line/log của kubectl)
+        try:
+            kube.apply({
+                "apiVersion": "v1", "kind": "Secret", "type": "Opaque",
+                "metadata": {"name": "aws-secrets-credentials", "namespace": "external-secrets"},
+                "stringData": {"access-key": access, "secret-access-key": secret_val},
+            })
+        except KubeError as e:
+            print("  ⚠ Failed to create aws-secrets-credentials:", e)
         else:
             print("  ✓ Created aws-secrets-credentials (from Terraform output or env).")
         return
 
     print("  ⚠ Secret aws-secrets-credentials not found. ESO needs it to read AWS Secrets Manager.")
-    print("  Chạy lại: ./deploy.py", TERRAFORM_ENV, "(deploy đã chạy Terraform ở đầu, ESO IAM user sẽ có trong output)")
+    print("  Chạy lại: ./deploy.py", current_env().env, "(deploy đã chạy Terraform ở đầu, ESO IAM user sẽ có trong output)")
     print("  Hoặc tạo tay: kubectl create secret generic aws-secrets-credentials -n external-secrets \\")
     print('    --from-literal=access-key="..." --from-literal=secret-access-key="..."')
 
 
-def _wait_for_external_secrets_crd(env, timeout=120):
+def _wait_for_external_secrets_crd(kube=None, timeout=120):
     """Chờ CRD ClusterSecretStore có sẵn (cần khi ESO đã cài từ trước, không chạy bước install)."""
     crd_name = "clustersecretstores.external-secrets.io"
-    for waited in range(0, timeout, 5):
-        res = subprocess.run(
-            f"kubectl get crd {crd_name} --request-timeout=5s 2>/dev/null",
-            shell=True,
-            env=env,
-            capture_output=True,
-            timeout=10,
-        )
-        if res.returncode == 0:
-            if waited > 0:
-                print(f"  ✓ CRD {crd_name} ready (waited {waited}s).")
-            return True
-        if waited % 15 == 0 and waited > 0:
-            print(f"  Waiting for External Secrets CRDs... ({waited}s)")
-        time.sleep(5)
-    return False
+    ready = watch_until(
+        "CustomResourceDefinition", _crd_established, f"CRD {crd_name}", kube,
+        name=crd_name, timeout=timeout, progress_every=15,
+    )
+    if ready and ready.attempts:
+        print(f"  ✓ CRD {crd_name} ready (waited {ready.waited:.0f}s).")
+    return ready.ok
 
 
 def apply_external_secrets_manifests():
     """Apply ClusterSecretStore + ExternalSecret cho env hiện tại (database + backend)."""
     print("--- Step 7.5c: Applying External Secrets (SecretStore + ExternalSecret) ---")
     kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
 
     # Luôn chờ CRD sẵn sàng trước khi apply (kể cả khi ESO "already installed" từ lần chạy trước)
-    if not _wait_for_external_secrets_crd(env):
+    kube = kube_client(kubeconfig_path)
+    if not _wait_for_external_secrets_crd(kube):
         print("  ⚠ ClusterSecretStore CRD not ready after 2 min. Skipping SecretStore/ExternalSecret apply.")
         print("     Chạy lại sau: kubectl apply -f external-secrets/secretstore.yaml")
         return
 
     # Webhook phải có endpoint thì apply ClusterSecretStore mới qua validation (no endpoints available)
     print("  Waiting for External Secrets webhook to be ready...")
-    for waited in range(0, 120, 5):
-        r = subprocess.run(
-            "kubectl get endpoints external-secrets-webhook -n external-secrets -o jsonpath='{.subsets[*].addresses[*].ip}' 2>/dev/null",
-            shell=True,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=10,
-        )
-        if r.returncode == 0 and (r.stdout or "").strip():
-            if waited > 0:
-                print(f"  ✓ Webhook ready (waited {waited}s).")
-            break
-        if waited % 15 == 0 and waited > 0:
-            print(f"  Still waiting for webhook... ({waited}s)")
-        time.sleep(5)
-    else:
+    ready = watch_until(
+        "Endpoints", _endpoints_ready, "External Secrets webhook endpoints", kube,
+        namespace="external-secrets", name="external-secrets-webhook", timeout=120, progress_every=15,
+    )
+    if ready and ready.attempts:
+        print(f"  ✓ Webhook ready (waited {ready.waited:.0f}s).")
+    elif not ready:
         print("  ⚠ Webhook may not be ready; apply may fail with 'no endpoints available'.")
 
     ext_dir = os.path.join(_SCRIPT_DIR, "external-secrets")
     store_path = os.path.join(ext_dir, "secretstore.yaml")
-    env_dir = os.path.join(ext_dir, "environments", TERRAFORM_ENV)
+    env_name = current_env().env
+    env_dir = os.path.join(ext_dir, "environments", env_name)
     if not os.path.isfile(store_path):
         print(f"  ⚠ {store_path} not found, skipping.")
         return
-    run_command(f"kubectl apply -f {store_path}", cwd=_SCRIPT_DIR, env=env, timeout=15)
     # ExternalSecret cần namespace tồn tại trước (backend → meo-stationery, database → database)
-    for ns in ("meo-stationery", "database"):
-        subprocess.run(
-            f"kubectl create namespace {ns} --dry-run=client -o yaml | kubectl apply -f -",
-            shell=True,
-            cwd=_SCRIPT_DIR,
-            env=env,
-            timeout=10,
-            capture_output=True,
-        )
-    if os.path.isdir(env_dir):
-        for f in sorted(os.listdir(env_dir)):
-            if f.endswith(".yaml"):
-                run_command(f"kubectl apply -f {os.path.join(env_dir, f)}", cwd=_SCRIPT_DIR, env=env, timeout=15)
-    print("  ✓ External Secrets manifests applied for env:", TERRAFORM_ENV)
+    _, errors = apply_bundle(
+        "External Secrets manifests",
+        paths=[store_path] + ([env_dir] if os.path.isdir(env_dir) else []),
+        documents=[namespace_manifest(ns) for ns in ("meo-stationery", "database")],
+        kubeconfig_path=kubeconfig_path,
+    )
+    if errors:
+        sys.exit(1)
+    print("  ✓ External Secrets manifests applied for env:", env_name)
 
 
 def deploy_argocd_applications():
     """Deploys ArgoCD Application manifests for GitOps."""
     print("--- Step 7.6: Deploying ArgoCD Applications ---")
     kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
 
     wait_for_argocd_ready()
-    print("  Waiting additional 10 seconds for ArgoCD components...")
-    time.sleep(10)
+    # Thay cho sleep 10s cố định: Application CRD phải có thì kubectl apply mới qua
+    watch_until("CustomResourceDefinition", _crd_established, "ArgoCD Application CRD", kube_client(kubeconfig_path),
+                name="applications.argoproj.io", timeout=60)
 
-    argocd_env_dir = os.path.join(_SCRIPT_DIR, "argocd", "environments", TERRAFORM_ENV)
+    env_name = current_env().env
+    argocd_env_dir = os.path.join(_SCRIPT_DIR, "argocd", "environments", env_name)
     if not os.path.isdir(argocd_env_dir):
-        print(f"  Error: argocd/environments/{TERRAFORM_ENV}/ not found.")
+        print(f"  Error: argocd/environments/{env_name}/ not found.")
+        sys.exit(1)
+    _, errors = apply_bundle(
+        "ArgoCD Applications",
+        paths=[os.path.join(argocd_env_dir, "be-application.yaml"), os.path.join(argocd_env_dir, "data-application.yaml")],
+        kubeconfig_path=kubeconfig_path,
+    )
+    if errors:
         sys.exit(1)
-    run_command("kubectl apply -f be-application.yaml", cwd=argocd_env_dir, env=env)
-    run_command("kubectl apply -f data-application.yaml", cwd=argocd_env_dir, env=env)
-    print("  ✓ ArgoCD Applications deployed (argocd/environments/{}/).".format(TERRAFORM_ENV))
+    print("  ✓ ArgoCD Applications deployed (argocd/environments/{}/).".format(env_name))
     print("  📝 GitOps Repo: https://github.com/minhtri1612/learning_RKE2.git")
-    print("  📌 Để apply từ master: clone repo có argocd/environments/, rồi ./scripts/apply-argocd-apps.sh {}".format(TERRAFORM_ENV))
+    print("  📌 Để apply từ master: clone repo có argocd/environments/, rồi ./scripts/apply-argocd-apps.sh {}".format(env_name))
     run_backend_migration_after_sync()
 
 
@@ -982,18 +2940,8 @@ def run_backend_migration_after_sync():
     env["KUBECONFIG"] = kubeconfig_path
 
     # Đợi namespace meo-stationery có (do Argo CD sync với CreateNamespace=true)
-    for _ in range(36):
-        res = subprocess.run(
-            "kubectl get namespace meo-stationery --request-timeout=5s",
-            shell=True,
-            env=env,
-            capture_output=True,
-            timeout=10,
-        )
-        if res.returncode == 0:
-            break
-        time.sleep(5)
-    else:
+    if not watch_until("Namespace", _exists, "namespace meo-stationery", kube_client(kubeconfig_path),
+                       name="meo-stationery", timeout=180):
         print("  ⚠ Namespace meo-stationery chưa có sau 3 phút; bỏ qua migration. Chạy thủ công khi cần:")
         print("    helm template meo-station-backend k8s_helm/backend -n meo-stationery -f k8s_helm/backend/values.yaml --show-only templates/migration-job.yaml | kubectl apply -n meo-stationery -f -")
         return
@@ -1009,7 +2957,7 @@ def run_backend_migration_after_sync():
             timeout=30,
         )
         print("  Waiting for migration job to complete (up to 10m)...")
-        subprocess.run(
+        run_process(
             "kubectl wait -n meo-stationery --for=condition=complete job/meo-station-backend-migration --timeout=600s",
             shell=True,
             env=env,
@@ -1034,7 +2982,6 @@ def resolve_dns_to_ip(dns_name):
 
 
 # Hostnames trỏ ALB: MỖI ENV CHỈ CẬP NHẬT HOST CỦA MÌNH → argocd.local CHỈ KHI DEPLOY MANAGEMENT.
-APP_INGRESS_HOST = f"meo-stationery-{TERRAFORM_ENV}.local"
 HOSTNAMES_FOR_ALB_BY_ENV = {
     "management": ("argocd.local",),
     "dev": ("meo-stationery-dev.local", RANCHER_HOSTNAME),
@@ -1053,7 +3000,7 @@ def update_etc_hosts(hostname, ip_or_dns):
     hosts_file = "/etc/hosts"
     entry = f"{ip}\t{hostname}"
     try:
-        result = subprocess.run(f"sudo cat {hosts_file}", shell=True, capture_output=True, text=True, check=True)
+        result = run_process(f"sudo cat {hosts_file}", shell=True, capture_output=True, text=True, check=True)
         lines = result.stdout.splitlines()
         new_lines = []
         found = False
@@ -1071,7 +3018,7 @@ def update_etc_hosts(hostname, ip_or_dns):
         with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
             tmp.write("\n".join(new_lines) + "\n")
             tmp_path = tmp.name
-        subprocess.check_call(f"sudo cp {tmp_path} {hosts_file} && sudo chmod 644 {hosts_file}", shell=True)
+        run_process(f"sudo cp {tmp_path} {hosts_file} && sudo chmod 644 {hosts_file}", shell=True, check=True)
         os.unlink(tmp_path)
         print(f"  ✓ Added/updated {hostname} -> {ip} in /etc/hosts")
         return True
@@ -1085,7 +3032,7 @@ def update_etc_hosts_for_alb(alb_dns):
     """Cập nhật /etc/hosts CHỈ hostnames của env hiện tại. Management → argocd.local; dev/prod → app + rancher (không đụng argocd.local)."""
     if not alb_dns:
         return False
-    hostnames = HOSTNAMES_FOR_ALB_BY_ENV.get(TERRAFORM_ENV, ())
+    hostnames = HOSTNAMES_FOR_ALB_BY_ENV.get(current_env().env, ())
     if not hostnames:
         return False
     print(f"  Using ALB DNS: {alb_dns}")
@@ -1096,7 +3043,7 @@ def update_etc_hosts_for_alb(alb_dns):
     hosts_file = "/etc/hosts"
     entry = f"{ip}\t" + " ".join(hostnames)
     try:
-        result = subprocess.run(f"sudo cat {hosts_file}", shell=True, capture_output=True, text=True, check=True)
+        result = run_process(f"sudo cat {hosts_file}", shell=True, capture_output=True, text=True, check=True)
         lines = result.stdout.splitlines()
         new_lines = []
         for line in lines:
@@ -1107,7 +3054,7 @@ def update_etc_hosts_for_alb(alb_dns):
         with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
             tmp.write("\n".join(new_lines) + "\n")
             tmp_path = tmp.name
-        subprocess.check_call(f"sudo cp {tmp_path} {hosts_file} && sudo chmod 644 {hosts_file}", shell=True)
+        run_process(f"sudo cp {tmp_path} {hosts_file} && sudo chmod 644 {hosts_file}", shell=True, check=True)
         os.unlink(tmp_path)
         print(f"  ✓ /etc/hosts updated: {ip} -> {' '.join(hostnames)}")
         return True
@@ -1121,22 +3068,22 @@ def update_etc_hosts_for_alb(alb_dns):
 
 def _write_setup_hosts_script(alb_dns, alb_ip, hostnames=None):
     """Ghi script để user chạy sudo khi deploy.py không có quyền sửa /etc/hosts."""
+    env_name = current_env().env
     if hostnames is None:
-        hostnames = HOSTNAMES_FOR_ALB_BY_ENV.get(TERRAFORM_ENV, ())
-    scripts_dir = os.path.join(_SCRIPT_DIR, "scripts")
-    os.makedirs(scripts_dir, exist_ok=True)
-    script_path = os.path.join(scripts_dir, "setup-hosts.sh")
+        hostnames = HOSTNAMES_FOR_ALB_BY_ENV.get(env_name, ())
+    # Mỗi env một script (.deploy/run/<env>/setup-hosts.sh): dev và prod không ghi đè script của nhau
+    script_path = current_env().run_path("setup-hosts.sh")
     hosts_str = " ".join(hostnames)
     # sed -E: extended regex so | = OR; escape dots for literal match
     sed_pattern = "|".join(h.replace(".", "\\.") for h in hostnames)
     content = f"""#!/usr/bin/env bash
-# Chạy 1 lần sau ./deploy.py (env={TERRAFORM_ENV}) nếu /etc/hosts chưa được cập nhật: sudo bash {script_path}
+# Chạy 1 lần sau ./deploy.py (env={env_name}) nếu /etc/hosts chưa được cập nhật: sudo bash {script_path}
 set -e
 ENTRY="{alb_ip}\t{hosts_str}"
 # Xóa dòng cũ có các host này
 sudo sed -i.bak -E '/{sed_pattern}/d' /etc/hosts
 echo "$ENTRY" | sudo tee -a /etc/hosts
-echo "Done. Hosts for {TERRAFORM_ENV}: {hosts_str}"
+echo "Done. Hosts for {env_name}: {hosts_str}"
 """
     with open(script_path, "w") as f:
         f.write(content)
@@ -1148,37 +3095,27 @@ echo "Done. Hosts for {TERRAFORM_ENV}: {hosts_str}"
 def wait_for_rancher_ready():
     """Waits for at least one Rancher pod to be ready."""
     print("--- Step 8.5: Waiting for Rancher to be ready ---")
-    kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
-
-    waited = 0
-    while waited < 300:
-        try:
-            result = subprocess.run(
-                "kubectl get pods -n cattle-system -l app=rancher "
-                "-o jsonpath='{.items[*].status.containerStatuses[0].ready}'",
-                shell=True,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=10,
-            )
-            if "true" in (result.stdout or ""):
-                print(f"  ✓ Rancher pod is ready (waited {waited}s)")
-                return True
-        except Exception:
-            pass
-        time.sleep(10)
-        waited += 10
+    ready = watch_until(
+        "Pod", _pods_ready, "Rancher pod", kube_client(),
+        namespace="cattle-system", selector="app=rancher", timeout=300,
+    )
+    if ready:
+        print(f"  ✓ Rancher pod is ready (waited {ready.waited:.0f}s)")
+        return True
 
     print("  ⚠ Rancher not ready after 300s, proceeding anyway")
     return False
 
 
+# Unit VPN là một cho cả máy (mọi env dùng chung VPN management) → cài / restart tuần tự qua lock này
+_OPENVPN_SERVICE = "openvpn-practice-rke2"
+_OPENVPN_SYSTEMD_LOCK = os.path.join(tempfile.gettempdir(), f"deploy-openvpn-systemd-{os.getuid()}.lock")
+
+
 def _setup_openvpn_systemd_service():
-    """Tạo systemd service để VPN chạy nền (không cần giữ terminal). Cài vào /etc/systemd nếu sudo được."""
-    service_name = "openvpn-practice-rke2"
+    """Tạo systemd service để VPN chạy nền (không cần giữ terminal). Cài vào /etc/systemd nếu sudo được.
+    Deploy song song: một env cài / restart tại một thời điểm; unit + .ovpn không đổi và service đang chạy → bỏ qua."""
+    service_name = _OPENVPN_SERVICE
     service_content = f"""[Unit]
 Description=OpenVPN for practice_RKE2 (route 10.0.0.0/16)
 After=network-online.target
@@ -1194,18 +3131,40 @@ RestartSec=5
 [Install]
 WantedBy=multi-user.target
 """
-    service_path = os.path.join(_SCRIPT_DIR, f"{service_name}.service")
+    service_path = current_env().run_path(f"{service_name}.service")
     with open(service_path, "w") as f:
         f.write(service_content)
     print("\n--- VPN chạy nền (systemd) ---")
-    print(f"  Đã tạo {service_name}.service trong project.")
+    print(f"  Đã tạo {os.path.relpath(service_path, _SCRIPT_DIR)}.")
+    with open(_OPENVPN_SYSTEMD_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _install_openvpn_systemd_service(service_name, service_path, service_content)
+
+
+def _install_openvpn_systemd_service(service_name, service_path, service_content):
+    """Cài + restart unit (gọi khi đang giữ _OPENVPN_SYSTEMD_LOCK); stamp ghi hash unit + .ovpn đã cài."""
+    h = hashlib.sha256(service_content.encode())
+    try:
+        with open(os.path.join(_SCRIPT_DIR, "minhtri.ovpn"), "rb") as f:
+            h.update(f.read())
+    except OSError:
+        pass
+    stamp_path = os.path.join(_RUN_ROOT, f"{service_name}.sha256")
+    try:
+        with open(stamp_path) as f:
+            installed = f.read().strip() == h.hexdigest()
+    except OSError:
+        installed = False
+    if installed and run_process(["systemctl", "is-active", "--quiet", service_name], timeout=10).returncode == 0:
+        print(f"  ✓ VPN service {service_name} đang chạy, unit + .ovpn không đổi → không restart")
+        return
     install_cmd = (
         f"sudo cp {service_path} /etc/systemd/system/ && "
         "sudo systemctl daemon-reload && "
         f"sudo systemctl enable --now {service_name}"
     )
     try:
-        subprocess.run(install_cmd, shell=True, cwd=_SCRIPT_DIR, timeout=15, check=True)
+        run_process(install_cmd, shell=True, cwd=_SCRIPT_DIR, timeout=15, check=True)
         print(f"  ✓ VPN đã bật nền (service: {service_name}). Tắt: sudo systemctl stop {service_name}")
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
         print("  Để VPN chạy nền sau (không cần giữ terminal), chạy:")
@@ -1213,311 +3172,1196 @@ WantedBy=multi-user.target
         return
     # Restart để process nạp .ovpn mới (Ansible vừa fetch), không cần user chạy tay refresh-ovpn + restart
     try:
-        subprocess.run(f"sudo systemctl restart {service_name}", shell=True, cwd=_SCRIPT_DIR, timeout=10, check=True)
+        run_process(f"sudo systemctl restart {service_name}", shell=True, cwd=_SCRIPT_DIR, timeout=10, check=True)
         print(f"  ✓ VPN đã restart (dùng .ovpn mới từ Ansible)")
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
         print(f"  Nếu VPN đang chạy với .ovpn cũ, chạy: sudo systemctl restart {service_name}")
+        return
+    with open(stamp_path, "w") as f:
+        f.write(h.hexdigest() + "\n")
 
 
-def start_rancher_portforward():
-    """Starts port-forward for Rancher UI automatically with retry logic."""
-    print("--- Step 9: Starting Rancher Port-Forward ---")
-    kubeconfig_path = _kubeconfig_for_deploy()
-    env = os.environ.copy()
-    env["KUBECONFIG"] = kubeconfig_path
-
-    wait_for_rancher_ready()
+def _remove_openvpn_systemd_service():
+    """Sau khi destroy management (OpenVPN server không còn): dừng + gỡ unit VPN nếu đã cài, xoá stamp."""
+    stamp_path = os.path.join(_RUN_ROOT, f"{_OPENVPN_SERVICE}.sha256")
+    if os.path.exists(stamp_path):
+        os.unlink(stamp_path)
+    unit_path = f"/etc/systemd/system/{_OPENVPN_SERVICE}.service"
+    if not os.path.exists(unit_path):
+        return
+    remove_cmd = (f"sudo systemctl disable --now {_OPENVPN_SERVICE} && sudo rm -f {unit_path} && "
+                  "sudo systemctl daemon-reload")
+    with open(_OPENVPN_SYSTEMD_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            run_process(remove_cmd, shell=True, cwd=_SCRIPT_DIR, timeout=30, check=True)
+            print(f"  ✓ Đã gỡ VPN service {_OPENVPN_SERVICE}")
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
+            print(f"  ⚠ Không gỡ được VPN service, chạy tay: {remove_cmd}")
 
-    try:
-        subprocess.check_call("pkill -f 'kubectl port-forward.*svc/rancher'", shell=True, stderr=subprocess.DEVNULL)
-        time.sleep(2)
-    except Exception:
-        pass
 
-    log_file = "/tmp/rancher-pf.log"
-    wrapper_script = f"""#!/bin/bash
-while true; do
-  kubectl port-forward -n cattle-system svc/rancher 8443:443 >> {log_file} 2>&1
-  echo "$(date): Port-forward died, restarting in 5 seconds..." >> {log_file}
-  sleep 5
-done
-"""
+def start_rancher_portforward():
+    """Rancher UI qua `kubectl port-forward` do tunnel manager giữ (tự chạy lại khi chết), port ưa thích 8443.
+    Trả về port local."""
+    print("--- Step 9: Rancher port-forward (tunnel manager) ---")
+    wait_for_rancher_ready()
 
-    wrapper_path = "/tmp/rancher-pf-wrapper.sh"
-    with open(wrapper_path, "w") as f:
-        f.write(wrapper_script)
-    os.chmod(wrapper_path, 0o755)
+    # Bản cũ chạy vòng bash `while true; kubectl port-forward` nền, giữ 8443 → dừng một lần. Chỉ dừng wrapper
+    # và cây con của nó: pkill theo pattern kubectl sẽ giết luôn forward Rancher của env khác (tunnel manager).
+    legacy_wrapper = "/tmp/rancher-pf-wrapper.sh"
+    if os.path.exists(legacy_wrapper):
+        res = run_process(["pgrep", "-f", legacy_wrapper], capture_output=True, text=True)
+        pids = [int(pid) for pid in res.stdout.split()]
+        _signal_all([p for pid in pids for p in [pid] + _descendants(pid)], signal.SIGTERM)
+        try:
+            os.unlink(legacy_wrapper)
+        except FileNotFoundError:
+            pass  # env khác vừa dọn
+
+    name = f"{current_env().env}-rancher"
+    port = tunnel("rancher", timeout=60)
+    if port:
+        print(f"  ✓ Rancher UI: https://localhost:{port}")
+    else:
+        print(f"  ⚠ Port-forward may have failed. Check: ./deploy.py tunnels, {_TUNNEL_DIR}/{name}.log")
+    return port
 
-    process = subprocess.Popen(wrapper_path, shell=True, env=env)
-    time.sleep(5)
 
-    if process.poll() is None:
-        print(f"  ✓ Port-forward started successfully (PID: {process.pid})")
-        print(f"  ✓ Logs: {log_file}")
+def argocd_cluster_secret(env_name):
+    """Secret khai báo cluster cho ArgoCD (label secret-type=cluster), dựng local từ kube_config_rke2_<env>.yaml
+    (client cert admin hoặc token) + cluster_api_url trong Terraform output — tương đương `argocd cluster add`
+    nhưng không cần argocd CLI / login / SSH. Trả về (server, YAML document), hoặc None nếu env chưa đủ dữ liệu."""
+    kc_path = os.path.join(_SCRIPT_DIR, f"kube_config_rke2_{env_name}.yaml")
+    if not os.path.isfile(kc_path):
+        print(f"  ⏭ {env_name}: chưa có {os.path.basename(kc_path)}, bỏ qua")
+        return None
+    try:
+        server = terraform_outputs(env_name).get("cluster_api_url", {}).get("value", "")
+    except subprocess.CalledProcessError as e:
+        print(f"  ⏭ {env_name}: terraform output failed ({e.returncode}), bỏ qua")
+        return None
+    if not server:
+        print(f"  ⏭ {env_name}: thiếu cluster_api_url, bỏ qua")
+        return None
+    res = run_process(
+        ["kubectl", "config", "view", "--raw", "--minify", "--flatten", "-o", "json", f"--kubeconfig={kc_path}"],
+        capture_output=True, text=True, timeout=15,
+    )
+    if res.returncode != 0 or not res.stdout.strip():
+        print(f"  ⏭ {env_name}: cannot read {os.path.basename(kc_path)}: {(res.stderr or '').strip()[:200]}")
+        return None
+    user = (json.loads(res.stdout).get("users") or [{"user": {}}])[0].get("user") or {}
+    # server = NLB API (internal, qua VPC peering; DNS NLB có trong tls-san của RKE2), insecure-skip-tls-verify như
+    # kubeconfig local — Secret không mang CA của cluster
+    config = {"tlsClientConfig": {"insecure": True}}
+    if user.get("client-certificate-data") and user.get("client-key-data"):
+        config["tlsClientConfig"].update(certData=user["client-certificate-data"], keyData=user["client-key-data"])
+    elif user.get("token"):
+        config["bearerToken"] = user["token"]
     else:
-        print(f"  ⚠ Port-forward may have failed. Check logs: {log_file}")
+        print(f"  ⏭ {env_name}: kubeconfig không có client cert / token, bỏ qua")
+        return None
+    return server, (
+        "apiVersion: v1\nkind: Secret\nmetadata:\n"
+        f"  name: cluster-{env_name}\n  namespace: argocd\n"
+        "  labels:\n    argocd.argoproj.io/secret-type: cluster\n"
+        "type: Opaque\nstringData:\n"
+        f"  name: {env_name}\n  server: {server}\n  config: {json.dumps(json.dumps(config))}\n"
+    )
 
 
-def _run_deploy_all():
+def register_argocd_clusters(kubeconfig_path, envs=("dev", "prod")):
+    """Đăng ký dev/prod vào ArgoCD: dựng cluster Secret song song theo env, apply một lần lên management.
+    Trả về {env: server} của các cluster đã đăng ký (destination cho Applications), hoặc None nếu lỗi."""
+    print(f"  Registering {'/'.join(envs)} clusters in ArgoCD (declarative cluster Secrets)...")
+    with ThreadPoolExecutor(max_workers=len(envs), thread_name_prefix="argocd-cluster") as pool:
+        built = dict(zip(envs, pool.map(_with_context(argocd_cluster_secret), envs)))
+    servers = {env: res[0] for env, res in built.items() if res}
+    if not servers:
+        print("  ⚠ Không có cluster nào để đăng ký.")
+        return None
+    documents = [res[1] for res in built.values() if res]
+    _, errors = apply_bundle("ArgoCD cluster Secrets", documents=documents, kubeconfig_path=kubeconfig_path)
+    return None if errors else servers
+
+
+def _build_all_steps(parallel, resume=False):
+    """Pipeline của full deploy: management + Terraform dev/prod song song → networking → deploy dev/prod.
+    Mỗi env chạy ngay trong process này (EnvContext riêng, thread của step), không chạy lại deploy.py."""
+    def env_log(name):
+        if not parallel:
+            return None
+        path = os.path.join(_LOG_DIR, f"{name}.log")
+        open(path, "w").close()
+        return path
+
+    def deploy_env(env, skip_terraform=False):
+        def step(ctx):
+            # 1/4. Full deploy env: management (OpenVPN + RKE2 + ArgoCD); dev/prod: kubeconfig + Rancher + ESO
+            print(f"\n--- Deploy env: {env} ---")
+            env_ctx = EnvContext(env, resume=resume, skip_terraform=skip_terraform)
+            log_file = env_log(f"deploy-{env}")
+            try:
+                if log_file:
+                    print(f"  (log: {log_file})")
+                    with open(log_file, "a", buffering=1) as f, output_to(f):
+                        run_env(env_ctx)
+                else:
+                    run_env(env_ctx)
+            except SystemExit as e:
+                if e.code in (0, None):
+                    return  # env dừng sớm có chủ đích (SKIP_OPENVPN_ANSIBLE=1)
+                if log_file:
+                    _print_log_tail(log_file)
+                raise
+            except BaseException:
+                if log_file:
+                    _print_log_tail(log_file)
+                raise
+        return step
+
+    def terraform_step(env, timeout):
+        def step(ctx):
+            # 2. Chỉ Terraform apply dev + prod (chưa peering nên chưa chạy fetch_kubeconfig)
+            _ensure_tfvars(os.path.join(TERRAFORM_DIR, "environments", env))
+            print(f"\n--- Terraform apply: {env} ---")
+            terraform_apply(env, timeout=timeout, log_file=env_log(f"terraform-{env}"))
+        return step
+
+    def applied(env):
+        # Resume Terraform apply khi .tf và state không đổi từ lần apply trước
+        return {"fingerprint": lambda ctx: _tf_fingerprint(env), "check": lambda ctx: _tf_state_key(env) is not None}
+
+    return [
+        Step("deploy_management", deploy_env("management")),
+        Step("terraform_dev", terraform_step("dev", 1800), **applied("dev")),
+        Step("terraform_prod", terraform_step("prod", 1800), **applied("prod")),
+        # 3. VPC peering trước khi SSH từ Management OpenVPN -> dev/prod master
+        Step("networking", terraform_step("networking", 300), ("deploy_management", "terraform_dev", "terraform_prod"),
+             fingerprint=lambda ctx: [_tf_fingerprint(env) for env in ("networking", "management", "dev", "prod")],
+             check=lambda ctx: _tf_state_key("networking") is not None),
+        Step("deploy_dev", deploy_env("dev", skip_terraform=True), ("networking",)),
+        Step("deploy_prod", deploy_env("prod", skip_terraform=True), ("networking",)),
+    ]
+
+
+def _run_deploy_all(ctx):
     """Deploy management + dev + prod, rồi ArgoCD add cluster + apply Applications → GitOps sync mọi thứ."""
-    deploy_py = os.path.abspath(os.path.join(_SCRIPT_DIR, "deploy.py"))
-    if not os.path.isfile(deploy_py):
-        deploy_py = sys.argv[0]
     print("\n" + "=" * 60)
     print("  ./deploy.py (no args) = FULL PIPELINE: management + dev + prod + ArgoCD add clusters + Applications")
     print("  ArgoCD sẽ sync app từ Git xuống dev/prod — không cần chạy tay script nào.")
     print("=" * 60)
-    # 1. Management full deploy (OpenVPN + RKE2 + ArgoCD)
-    print(f"\n--- Deploy env: management ---")
-    run_command(f"{sys.executable} {deploy_py} management", cwd=_SCRIPT_DIR, timeout=3600)
-    # 2. Chỉ Terraform apply dev + prod (chưa peering nên chưa chạy fetch_kubeconfig)
-    for env in ("dev", "prod"):
-        env_dir = os.path.join(TERRAFORM_DIR, "environments", env)
-        tfvars = os.path.join(env_dir, "terraform.tfvars")
-        if not os.path.isfile(tfvars):
-            ex = os.path.join(env_dir, "terraform.tfvars.example")
-            if os.path.isfile(ex):
-                with open(ex) as f:
-                    c = f.read().replace("YOUR_OFFICE_OR_VPN_IP/32", "0.0.0.0/0")
-                with open(tfvars, "w") as f:
-                    f.write(c)
-        print(f"\n--- Terraform apply: {env} ---")
-        run_command(
-            f"terraform -chdir=environments/{env} init -input=false && terraform -chdir=environments/{env} apply -auto-approve -input=false -var-file=terraform.tfvars",
-            cwd=TERRAFORM_DIR,
-            timeout=1800,
-        )
-    # 3. VPC peering trước khi SSH từ Management OpenVPN -> dev/prod master
-    print("\n--- Networking: VPC peering (management <-> dev, management <-> prod) ---")
-    run_command(
-        "terraform -chdir=environments/networking init -input=false && terraform -chdir=environments/networking apply -auto-approve -input=false",
-        cwd=TERRAFORM_DIR,
-        timeout=300,
-    )
-    # 4. Dev/Prod: fetch kubeconfig qua jump + Rancher/ESO (đã có peering nên SSH được)
-    for env in ("dev", "prod"):
-        print(f"\n--- Deploy env: {env} (kubeconfig + Rancher + ESO) ---")
-        env_with_skip = os.environ.copy()
-        env_with_skip["SKIP_TERRAFORM"] = "1"
-        run_command(f"{sys.executable} {deploy_py} {env}", cwd=_SCRIPT_DIR, timeout=3600, env=env_with_skip)
+    # 1-4 chạy theo DAG: management deploy và Terraform apply dev/prod độc lập nhau → song song;
+    # networking (VPC peering) cần cả ba; deploy dev/prod (qua jump Management) cần peering.
+    parallel = DEPLOY_ENV_CONCURRENCY > 1
+    if parallel:
+        os.makedirs(_LOG_DIR, exist_ok=True)
+        print(f"  Parallel mode: tối đa {DEPLOY_ENV_CONCURRENCY} env cùng lúc, log mỗi env trong {_LOG_DIR}/")
+
+    steps = _build_all_steps(parallel, resume=ctx.resume)
+    ctx.journal = StepJournal("all", resume=ctx.resume)
+    try:
+        run_steps(steps, ctx, max_workers=DEPLOY_ENV_CONCURRENCY)
+    except SystemExit:
+        print("\n  ✗ Full pipeline failed (xem lỗi ở trên" + (f", log từng env trong {_LOG_DIR}/" if parallel else "") + ").")
+        raise
     print("\n--- ArgoCD: add clusters + apply Applications (GitOps) ---")
-    # Lấy ArgoCD admin password từ management cluster (qua SSH tunnel)
-    mgmt_tf = "environments/management"
     try:
-        out = subprocess.check_output(
-            f"terraform -chdir={mgmt_tf} output -json",
-            shell=True,
-            cwd=TERRAFORM_DIR,
-            timeout=30,
-        )
-        tf_json = json.loads(out)
+        tf_json = terraform_outputs("management")
         openvpn_ip = tf_json.get("openvpn_public_ip", {}).get("value", "")
         master_ips = tf_json.get("master_private_ip", {}).get("value", [])
         master_ip = master_ips[0] if master_ips else ""
     except Exception:
         openvpn_ip, master_ip = "", ""
-    argocd_password = os.environ.get("ARGOCD_PASSWORD", "")
-    if not argocd_password and openvpn_ip and master_ip:
-        key = os.path.join(TERRAFORM_DIR, "environments", "management", "k8s-key.pem")
-        # Avoid collisions with other tunnels (argocd-add-clusters uses its own ports)
-        port = 6444
-        try:
-            subprocess.run(f"pkill -f 'ssh -L {port}:' 2>/dev/null || true", shell=True, cwd=_SCRIPT_DIR, timeout=5)
-        except Exception:
-            pass
-        tunnel_proc = subprocess.Popen(
-            f"ssh -L {port}:{master_ip}:6443 -i {key} -o StrictHostKeyChecking=no -o ConnectTimeout=15 -o BatchMode=yes ubuntu@{openvpn_ip} -N",
-            shell=True,
-            cwd=_SCRIPT_DIR,
-        )
-        time.sleep(5)
-        try:
-            kc_mgmt = os.path.join(_SCRIPT_DIR, "kube_config_rke2_management.yaml")
-            if os.path.isfile(kc_mgmt):
-                with open(kc_mgmt) as f:
-                    kc_content = f.read()
-                kc_content = re.sub(r"server: https://[^:]+:6443", f"server: https://127.0.0.1:{port}", kc_content)
-                with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as tmp:
-                    tmp.write(kc_content)
-                    tmp_kc = tmp.name
-                for _ in range(24):
-                    try:
-                        out = subprocess.check_output(
-                            f"kubectl get secret argocd-initial-admin-secret -n argocd -o jsonpath='{{.data.password}}'",
-                            shell=True,
-                            env={**os.environ, "KUBECONFIG": tmp_kc},
-                            timeout=10,
-                        )
-                        argocd_password = subprocess.check_output("base64 -d", input=out, shell=True).decode().strip()
-                        break
-                    except subprocess.CalledProcessError:
-                        time.sleep(10)
-                os.unlink(tmp_kc)
-        finally:
-            tunnel_proc.terminate()
-            tunnel_proc.wait(timeout=5)
-    env = os.environ.copy()
-    if argocd_password:
-        env["ARGOCD_PASSWORD"] = argocd_password
-        print(f"  ✓ ArgoCD password: {argocd_password}")
-        
-        # Add clusters directly via Management Master instead of tunnels
-        print("  Adding dev/prod clusters to ArgoCD via Management Master...")
-        mgmt_key = os.path.join(TERRAFORM_DIR, "environments", "management", "k8s-key.pem")
-        
-        # SSH to Management Master and run ArgoCD commands directly
-        ssh_cmd = f"ssh -i {mgmt_key} -o StrictHostKeyChecking=no ubuntu@{master_ip}"
-        
-        # Install ArgoCD CLI on Management Master if not exists
-        run_command(f"{ssh_cmd} 'which argocd || (curl -sSL -o /tmp/argocd https://github.com/argoproj/argo-cd/releases/latest/download/argocd-linux-amd64 && chmod +x /tmp/argocd && sudo mv /tmp/argocd /usr/local/bin/)'", timeout=120)
-        
-        # Add /etc/hosts entry for argocd.local
-        run_command(f"{ssh_cmd} 'grep -q argocd.local /etc/hosts || echo \"127.0.0.1 argocd.local\" | sudo tee -a /etc/hosts'", timeout=30)
-        
-        # Login ArgoCD
-        run_command(f"{ssh_cmd} 'argocd login argocd.local --insecure --grpc-web --username admin --password \"{argocd_password}\"'", timeout=60)
-        
-        # Get dev/prod master IPs and add clusters
-        for env_name in ["dev", "prod"]:
-            try:
-                env_out = subprocess.check_output(
-                    f"terraform -chdir=environments/{env_name} output -json",
-                    shell=True, cwd=TERRAFORM_DIR, timeout=30
-                )
-                env_data = json.loads(env_out)
-                env_master_ips = env_data.get("master_private_ip", {}).get("value", [])
-                env_master_ip = env_master_ips[0] if env_master_ips else ""
-                
-                if env_master_ip:
-                    print(f"  Adding {env_name} cluster ({env_master_ip}) to ArgoCD...")
-                    
-                    # Create kubeconfig for the environment
-                    run_command(f"{ssh_cmd} 'ssh -i ~/.ssh/k8s-key-{env_name}.pem ubuntu@{env_master_ip} \"cat ~/.kube/config\" > ~/.kube/config-{env_name}'", timeout=60)
-                    
-                    # Fix kubeconfig server URL and TLS
-                    run_command(f"{ssh_cmd} 'sed -i \"s/server: https:\\/\\/127.0.0.1:6443/server: https:\\/\\/{env_master_ip}:6443/\" ~/.kube/config-{env_name}'", timeout=30)
-                    run_command(f"{ssh_cmd} 'sed -i \"s/certificate-authority-data:.*/insecure-skip-tls-verify: true/\" ~/.kube/config-{env_name}'", timeout=30)
-                    
-                    # Add cluster to ArgoCD
-                    run_command(f"{ssh_cmd} 'echo y | argocd cluster add default --name {env_name} --kubeconfig ~/.kube/config-{env_name}'", timeout=120)
-                    
-                    print(f"  ✓ {env_name} cluster added to ArgoCD")
-            except Exception as e:
-                print(f"  ⚠ Failed to add {env_name} cluster: {e}")
-        
-        # Apply ArgoCD Applications and patch cluster URLs
-        run_command("bash scripts/setup-argocd-management-apps.sh", cwd=_SCRIPT_DIR, env=env, timeout=120)
-        
-        # Patch application cluster URLs to use correct IPs
-        print("  Patching ArgoCD application cluster URLs...")
-        patch_cmd = f"{ssh_cmd} 'kubectl patch application meo-station-backend-dev -n argocd --type=merge -p=\"{{\\\"spec\\\":{{\\\"destination\\\":{{\\\"server\\\":\\\"https://10.1.101.190:6443\\\"}}}}}}\" && kubectl patch application meo-station-database-dev -n argocd --type=merge -p=\"{{\\\"spec\\\":{{\\\"destination\\\":{{\\\"server\\\":\\\"https://10.1.101.190:6443\\\"}}}}}}\" && kubectl patch application meo-station-backend-prod -n argocd --type=merge -p=\"{{\\\"spec\\\":{{\\\"destination\\\":{{\\\"server\\\":\\\"https://10.2.101.223:6443\\\"}}}}}}\" && kubectl patch application meo-station-database-prod -n argocd --type=merge -p=\"{{\\\"spec\\\":{{\\\"destination\\\":{{\\\"server\\\":\\\"https://10.2.101.223:6443\\\"}}}}}}\"\'"
-        run_command(patch_cmd, timeout=60)
-        
-    else:
-        print("  ⚠ Không lấy được ArgoCD password. Set ARGOCD_PASSWORD=<admin-pass> rồi chạy lại 2 script sau.")
-        run_command("bash scripts/argocd-add-clusters.sh", cwd=_SCRIPT_DIR, env=env, timeout=600)
-        run_command("bash scripts/setup-argocd-management-apps.sh", cwd=_SCRIPT_DIR, env=env, timeout=120)
+    # Kubeconfig tạm trỏ vào tunnel API management (tunnel manager giữ: bước deploy_management vừa mở → attach ngay)
+    tmp_kc = None
+    kc_mgmt = EnvContext("management").kubeconfig_file
+    if openvpn_ip and master_ip and os.path.isfile(kc_mgmt):
+        port = tunnel("api", "management")
+        if port:
+            with open(kc_mgmt) as f:
+                kc_content = f.read()
+            kc_content = re.sub(r"server: https://[^:]+:6443", f"server: https://127.0.0.1:{port}", kc_content)
+            with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as tmp:
+                tmp.write(kc_content)
+                tmp_kc = tmp.name
+    try:
+        # ARGOCD_PASSWORD (nếu user set) chỉ cần cho argocd-add-clusters.sh ở nhánh không có tunnel
+        env = os.environ.copy()
+        if tmp_kc:
+            # Cluster Secret khai báo (server = cluster_api_url từ Terraform output), apply thẳng qua tunnel →
+            # không cần argocd CLI / login / mật khẩu admin / SSH lên master
+            servers = register_argocd_clusters(tmp_kc)
+            if not servers:
+                print("  ✗ Đăng ký cluster dev/prod vào ArgoCD thất bại (xem lỗi ở trên); Applications sẽ không sync.")
+                sys.exit(1)
+
+            # Applications: destination = đúng chuỗi server của cluster Secret vừa apply (ArgoCD khớp theo server)
+            for env_name, server in servers.items():
+                env[f"CLUSTER_SERVER_{env_name.upper()}"] = server
+            run_command("bash scripts/setup-argocd-management-apps.sh", cwd=_SCRIPT_DIR, env=env, timeout=120)
+        else:
+            print("  ⚠ Không mở được tunnel tới API management. Set ARGOCD_PASSWORD=<admin-pass> rồi chạy lại 2 script sau.")
+            run_command("bash scripts/argocd-add-clusters.sh", cwd=_SCRIPT_DIR, env=env, timeout=600)
+            run_command("bash scripts/setup-argocd-management-apps.sh", cwd=_SCRIPT_DIR, env=env, timeout=120)
+    finally:
+        if tmp_kc:
+            os.unlink(tmp_kc)
     print("\n" + "=" * 60)
     print("  Done. ArgoCD sẽ sync từ Git xuống dev + prod.")
     print("  http://argocd.local — Applications (backend-dev, data-dev, backend-prod, data-prod)")
     print("=" * 60)
 
 
-def main():
-    if TERRAFORM_ENV == "all":
-        _run_deploy_all()
+# --- Destroy: networking (peering giữa các VPC) trước, dev + prod song song, management (OpenVPN jump) sau cùng ---
+# Mỗi env: deps = env phải destroy trước nó (chỉ tính env có trong lần destroy này).
+_DESTROY_ORDER = {"networking": (), "dev": ("networking",), "prod": ("networking",),
+                  "management": ("networking", "dev", "prod")}
+
+
+def terraform_destroy(env_name, timeout=None, log_file=None):
+    """init + destroy env. Không có thư mục / state không còn resource → bỏ qua. Trả về True nếu đã destroy."""
+    env_dir = os.path.join(TERRAFORM_DIR, "environments", env_name)
+    if not os.path.isdir(env_dir):
+        print(f"  ⏭ Bỏ qua {env_name} (không có thư mục)")
+        return False
+    try:
+        with open(os.path.join(env_dir, "terraform.tfstate")) as f:
+            empty = json.load(f).get("resources") == []
+    except FileNotFoundError:
+        empty = True
+    except (OSError, ValueError):
+        empty = False
+    if empty:
+        print(f"  ⏭ Terraform {env_name}: state không còn resource, bỏ qua destroy")
+        return False
+    # Destroy không sinh cấu hình: chỉ dùng terraform.tfvars đã có (không tạo từ .example như apply)
+    has_tfvars = os.path.isfile(os.path.join(env_dir, "terraform.tfvars"))
+    var_file = " -var-file=terraform.tfvars" if env_name != "networking" and has_tfvars else ""
+    terraform_init(env_name, log_file=log_file)
+    run_command(f"terraform -chdir=environments/{env_name} destroy -auto-approve -input=false{var_file}",
+                cwd=TERRAFORM_DIR, timeout=timeout, log_file=log_file)
+    return True
+
+
+def _cleanup_after_destroy(ctx):
+    """Dọn những gì deploy để lại trên máy local cho env vừa destroy: tunnel, kubeconfig (cả bản tunnel), SSH master
+    tới host của env, cache output / init stamp, journal (--resume không bỏ qua step của hạ tầng đã mất), file trong
+    .deploy/run/<env>; management: VPN unit."""
+    removed = []
+    outputs_cache = os.path.join(_STATE_DIR, f"tf-outputs-{ctx.env}.json")
+    try:
+        if ctx.env == "management":
+            # Mọi tunnel (API, Rancher) đều đi qua OpenVPN của management → dừng luôn tunnel manager
+            if _tunnel_request("list"):
+                removed.append("tunnels")
+            _tunnel_request("shutdown")
+        else:
+            for t in _tunnel_request("list"):
+                if t["name"].startswith(f"{ctx.env}-"):
+                    _tunnel_request("stop", name=t["name"])
+                    removed.append(f"tunnel {t['name']}")
+    except OSError:
+        pass  # tunnel manager không chạy
+    # Host của env lấy từ cache output (state đã destroy): SSH master (ControlPersist) tới host đó còn mở thì đóng
+    hosts = set()
+    try:
+        with open(outputs_cache) as f:
+            outputs = json.load(f)["outputs"]
+        hosts.update(outputs.get("master_private_ip", {}).get("value") or [])
+        if outputs.get("openvpn_public_ip", {}).get("value"):
+            hosts.add(outputs["openvpn_public_ip"]["value"])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    with _ssh_sessions_lock:
+        for key in [key for key in _ssh_sessions if key[0] in hosts]:
+            del _ssh_sessions[key]
+    try:
+        _ensure_ssh_control_dir()
+    except RuntimeError as e:
+        print(f"  ⚠ {e}")
+        hosts = set()  # không đụng socket trong thư mục của user khác
+    for host in sorted(hosts):
+        control_path = os.path.join(_SSH_CONTROL_DIR, f"ubuntu@{host}")
+        if os.path.exists(control_path):
+            try:
+                run_process(["ssh", "-o", f"ControlPath={control_path}", "-O", "exit", f"ubuntu@{host}"],
+                            capture_output=True, timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+            removed.append(f"ssh master {host}")
+        for suffix in ("", ".lock", ".log", ".forwards"):
+            if os.path.lexists(control_path + suffix):
+                os.unlink(control_path + suffix)
+    with _tf_outputs_lock:
+        _tf_outputs.pop(ctx.env, None)
+    paths = [ctx.kubeconfig_file, ctx.tunnel_kubeconfig_path, outputs_cache,
+             os.path.join(_STATE_DIR, f"tf-init-{ctx.env}.json"),
+             StepJournal.path_for(ctx.env), StepJournal.path_for("all")]
+    run_dir = os.path.dirname(ctx.run_path("deploy.lock"))
+    paths += [os.path.join(run_dir, f) for f in os.listdir(run_dir) if f != "deploy.lock"]
+    for path in paths:
+        if os.path.isfile(path):
+            os.unlink(path)
+            removed.append(os.path.relpath(path, _SCRIPT_DIR))
+    if removed:
+        print(f"  ✓ Dọn local: {', '.join(removed)}")
+    if ctx.env == "management":
+        _remove_openvpn_systemd_service()
+
+
+def destroy_command(ctx, args):
+    """deploy.py destroy [env...] (mặc định cả bốn): Terraform destroy theo _DESTROY_ORDER, env độc lập chạy song song
+    (tối đa DEPLOY_ENV_CONCURRENCY), dọn local sau mỗi env, cuối cùng in thời gian từng env."""
+    envs = [a.lower() for a in args] or list(_DESTROY_ORDER)
+    unknown = [e for e in envs if e not in _DESTROY_ORDER]
+    if unknown:
+        print(f"Usage: {sys.argv[0]} destroy [{'|'.join(_DESTROY_ORDER)} ...]", file=sys.stderr)
+        print(f"Invalid environment: {unknown[0]}", file=sys.stderr)
+        sys.exit(1)
+    envs = [e for e in _DESTROY_ORDER if e in envs]
+    parallel = DEPLOY_ENV_CONCURRENCY > 1
+    if parallel:
+        os.makedirs(_LOG_DIR, exist_ok=True)
+        print(f"  Parallel mode: tối đa {DEPLOY_ENV_CONCURRENCY} env cùng lúc, log mỗi env trong {_LOG_DIR}/")
+    results = {}
+
+    def destroy_env(env):
+        def step(_):
+            env_ctx = EnvContext(env)
+            log_file = os.path.join(_LOG_DIR, f"destroy-{env}.log") if parallel else None
+            if log_file:
+                open(log_file, "w").close()
+            start = time.monotonic()
+            try:
+                with use_env(env_ctx), env_lock(env_ctx):
+                    print(f"\n--- Terraform destroy: {env} ---")
+                    destroyed = terraform_destroy(env, timeout=1800, log_file=log_file)
+                    _cleanup_after_destroy(env_ctx)
+            except BaseException:
+                results[env] = ("failed", time.monotonic() - start)
+                raise
+            results[env] = ("destroyed" if destroyed else "skipped", time.monotonic() - start)
+        return step
+
+    steps = [Step(f"destroy_{env}", destroy_env(env), tuple(f"destroy_{d}" for d in _DESTROY_ORDER[env] if d in envs))
+             for env in envs]
+    start = time.monotonic()
+    try:
+        run_steps(steps, ctx, max_workers=DEPLOY_ENV_CONCURRENCY)
+    finally:
+        wall = time.monotonic() - start
+        print("\n--- Destroy summary ---")
+        print(f"  {'env':<12} {'status':<11} {'wall':>8}")
+        for env in envs:
+            status, dur = results.get(env, ("not run", None))
+            print(f"  {env:<12} {status:<11} {'' if dur is None else _fmt_duration(dur):>8}")
+        total = sum(dur for _, dur in results.values())
+        print(f"  Tổng: {_fmt_duration(wall)} (tuần tự từng env: {_fmt_duration(total)})")
+
+
+# --- Status: trạng thái cả fleet trong vài giây, chỉ đọc ---
+# Mỗi env song song: state + output Terraform (cache), SSH tới jump, /readyz + node + pod qua tunnel manager (attach
+# tunnel đang chạy, không thì mở). Không đợi như các bước deploy: check nào lỗi thì ghi lại và dừng env đó.
+# Workload: tên cột → (namespace, label selector pod) như các bước install đợi
+_STATUS_WORKLOADS = {
+    "ebs-csi": ("kube-system", "app=ebs-csi-controller"),
+    "argocd": ("argocd", "app.kubernetes.io/name=argocd-server"),
+    "rancher": ("cattle-system", "app=rancher"),
+    "eso": ("external-secrets", "app.kubernetes.io/name=external-secrets"),
+}
+
+
+def _status_workloads(env):
+    # Management chỉ chạy ArgoCD; dev/prod chạy Rancher + ESO (xem _build_env_steps)
+    return ("ebs-csi", "argocd") if env == "management" else ("ebs-csi", "rancher", "eso")
+
+
+def _ready_count(items, ready):
+    return {"ready": sum(1 for item in items if ready(item)), "total": len(items)}
+
+
+def _node_ready(node):
+    return any(c.get("type") == "Ready" and c.get("status") == "True"
+               for c in (node.get("status") or {}).get("conditions") or [])
+
+
+def _pod_ready(pod):
+    statuses = (pod.get("status") or {}).get("containerStatuses") or []
+    return bool(statuses) and all(c.get("ready") for c in statuses)
+
+
+def env_status(ctx):
+    """Trạng thái env của ctx → dict (JSON được). health: ok | degraded (cluster trả lời nhưng node / workload chưa
+    ready) | down (có state nhưng jump / API không tới được) | absent (chưa có state Terraform)."""
+    st = {"env": ctx.env, "health": "absent", "terraform": None, "jump": None, "api": None, "nodes": None,
+          "workloads": dict.fromkeys(_status_workloads(ctx.env)), "errors": []}
+    key = _tf_state_key(ctx.env)
+    if key is None:
+        st["errors"].append("no Terraform state")
+        return st
+    st["health"] = "down"
+    try:
+        _apply_outputs(ctx, terraform_outputs(ctx.env))
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, KeyError, IndexError, TypeError, ValueError) as e:
+        st["terraform"] = {"serial": key[1], "outputs": False}
+        st["errors"].append(f"terraform output: {type(e).__name__}: {e}")
+        return st
+    st["terraform"] = {"serial": key[1], "outputs": True, "master": ctx.master_private_ip,
+                       "jump_host": ctx.openvpn_public_ip}
+    if not ctx.openvpn_public_ip:
+        st["errors"].append("no jump host (management OpenVPN output)")
+        return st
+
+    jump = ssh_session(ctx.openvpn_public_ip, ctx.jump_key_path or ctx.ssh_key_path)
+    start = time.monotonic()
+    try:
+        res = jump.run("true", connect_timeout=5, capture_output=True, timeout=10)
+        lines = (res.stderr or b"").decode(errors="replace").strip().splitlines()
+        error = (lines[-1] if lines else f"ssh rc={res.returncode}") if res.returncode else None
+    except subprocess.TimeoutExpired:
+        error = "timeout"
+    st["jump"] = {"ok": error is None, "ms": round((time.monotonic() - start) * 1000)}
+    if error is not None:
+        st["errors"].append(f"ssh {ctx.openvpn_public_ip}: {error}")
+        return st
+    if not os.path.isfile(ctx.kubeconfig_file):
+        st["errors"].append(f"no {os.path.basename(ctx.kubeconfig_file)} (deploy chưa tới bước kubeconfig)")
+        return st
+
+    port = tunnel("api", ctx.env, timeout=DEPLOY_STATUS_TIMEOUT)
+    if not port:
+        st["api"] = {"ok": False}
+        st["errors"].append(f"API tunnel not up after {DEPLOY_STATUS_TIMEOUT:.0f}s (./deploy.py tunnels)")
+        return st
+    _create_tunnel_kubeconfig(port)
+    try:
+        kube = KubeClient(ctx.kubeconfig_tunnel_file, timeout=5)
+    except (KubeError, OSError, ValueError) as e:
+        st["errors"].append(f"kubeconfig: {e}")
+        return st
+    try:
+        start = time.monotonic()
+        readyz = kube.request("GET", "/readyz")
+        st["api"] = {"ok": True, "port": port, "ms": round((time.monotonic() - start) * 1000), "readyz": readyz}
+        st["nodes"] = _ready_count(kube.list(resource_path("Node"))["items"], _node_ready)
+        for name in st["workloads"]:
+            namespace, selector = _STATUS_WORKLOADS[name]
+            pods = kube.list(resource_path("Pod", namespace), label_selector=selector)["items"]
+            st["workloads"][name] = _ready_count(pods, _pod_ready)
+    except (KubeError, OSError, http.client.HTTPException) as e:
+        st["api"] = st["api"] or {"ok": False, "port": port}
+        st["errors"].append(f"API: {type(e).__name__}: {e}")
+        return st
+    finally:
+        kube.close()
+    counts = [st["nodes"], *st["workloads"].values()]
+    st["health"] = "ok" if all(c["total"] and c["ready"] == c["total"] for c in counts) else "degraded"
+    return st
+
+
+def status_command(args, as_json=False):
+    """deploy.py status [env...] [--json]: env_status của các env song song → bảng (hoặc JSON cho monitoring).
+    Exit code 0 chỉ khi mọi env health=ok."""
+    envs = [a.lower() for a in args] or ["management", "dev", "prod"]
+    unknown = [e for e in envs if e not in _VALID_ENVS or e == "all"]
+    if unknown:
+        print(f"Usage: {sys.argv[0]} status [dev|prod|management ...] [--json]", file=sys.stderr)
+        print(f"Invalid environment: {unknown[0]}", file=sys.stderr)
+        sys.exit(1)
+
+    def probe(env):
+        ctx = EnvContext(env)
+        start = time.monotonic()
+        # Output của tunnel / SSH (✓ Tunnel ... warm) không cần cho bảng
+        with use_env(ctx), open(os.devnull, "w") as devnull, output_to(devnull):
+            st = env_status(ctx)
+        st["seconds"] = round(time.monotonic() - start, 1)
+        return st
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(envs), thread_name_prefix="status") as pool:
+        statuses = list(pool.map(_with_context(probe), envs))
+    if as_json:
+        print(json.dumps({"checked_at": time.time(), "seconds": round(time.monotonic() - start, 1),
+                          "envs": statuses}, indent=2))
+    else:
+        def count(c):
+            return "-" if c is None else f"{c['ready']}/{c['total']}"
+
+        def check(c):
+            return "-" if c is None else (f"ok {c['ms']}ms" if c["ok"] else "FAIL")
+
+        columns = list(_STATUS_WORKLOADS)
+        print(f"  {'env':<11} {'health':<9} {'tf':>5} {'jump':>9} {'api':>9} {'nodes':>6}  "
+              + " ".join(f"{c:>8}" for c in columns))
+        for st in statuses:
+            tf = "-" if st["terraform"] is None else f"#{st['terraform']['serial']}"
+            print(f"  {st['env']:<11} {st['health']:<9} {tf:>5} {check(st['jump']):>9} {check(st['api']):>9} "
+                  f"{count(st['nodes']):>6}  "
+                  + " ".join(f"{count(st['workloads'][c]) if c in st['workloads'] else '':>8}" for c in columns))
+        for st in statuses:
+            for error in st["errors"]:
+                print(f"  ✗ {st['env']}: {error}")
+        print(f"  ({time.monotonic() - start:.1f}s)")
+    if any(st["health"] != "ok" for st in statuses):
+        sys.exit(1)
+
+
+# --- Step journal: ghi step đã xong + fingerprint input, --resume bỏ qua step còn khớp ---
+def _hash_tree(*paths):
+    """sha256 nội dung các file dưới paths (bỏ file/thư mục ẩn như .terraform, state và key sinh ra)."""
+    h = hashlib.sha256()
+    for root in paths:
+        if os.path.isfile(root):
+            files = [root]
+        else:
+            files = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+                files += [os.path.join(dirpath, f) for f in sorted(filenames)
+                          if not f.startswith(".") and not f.endswith((".tfstate", ".tfstate.backup", ".pem"))]
+        for path in files:
+            h.update(os.path.relpath(path, _SCRIPT_DIR).encode() + b"\0")
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def _source_digest(func):
+    """Hash source của hàm install → sửa flag/values trong code cũng làm step chạy lại khi resume."""
+    return hashlib.sha256(inspect.getsource(func).encode()).hexdigest()[:16]
+
+
+class StepJournal:
+    """Journal các step đã xong của một env. Ghi ngay khi mỗi step thành công (kể cả khi run sau đó lỗi).
+    Không --resume thì bắt đầu journal mới; --resume thì load và cho bỏ qua step có fingerprint khớp + check() đúng."""
+
+    def __init__(self, name, resume=False):
+        self.path = self.path_for(name)
+        self.resume = resume
+        self.entries = {}
+        self._lock = threading.Lock()
+        if resume:
+            try:
+                self.entries = self.load(name)
+            except (OSError, ValueError):
+                print(f"  ℹ --resume: chưa có journal {os.path.relpath(self.path, _SCRIPT_DIR)}, chạy từ đầu.")
+            else:
+                print(f"  ↻ --resume: {len(self.entries)} step trong journal ({', '.join(self.entries)})")
+        else:
+            self._save()
+
+    @staticmethod
+    def path_for(name):
+        return os.path.join(_STATE_DIR, f"journal-{name}.json")
+
+    @classmethod
+    def load(cls, name):
+        """Entries của journal (chỉ đọc; --plan dùng mà không tạo journal mới)."""
+        with open(cls.path_for(name)) as f:
+            return json.load(f)
+
+    @staticmethod
+    def fingerprint(step, ctx):
+        data = json.dumps(step.fingerprint(ctx), sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def can_skip(self, step, ctx):
+        entry = self.entries.get(step.name)
+        if not self.resume or not entry or step.fingerprint is None or step.check is None:
+            return False
+        try:
+            if self.fingerprint(step, ctx) != entry.get("fingerprint"):
+                print(f"  ↻ [{step.name}] input changed since last run → re-run")
+                return False
+            if not step.check(ctx):
+                print(f"  ↻ [{step.name}] post-condition no longer holds → re-run")
+                return False
+        except Exception as e:
+            print(f"  ↻ [{step.name}] cannot verify journal entry ({type(e).__name__}: {e}) → re-run")
+            return False
+        return True
+
+    def record(self, step, ctx, duration):
+        if step.fingerprint is None:
+            return
+        try:
+            fingerprint = self.fingerprint(step, ctx)
+        except Exception as e:
+            print(f"  ⚠ [{step.name}] not journaled ({type(e).__name__}: {e})")
+            return
+        with self._lock:
+            self.entries[step.name] = {"fingerprint": fingerprint, "finished": time.time(), "duration": round(duration, 1)}
+            self._save()
+
+    def _save(self):
+        os.makedirs(_STATE_DIR, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def _check_step_graph(steps):
+    """Validates the step DAG (unknown deps, duplicates, cycles) before anything runs."""
+    by_name = {}
+    for step in steps:
+        if step.name in by_name:
+            raise ValueError(f"Duplicate step: {step.name}")
+        by_name[step.name] = step
+    for step in steps:
+        for dep in step.deps:
+            if dep not in by_name:
+                raise ValueError(f"Step {step.name} depends on unknown step {dep}")
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [s for s in remaining if all(d in done for d in s.deps)]
+        if not ready:
+            raise ValueError("Step graph has a cycle: " + ", ".join(s.name for s in remaining))
+        done.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in done]
+    return by_name
+
+
+_active_pipelines = 0
+_active_pipelines_lock = threading.Lock()
+
+
+def run_steps(steps, ctx, max_workers=None):
+    """Chạy pipeline dạng DAG: mỗi step bắt đầu ngay khi các deps xong, tối đa max_workers step cùng lúc.
+    Step đầu tiên lỗi (hoặc Ctrl-C) → không chạy thêm step mới, huỷ command/wait của các step đang chạy
+    (cancel_processes), đợi chúng dừng rồi raise lại lỗi đó."""
+    global _active_pipelines
+    _check_step_graph(steps)
+    max_workers = max(1, max_workers or DEPLOY_MAX_WORKERS)
+    with _active_pipelines_lock:
+        _active_pipelines += 1
+    pending = list(steps)
+    done = set()
+    running = {}
+    failure = None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="step") as pool:
+            while pending or running:
+                if failure is None:
+                    for step in [s for s in pending if all(d in done for d in s.deps)]:
+                        pending.remove(step)
+                        running[pool.submit(_with_context(_run_step), step, ctx)] = step
+                if not running:
+                    break
+                try:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt as e:
+                    if failure is not None:
+                        raise
+                    failure, pending = e, []
+                    print(f"\n  ✗ Interrupted; stopping: {', '.join(s.name for s in running.values())}")
+                    cancel_processes()
+                    continue
+                for fut in finished:
+                    step = running.pop(fut)
+                    try:
+                        fut.result()
+                        done.add(step.name)
+                    except BaseException as e:
+                        if failure is None:
+                            failure = e
+                            if pending:
+                                print(f"  ✗ Step {step.name} failed; not starting: {', '.join(s.name for s in pending)}")
+                            if running:
+                                print(f"  ✗ Cancelling running steps: {', '.join(s.name for s in running.values())}")
+                                cancel_processes()
+                            pending = []
+    finally:
+        # Cleanup sau đó (đóng SSH master, ...) vẫn cần chạy command. Pipeline lồng (env trong full pipeline) không
+        # bỏ huỷ: pipeline ngoài đang huỷ thì các env khác vẫn phải dừng.
+        with _active_pipelines_lock:
+            _active_pipelines -= 1
+            if _active_pipelines == 0:
+                resume_processes()
+    if failure is not None:
+        raise failure
+
+
+def _run_step(step, ctx):
+    journal = getattr(ctx, "journal", None)
+    if journal and journal.can_skip(step, ctx):
+        print(f"\n⏭ [{step.name}] skipped (done in previous run, inputs unchanged)")
+        _record_span(step.name, "step", time.time(), 0, {"status": "skipped"})
         return
-    if os.environ.get("SKIP_TERRAFORM") != "1":
+    start = time.monotonic()
+    print(f"\n▶ [{step.name}] start")
+    with span(step.name, "step"):
+        step.func(ctx)
+        # Step nuốt lỗi của wait / command bị huỷ vẫn không được tính là xong (không journal → --resume chạy lại)
+        if _CANCEL.is_set():
+            raise Cancelled(f"pipeline cancelled during step {step.name}")
+    print(f"✓ [{step.name}] done ({time.monotonic() - start:.0f}s)")
+    if journal:
+        journal.record(step, ctx, time.monotonic() - start)
+
+
+def _step_terraform(ctx):
+    if not ctx.skip_terraform:
         setup_terraform()
-    tf_out = get_terraform_output()
 
-    nlb_dns = tf_out["nlb_dns_name"]["value"]
-    master_private_ip = tf_out["master_private_ip"]["value"][0]
 
+def _apply_outputs(ctx, tf_out):
+    """Điền ctx từ Terraform output của env (IP master, jump host, NLB/ALB)."""
+    ctx.tf_out = tf_out
+    ctx.nlb_dns = tf_out["nlb_dns_name"]["value"]
+    ctx.master_private_ip = tf_out["master_private_ip"]["value"][0]
+    ctx.alb_dns = tf_out.get("web_alb_dns_name", {}).get("value", "")
     # Chỉ Management có OpenVPN; dev/prod dùng Management làm jump host
-    if TERRAFORM_ENV == "management":
-        openvpn_public_ip = tf_out["openvpn_public_ip"]["value"]
-        jump_key_path = None
-        key_on_jump = "k8s-key.pem"
+    if ctx.env == "management":
+        ctx.openvpn_public_ip = tf_out["openvpn_public_ip"]["value"]
+        ctx.jump_key_path = None
+        ctx.key_on_jump = "k8s-key.pem"
     else:
-        openvpn_public_ip = get_management_openvpn_ip()
-        if not openvpn_public_ip:
+        ctx.openvpn_public_ip = get_management_openvpn_ip()
+        ctx.jump_key_path = os.path.abspath(os.path.join(TERRAFORM_DIR, "environments", "management", SSH_KEY_FILE_NAME))
+        ctx.key_on_jump = f"k8s-key-{ctx.env}.pem"
+
+
+def _step_outputs(ctx):
+    _apply_outputs(ctx, get_terraform_output())
+    if ctx.env != "management":
+        if not ctx.openvpn_public_ip:
             print("  ✗ Dev/Prod cần Management OpenVPN làm jump. Chạy terraform apply cho management trước.")
             sys.exit(1)
-        jump_key_path = os.path.join(TERRAFORM_DIR, "environments", "management", SSH_KEY_FILE_NAME)
-        if not os.path.isfile(jump_key_path):
-            print(f"  ✗ Thiếu key Management: {jump_key_path}")
+        if not os.path.isfile(ctx.jump_key_path):
+            print(f"  ✗ Thiếu key Management: {ctx.jump_key_path}")
             sys.exit(1)
-        jump_key_path = os.path.abspath(jump_key_path)
-        key_on_jump = f"k8s-key-{TERRAFORM_ENV}.pem"
 
     print("\n--- RKE2 + OpenVPN ---")
-    print(f"  ✓ Jump / OpenVPN: {openvpn_public_ip}" + (" (Management)" if TERRAFORM_ENV != "management" else ""))
-    print(f"  ✓ Master Private IP: {master_private_ip}")
+    print(f"  ✓ Jump / OpenVPN: {ctx.openvpn_public_ip}" + (" (Management)" if ctx.env != "management" else ""))
+    print(f"  ✓ Master Private IP: {ctx.master_private_ip}")
 
     if os.environ.get("SKIP_OPENVPN_ANSIBLE") == "1":
         print("  ⏭ SKIP_OPENVPN_ANSIBLE=1 → bỏ qua bước OpenVPN/Ansible.")
-        if TERRAFORM_ENV == "management":
+        if ctx.env == "management":
             print("  Khi SSH được, chạy:")
-            print(f"    ssh -o IdentitiesOnly=yes -i terraform/environments/{TERRAFORM_ENV}/k8s-key.pem ubuntu@{openvpn_public_ip}")
-            print(f"    cd ansible && ansible-playbook -i inventory_openvpn.yml -e openvpn_public_ip={openvpn_public_ip} openvpn-server.yml")
-        print("  Sau đó chạy lại: ./deploy.py", TERRAFORM_ENV)
+            print(f"    ssh -o IdentitiesOnly=yes -i terraform/environments/{ctx.env}/k8s-key.pem ubuntu@{ctx.openvpn_public_ip}")
+            print(f"    cd ansible && ansible-playbook -i inventory_openvpn.yml -e openvpn_public_ip={ctx.openvpn_public_ip} openvpn-server.yml")
+        print("  Sau đó chạy lại: ./deploy.py", ctx.env)
         sys.exit(0)
 
-    if TERRAFORM_ENV == "management":
-        print("  ⏳ Đợi OpenVPN instance SSH sẵn sàng rồi chạy Ansible setup...")
-        run_openvpn_ansible(openvpn_public_ip)
 
-    fetch_kubeconfig(openvpn_public_ip, master_private_ip, nlb_dns, jump_ssh_key_path=jump_key_path, key_on_jump=key_on_jump)
-    _create_tunnel_kubeconfig()
+def _step_openvpn_ansible(ctx):
+    print("  ⏳ Đợi OpenVPN instance SSH sẵn sàng rồi chạy Ansible setup...")
+    run_openvpn_ansible(ctx.openvpn_public_ip)
+
+
+def _step_kubeconfig(ctx):
+    fetch_kubeconfig(ctx.openvpn_public_ip, ctx.master_private_ip, ctx.nlb_dns,
+                     jump_ssh_key_path=ctx.jump_key_path, key_on_jump=ctx.key_on_jump)
+
+
+def _step_api_from_openvpn(ctx):
     print("--- Step 4.4: Waiting for API server reachable from OpenVPN ---")
-    if not wait_for_api_from_openvpn(openvpn_public_ip, master_private_ip, jump_ssh_key_path=jump_key_path):
+    if not wait_for_api_from_openvpn(ctx.openvpn_public_ip, ctx.master_private_ip, jump_ssh_key_path=ctx.jump_key_path):
         sys.exit(1)
-    start_openvpn_port_forward(openvpn_public_ip, master_private_ip, jump_ssh_key_path=jump_key_path)
-    wait_for_nlb_health_checks()
-    install_ebs_csi_driver()
 
-    if TERRAFORM_ENV == "management":
-        # Cluster management: CHỈ cài ArgoCD. ArgoCD này quản lý deploy sang dev/prod (không cài ArgoCD trên prod/dev).
-        install_argocd()
-        wait_for_argocd_ready()
-        # Sau khi có argocd/environments/management/ (Application target dev/prod), có thể gọi deploy_argocd_applications() ở đây.
-    else:
-        # Dev/Staging/Prod: KHÔNG cài ArgoCD. Chỉ Rancher, ESO, secrets. Apps deploy qua ArgoCD trên management (add cluster + chạy setup-argocd-management-apps.sh).
-        install_rancher()
-        install_external_secrets_operator()
-        ensure_aws_secrets_credentials()
-        apply_external_secrets_manifests()
 
+def _step_port_forward(ctx):
+    ctx.api_port = start_openvpn_port_forward(ctx.openvpn_public_ip, ctx.master_private_ip,
+                                              jump_ssh_key_path=ctx.jump_key_path)
+
+
+def _step_k8s_api(ctx):
+    wait_for_k8s_api(_kubeconfig_for_deploy(), max_wait=120)
+
+
+def _step_nlb_health(ctx):
+    tg_arn = ctx.tf_out.get("nlb_target_group_arn", {}).get("value", "")
+    wait_for_nlb_health_checks(ctx.openvpn_public_ip, ctx.nlb_dns, jump_ssh_key_path=ctx.jump_key_path, tg_arn=tg_arn)
+
+
+def _step_argocd(ctx):
+    install_argocd()
+    wait_for_argocd_ready()
+
+
+def _step_rancher_portforward(ctx):
+    ctx.rancher_port = start_rancher_portforward()
+
+
+def _step_etc_hosts(ctx):
     print("\n--- Updating /etc/hosts for Ingress access ---")
-    alb_dns = tf_out.get("web_alb_dns_name", {}).get("value", "")
-    if alb_dns:
-        if not update_etc_hosts_for_alb(alb_dns):
-            print(f"  You can run the script above once to add ALB -> {' '.join(HOSTNAMES_FOR_ALB_BY_ENV.get(TERRAFORM_ENV, ()))}")
+    if ctx.alb_dns:
+        if not update_etc_hosts_for_alb(ctx.alb_dns):
+            print(f"  You can run the script above once to add ALB -> {' '.join(HOSTNAMES_FOR_ALB_BY_ENV.get(ctx.env, ()))}")
     else:
         print("  ⚠ ALB DNS not available yet, skipping /etc/hosts update")
         print("  You can update manually after ALB is ready")
 
-    if TERRAFORM_ENV != "management":
-        start_rancher_portforward()
 
+# Fingerprint / post-condition cho --resume (xem StepJournal). Step không có → luôn chạy
+# (outputs, tunnel, các wait: rẻ và tạo state runtime mà step sau cần).
+def _tf_fingerprint(env_name):
+    env_dir = os.path.join(TERRAFORM_DIR, "environments", env_name)
+    return {
+        "tf": _hash_tree(env_dir, os.path.join(TERRAFORM_DIR, "modules"), os.path.join(TERRAFORM_DIR, "global")),
+        "state": _tf_state_key(env_name),
+    }
+
+
+def _helm_release_deployed(namespace, release):
+    """Helm release ở trạng thái deployed (đọc Secret release của Helm 3, không cần gọi helm)."""
+    selector = f"owner=helm,name={release},status=deployed"
+    return bool(kube_client().list(resource_path("Secret", namespace), label_selector=selector)["items"])
+
+
+def _chart_fingerprint(chart, install_func, *inputs):
+    def fingerprint(ctx):
+        return {"cluster": ctx.master_private_ip, "chart": HELM_CHARTS[chart], "code": _source_digest(install_func),
+                "inputs": _hash_tree(*inputs) if inputs else None}
+    return fingerprint
+
+
+def _openvpn_active(ctx):
+    vpn = ssh_session(ctx.openvpn_public_ip, ctx.ssh_key_path)
+    return vpn.run("systemctl is-active --quiet openvpn-server@server", timeout=20).returncode == 0
+
+
+_RESUME = {
+    "terraform": (lambda ctx: _tf_fingerprint(ctx.env), lambda ctx: _tf_state_key(ctx.env) is not None),
+    "openvpn_ansible": (
+        lambda ctx: {"ip": ctx.openvpn_public_ip, "ansible": _hash_tree(ANSIBLE_DIR)},
+        _openvpn_active,
+    ),
+    "kubeconfig": (
+        lambda ctx: {"master": ctx.master_private_ip, "jump": ctx.openvpn_public_ip, "state": _tf_state_key(ctx.env)},
+        lambda ctx: os.path.isfile(ctx.kubeconfig_file),
+    ),
+    "ebs_csi": (
+        _chart_fingerprint("aws-ebs-csi-driver", install_ebs_csi_driver),
+        lambda ctx: _helm_release_deployed("kube-system", "aws-ebs-csi-driver"),
+    ),
+    "argocd": (
+        _chart_fingerprint("argo-cd", install_argocd, os.path.join(_SCRIPT_DIR, "argocd", "values-nodeselector.yaml")),
+        lambda ctx: _helm_release_deployed("argocd", "argocd"),
+    ),
+    "rancher": (
+        _chart_fingerprint("rancher", install_rancher),
+        lambda ctx: _helm_release_deployed("cattle-system", "rancher")
+        and kube_client().exists(resource_path("Secret", "cattle-system", "tls-rancher-ingress")),
+    ),
+    "external_secrets_operator": (
+        _chart_fingerprint("external-secrets", install_external_secrets_operator),
+        lambda ctx: _helm_release_deployed("external-secrets", "external-secrets"),
+    ),
+    "aws_secrets_credentials": (
+        lambda ctx: {"cluster": ctx.master_private_ip, "state": _tf_state_key(ctx.env)},
+        lambda ctx: kube_client().exists(resource_path("Secret", "external-secrets", "aws-secrets-credentials")),
+    ),
+    "external_secrets_manifests": (
+        lambda ctx: {"cluster": ctx.master_private_ip, "manifests": _hash_tree(os.path.join(_SCRIPT_DIR, "external-secrets"))},
+        lambda ctx: kube_client().exists(resource_path("ClusterSecretStore", name="aws-secrets-manager")),
+    ),
+}
+
+
+def _build_env_steps(ctx):
+    """Pipeline của một env (dev/prod/management). Sau khi tunnel lên, các Helm install độc lập chạy song song."""
+    steps = [
+        Step("terraform", _step_terraform),
+        Step("outputs", _step_outputs, ("terraform",)),
+    ]
+    if ctx.env == "management":
+        steps.append(Step("openvpn_ansible", _step_openvpn_ansible, ("outputs",)))
+        steps.append(Step("kubeconfig", _step_kubeconfig, ("openvpn_ansible",)))
+    else:
+        steps.append(Step("kubeconfig", _step_kubeconfig, ("outputs",)))
+    steps += [
+        Step("api_from_openvpn", _step_api_from_openvpn, ("kubeconfig",)),
+        Step("port_forward", _step_port_forward, ("api_from_openvpn",)),
+        Step("tunnel_kubeconfig", lambda ctx: _create_tunnel_kubeconfig(ctx.api_port), ("port_forward",)),
+        Step("k8s_api", _step_k8s_api, ("tunnel_kubeconfig",)),
+        Step("nlb_health", _step_nlb_health, ("port_forward",)),
+        Step("ebs_csi", lambda ctx: install_ebs_csi_driver(), ("k8s_api",)),
+    ]
+    if ctx.env == "management":
+        # Cluster management: CHỈ cài ArgoCD. ArgoCD này quản lý deploy sang dev/prod (không cài ArgoCD trên prod/dev).
+        steps.append(Step("argocd", _step_argocd, ("k8s_api",)))
+        cluster_steps = ("ebs_csi", "argocd")
+    else:
+        # Dev/Staging/Prod: KHÔNG cài ArgoCD. Chỉ Rancher, ESO, secrets. Apps deploy qua ArgoCD trên management.
+        steps += [
+            Step("rancher", lambda ctx: install_rancher(), ("k8s_api",)),
+            Step("external_secrets_operator", lambda ctx: install_external_secrets_operator(), ("k8s_api",)),
+            Step("aws_secrets_credentials", lambda ctx: ensure_aws_secrets_credentials(), ("external_secrets_operator",)),
+            Step("external_secrets_manifests", lambda ctx: apply_external_secrets_manifests(), ("aws_secrets_credentials",)),
+        ]
+        cluster_steps = ("ebs_csi", "rancher", "external_secrets_manifests")
+    steps.append(Step("etc_hosts", _step_etc_hosts, cluster_steps))
+    final_deps = ("etc_hosts", "nlb_health")
+    if ctx.env != "management":
+        steps.append(Step("rancher_portforward", _step_rancher_portforward, ("rancher", "etc_hosts")))
+        final_deps += ("rancher_portforward",)
     # VPN chạy nền: tạo systemd service (project này) để không cần giữ terminal
-    _setup_openvpn_systemd_service()
+    steps.append(Step("openvpn_systemd", lambda ctx: _setup_openvpn_systemd_service(), final_deps))
+    return [step._replace(fingerprint=_RESUME[step.name][0], check=_RESUME[step.name][1]) if step.name in _RESUME else step
+            for step in steps]
+
+
+# --- Plan (--plan): step nào sẽ chạy + thời gian ước tính theo lịch sử (history.db), không thay đổi gì ---
+# Chỉ đọc: terraform plan -lock=false, journal, Helm release / Secret trên cluster (qua tunnel manager, nếu có).
+def _step_history(limit=5):
+    """{(env, step): [giây]} của tối đa limit lần chạy xong gần nhất (history.db)."""
+    history = {}
+    if not os.path.isfile(_HISTORY_DB):
+        return history
+    try:
+        with closing(_history_db()) as db:
+            rows = db.execute("SELECT env, name, duration FROM steps WHERE outcome = 'ok' ORDER BY started DESC").fetchall()
+    except sqlite3.Error:
+        return history
+    for env, name, duration in rows:
+        runs = history.setdefault((env, name), [])
+        if len(runs) < limit:
+            runs.append(duration)
+    return history
+
+
+def _estimate(history, env, name):
+    """Median thời gian của step (giây); None nếu chưa có lịch sử."""
+    runs = sorted(history.get((env, name), ()))
+    return runs[len(runs) // 2] if runs else None
+
+
+def _terraform_plan(env_name):
+    """Tóm tắt `terraform plan` của env (không lock state, không ghi gì): "no changes", "N to add, ..." hoặc lý do."""
+    env_dir = os.path.join(TERRAFORM_DIR, "environments", env_name)
+    if not os.path.isdir(os.path.join(env_dir, ".terraform")):
+        return "not initialized (init + full apply)"
+    var_file = []
+    if env_name != "networking":
+        if not os.path.isfile(os.path.join(env_dir, "terraform.tfvars")):
+            return "no terraform.tfvars yet (tạo từ .example khi deploy)"
+        var_file = ["-var-file=terraform.tfvars"]
+    try:
+        res = run_process(
+            ["terraform", f"-chdir=environments/{env_name}", "plan", "-detailed-exitcode", "-lock=false",
+             "-input=false", "-no-color", *var_file],
+            cwd=TERRAFORM_DIR, capture_output=True, text=True, timeout=600,
+        )
+    except subprocess.TimeoutExpired:
+        return "terraform plan timed out"
+    if res.returncode == 0:
+        return "no changes (apply skipped)" if DEPLOY_TF_INCREMENTAL else "no changes (apply is a no-op)"
+    if res.returncode == 2:
+        m = re.search(r"Plan: (\d+) to add, (\d+) to change, (\d+) to destroy", res.stdout)
+        return m.group(0)[len("Plan: "):] if m else "changes pending"
+    lines = [line for line in (res.stderr or res.stdout).splitlines() if line.strip()]
+    return "plan failed: " + (lines[-1].strip()[:120] if lines else f"exit {res.returncode}")
+
+
+def _plan_step(step, ctx, entries, tf_envs):
+    """(action, lý do) của step khi chạy thật: "run" hoặc "skip" (--resume + journal khớp)."""
+    unchanged = None
+    if step.fingerprint is not None and step.check is not None:
+        entry = entries.get(step.name)
+        try:
+            if not entry:
+                unchanged = "not in journal"
+            elif StepJournal.fingerprint(step, ctx) != entry.get("fingerprint"):
+                unchanged = "input changed since last run"
+            elif not step.check(ctx):
+                unchanged = "post-condition not met (release / secret missing)"
+            else:
+                unchanged = True
+        except Exception as e:
+            unchanged = f"cannot inspect ({type(e).__name__}: {str(e)[:80]})"
+    if step.name in tf_envs:
+        if tf_envs[step.name] is None:
+            return "skip", "SKIP_TERRAFORM=1"
+        if unchanged is True and ctx.resume:
+            return "skip", "unchanged since last apply (--resume)"
+        return "run", _terraform_plan(tf_envs[step.name])
+    if unchanged is True:
+        return ("skip", "unchanged (--resume)") if ctx.resume else ("run", "unchanged since last run (skip with --resume)")
+    return "run", unchanged or "always runs"
+
+
+def _print_plan(title, steps, plans, history, env):
+    """Bảng step graph + ước tính; tổng = critical path (step độc lập chạy song song)."""
+    print(f"\n--- Plan: {title} (không thay đổi gì) ---")
+    print(f"  {'step':<28} {'after':<30} {'action':<6} {'est.':>7}  reason")
+    finish = {}
+    unknown = []
+    for step in steps:  # steps đã theo thứ tự topo (deps khai báo trước)
+        action, reason = plans[step.name]
+        est = _estimate(history, env, step.name) if action == "run" else 0
+        if est is None:
+            unknown.append(step.name)
+        finish[step.name] = max((finish[d] for d in step.deps), default=0) + (est or 0)
+        deps = ",".join(step.deps)
+        deps = deps if len(deps) <= 30 else deps[:29] + "…"
+        print(f"  {step.name:<28} {deps:<30} {action:<6} {_fmt_duration(est):>7}  {reason}")
+    runs = sum(1 for a, _ in plans.values() if a == "run")
+    print(f"  ≈ {_fmt_duration(max(finish.values(), default=0))} (critical path; {runs}/{len(steps)} step chạy"
+          + (f"; chưa có lịch sử: {', '.join(unknown)}" if unknown else "") + ")")
+
+
+def _steps_after(steps, root):
+    """Tên các step phụ thuộc (trực tiếp hoặc gián tiếp) vào root."""
+    after = {root}
+    for step in steps:
+        if after & set(step.deps):
+            after.add(step.name)
+    return after - {root}
+
+
+def plan_env(ctx):
+    """./deploy.py <env> --plan."""
+    with use_env(ctx):
+        _plan_env(ctx)
+
+
+def _plan_env(ctx):
+    steps = _build_env_steps(ctx)
+    _check_step_graph(steps)
+    try:
+        entries = StepJournal.load(ctx.env)
+    except (OSError, ValueError):
+        entries = {}
+    tf_envs = {"terraform": None if ctx.skip_terraform else ctx.env}
+    plans = {}
+    if _tf_state_key(ctx.env) is None:
+        # Env mới: chưa có gì để kiểm tra, mọi step đều chạy
+        plans = {step.name: ("run", "new environment (no Terraform state)") for step in steps}
+        plans["terraform"] = _plan_step(steps[0], ctx, entries, tf_envs)
+    else:
+        _apply_outputs(ctx, terraform_outputs(ctx.env))
+        cluster_error = None
+        if not os.path.isfile(ctx.kubeconfig_file):
+            cluster_error = "no kubeconfig yet"
+        else:
+            port = tunnel("api", ctx.env, timeout=30)
+            if port:
+                _create_tunnel_kubeconfig(port)
+            else:
+                cluster_error = "API not reachable"
+        needs_cluster = _steps_after(steps, "k8s_api") if cluster_error else set()
+        for step in steps:
+            if step.name in needs_cluster:
+                plans[step.name] = ("run", f"cannot inspect cluster ({cluster_error})")
+        # terraform plan, ssh, API: chạy song song
+        todo = [step for step in steps if step.name not in plans]
+        with ThreadPoolExecutor(max_workers=max(1, len(todo)), thread_name_prefix="plan") as pool:
+            plan_step = _with_context(lambda step: _plan_step(step, ctx, entries, tf_envs))
+            for step, plan in zip(todo, pool.map(plan_step, todo)):
+                plans[step.name] = plan
+    _print_plan(ctx.env + (" --resume" if ctx.resume else ""), steps, plans, _step_history(), ctx.env)
+
+
+def plan_all(ctx):
+    """./deploy.py --plan: DAG của full pipeline + plan từng env (management/dev/prod song song, cùng process)."""
+    steps = _build_all_steps(parallel=False, resume=ctx.resume)
+    try:
+        entries = StepJournal.load("all")
+    except (OSError, ValueError):
+        entries = {}
+    tf_envs = {"terraform_dev": "dev", "terraform_prod": "prod", "networking": "networking"}
+
+    def plan_of(env):
+        # như full deploy: Terraform dev/prod là step riêng của pipeline. Output gom lại, in theo thứ tự env.
+        env_ctx = EnvContext(env, resume=ctx.resume, skip_terraform=env != "management")
+        with tempfile.TemporaryFile(mode="w+") as f:
+            with output_to(f):
+                try:
+                    plan_env(env_ctx)
+                except (Exception, SystemExit) as e:
+                    print(f"\n  ✗ {env} --plan: {type(e).__name__}: {e}")
+            f.seek(0)
+            return f.read()
+
+    envs = ("management", "dev", "prod")
+    with ThreadPoolExecutor(max_workers=len(steps) + len(envs), thread_name_prefix="plan") as pool:
+        env_plans = pool.map(plan_of, envs)
+        plan_step = _with_context(lambda step: _plan_step(step, ctx, entries, tf_envs))
+        plans = dict(zip((s.name for s in steps), pool.map(plan_step, steps)))
+        for text in env_plans:
+            print(text, end="")
+    _print_plan("all" + (" --resume" if ctx.resume else ""), steps, plans, _step_history(), "all")
+    print("  (sau pipeline: đăng ký cluster + Applications ArgoCD, vài giây)")
+
+
+def run_env(ctx):
+    """Deploy một env (dev/prod/management): pipeline step của env rồi in tổng kết. ctx: EnvContext."""
+    with use_env(ctx), env_lock(ctx):
+        ctx.journal = StepJournal(ctx.env, resume=ctx.resume)
+        try:
+            run_steps(_build_env_steps(ctx), ctx)
+        finally:
+            _print_wait_summary(ctx.env)
+        _print_env_summary(ctx)
+
+
+def main(argv=None):
+    global _RUN_DEADLINE
+    env, command, args, flags = _parse_args(sys.argv[1:] if argv is None else argv)
+    if command == "tunnels":
+        tunnels_command(args)
+        return
+    if command == "stats":
+        stats_command(args)
+        return
+    if command == "status":
+        status_command(args, as_json="--json" in flags)
+        return
+    # --resume: bỏ qua step đã xong ở lần chạy trước (journal .deploy/journal-<env>.json) nếu input không đổi
+    ctx = EnvContext(env, resume="--resume" in flags)
+    _CURRENT_ENV.set(ctx)
+    if command == "destroy":
+        atexit.register(_write_trace)
+        destroy_command(ctx, args)
+        return
+    if "--plan" in flags:
+        # --plan: in step sẽ chạy + thời gian ước tính (từ history.db), không thay đổi gì (không ghi trace / lịch sử)
+        if env == "all":
+            plan_all(ctx)
+        else:
+            plan_env(ctx)
+        return
+    atexit.register(_write_trace)
+    if DEPLOY_WAIT_BUDGET > 0:
+        _RUN_DEADLINE = Deadline(DEPLOY_WAIT_BUDGET)
+    try:
+        if env == "all":
+            with env_lock(ctx):
+                _run_deploy_all(ctx)
+        else:
+            run_env(ctx)
+    except BudgetExhausted as e:
+        print(f"\n  ✗ {e} (DEPLOY_WAIT_BUDGET={DEPLOY_WAIT_BUDGET:.0f}s)")
+        sys.exit(1)
+
+
+def _print_env_summary(ctx):
+    """Tổng kết cuối deploy một env: kubeconfig, SSH, URL UI."""
+    master_private_ip = ctx.master_private_ip
+    openvpn_public_ip = ctx.openvpn_public_ip
+    alb_dns = ctx.alb_dns
 
     print("\n" + "=" * 60)
     print("XXX Deployment Complete! XXX")
     print("=" * 60)
     print("\n📋 Cluster (kubeconfig theo env, chỉ cần VPN):")
-    print(f"   export KUBECONFIG={os.path.abspath(KUBECONFIG_FILE)}")
+    print(f"   export KUBECONFIG={os.path.abspath(ctx.kubeconfig_file)}")
     print(f"   kubectl get nodes")
-    if TERRAFORM_ENV == "management":
-        print(f"   ssh -o IdentitiesOnly=yes -i terraform/environments/{TERRAFORM_ENV}/k8s-key.pem ubuntu@{master_private_ip}")
+    if ctx.env == "management":
+        print(f"   ssh -o IdentitiesOnly=yes -i terraform/environments/{ctx.env}/k8s-key.pem ubuntu@{master_private_ip}")
         print(f"\n🔐 OpenVPN Server: {openvpn_public_ip}")
         print("   SSH qua jump: ssh -o IdentitiesOnly=yes -i terraform/environments/management/k8s-key.pem ubuntu@%s" % openvpn_public_ip)
     else:
-        print(f"   SSH qua Management: ssh -i .../management/k8s-key.pem ubuntu@{openvpn_public_ip} rồi ssh -i .../%s/k8s-key.pem ubuntu@%s" % (TERRAFORM_ENV, master_private_ip))
+        print(f"   SSH qua Management: ssh -i terraform/environments/{ctx.env}/k8s-key.pem -o ProxyCommand='ssh -i "
+              f"terraform/environments/management/k8s-key.pem -W %h:%p ubuntu@{openvpn_public_ip}' ubuntu@{master_private_ip}")
         print(f"\n🔐 Jump host (Management OpenVPN): {openvpn_public_ip}")
-    if TERRAFORM_ENV == "management":
+    if ctx.env == "management":
         if alb_dns:
             print(f"\n🌐 ArgoCD UI (Ingress via ALB):\n   http://argocd.local")
         print("\n   ArgoCD (port-forward nếu chưa có Ingress):\n   kubectl port-forward svc/argocd-server -n argocd 8080:443")
@@ -1527,8 +4371,8 @@ def main():
     else:
         if alb_dns:
             print(f"\n🌐 Rancher UI (Ingress via ALB):\n   https://{RANCHER_HOSTNAME}\n   admin / {RANCHER_BOOTSTRAP_PASSWORD}")
-            print(f"\n🌐 App (Ingress via ALB, env={TERRAFORM_ENV}):\n   https://{APP_INGRESS_HOST}")
-        print("\n🌐 Rancher UI (port-forward backup):\n   https://localhost:8443")
+            print(f"\n🌐 App (Ingress via ALB, env={ctx.env}):\n   https://{ctx.app_ingress_host}")
+        print(f"\n🌐 Rancher UI (port-forward backup):\n   https://localhost:{getattr(ctx, 'rancher_port', None) or 8443}")
         print("   ArgoCD chỉ chạy trên cluster management → http://argocd.local (sau khi deploy management).")
     print("\n⚠️  TLS note: self-signed cert → browser warning is expected.")
     print("=" * 60)
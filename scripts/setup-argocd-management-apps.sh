@@ -15,8 +15,9 @@ get_cluster_url() {
   local env="$1"
   (cd "$TERRAFORM_DIR" && terraform -chdir="environments/$env" output -raw cluster_api_url 2>/dev/null) || true
 }
-PROD_URL="$(get_cluster_url prod)"
-DEV_URL="$(get_cluster_url dev)"
+# deploy.py truyền CLUSTER_SERVER_<ENV> = server của cluster Secret vừa đăng ký (ArgoCD khớp destination theo server)
+PROD_URL="${CLUSTER_SERVER_PROD:-$(get_cluster_url prod)}"
+DEV_URL="${CLUSTER_SERVER_DEV:-$(get_cluster_url dev)}"
 
 if [[ -z "$PROD_URL" && -z "$DEV_URL" ]]; then
   echo "Lỗi: Không lấy được cluster_api_url từ terraform. Chạy terraform apply cho ít nhất một env (dev/prod)."
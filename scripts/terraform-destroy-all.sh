@@ -3,6 +3,7 @@
 # Thứ tự: networking trước (peering + routes), rồi dev -> prod -> management.
 # Lưu ý: networking dùng data lookup route table; nếu mgmt/dev/prod đã destroy trước thì
 # module networking đã dùng aws_route_tables + count nên vẫn destroy được (chỉ xóa peering).
+# Nhanh hơn (dev + prod song song, dọn tunnel / kubeconfig / VPN unit, báo thời gian từng env): ./deploy.py destroy
 set -e
 ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
 cd "$ROOT/terraform"
@@ -44,3 +44,8 @@ output "eso_secret_access_key" {
   value       = module.iam.eso_secret_access_key
   sensitive   = true
 }
+
+output "nlb_target_group_arn" {
+  value       = module.loadbalancers.nlb_tg_arn
+  description = "Target group của NLB API (deploy.py kiểm tra target health)"
+}
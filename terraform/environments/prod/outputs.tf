@@ -47,3 +47,8 @@ output "eso_secret_access_key" {
   sensitive   = true
   description = "ESO IAM secret key (deploy.py dùng, không in log)"
 }
+
+output "nlb_target_group_arn" {
+  value       = module.loadbalancers.nlb_tg_arn
+  description = "Target group của NLB API (deploy.py kiểm tra target health)"
+}
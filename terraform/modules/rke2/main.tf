@@ -28,8 +28,9 @@ resource "aws_instance" "masters" {
   }
 
   user_data = templatefile("${path.module}/userdata_master.sh", {
-    rke2_token = var.rke2_token
-    nlb_dns    = var.nlb_dns_name
+    rke2_token   = var.rke2_token
+    nlb_dns      = var.nlb_dns_name
+    rke2_version = var.rke2_version
   })
   # Spot one-time instances cannot be stopped for in-place user_data updates.
   # Force replacement when user_data changes.
@@ -70,6 +71,7 @@ resource "aws_instance" "workers" {
   user_data = templatefile("${path.module}/userdata_worker.sh", {
     rke2_token   = var.rke2_token
     master_ip    = aws_instance.masters[0].private_ip
+    rke2_version = var.rke2_version
   })
   # Spot one-time instances cannot be stopped for in-place user_data updates.
   # Force replacement when user_data changes.
@@ -14,7 +14,7 @@ sysctl --system || true
 
 # RKE2 Server Installation
 INSTANCE_IP=$(curl -s http://169.254.169.254/latest/meta-data/local-ipv4)
-curl -sfL https://get.rke2.io | INSTALL_RKE2_TYPE="server" sh -
+curl -sfL https://get.rke2.io | INSTALL_RKE2_VERSION="${rke2_version}" INSTALL_RKE2_TYPE="server" sh -
 mkdir -p /etc/rancher/rke2/
 cat <<EOT > /etc/rancher/rke2/config.yaml
 token: ${rke2_token}
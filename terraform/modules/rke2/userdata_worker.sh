@@ -15,7 +15,7 @@ MASTER_IP="${master_ip}"
 echo "Waiting for master node at $MASTER_IP:9345 to be ready..."
 timeout 600 bash -c 'until curl -k -s https://${master_ip}:9345 >/dev/null 2>&1 || nc -z ${master_ip} 9345; do sleep 10; done' || true
 
-curl -sfL https://get.rke2.io | INSTALL_RKE2_TYPE="agent" sh -
+curl -sfL https://get.rke2.io | INSTALL_RKE2_VERSION="${rke2_version}" INSTALL_RKE2_TYPE="agent" sh -
 mkdir -p /etc/rancher/rke2/
 cat <<EOT > /etc/rancher/rke2/config.yaml
 server: https://${master_ip}:9345
@@ -71,3 +71,9 @@ variable "use_spot_instances" {
   type    = bool
   default = true
 }
+
+variable "rke2_version" {
+  type        = string
+  default     = "v1.31.4+rke2r1"
+  description = "RKE2 release (INSTALL_RKE2_VERSION); its Kubernetes minor must satisfy every chart pinned in HELM_CHARTS (deploy.py)"
+}
@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import deploy  # noqa: E402
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    """history.db + SPANS riêng cho test, không đụng .deploy/ của repo."""
+    monkeypatch.setattr(deploy, "_STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(deploy, "_HISTORY_DB", str(tmp_path / "history.db"))
+    monkeypatch.setattr(deploy, "SPANS", [])
+    return tmp_path / "history.db"
+
+
+def _run_step(name, code):
+    with pytest.raises(SystemExit):
+        with deploy.span(name, "step"):
+            sys.exit(code)
+
+
+@pytest.mark.parametrize("code", [0, None])
+def test_sys_exit_zero_is_stopped_not_failed(history, code):
+    _run_step("outputs", code)
+    args = deploy.SPANS[-1]["args"]
+    assert "exit_code" not in args
+    assert deploy._step_outcome(args) == ("stopped", None)
+
+    deploy._record_history()
+    with sqlite3.connect(history) as db:
+        assert db.execute("SELECT outcome FROM steps WHERE name = 'outputs'").fetchone() == ("stopped",)
+        assert db.execute("SELECT outcome FROM runs").fetchone() == ("ok",)
+
+
+def test_sys_exit_nonzero_is_failed(history):
+    _run_step("outputs", 1)
+    assert deploy._step_outcome(deploy.SPANS[-1]["args"]) == ("failed", "exit 1")
+
+    deploy._record_history()
+    with sqlite3.connect(history) as db:
+        assert db.execute("SELECT outcome FROM runs").fetchone() == ("failed",)